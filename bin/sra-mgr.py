@@ -55,7 +55,7 @@ def do(args):
 def do_update_metadata(args, fs):
 
     if args.all:
-        sraids = fs.list()
+        sraids = fs.iter_list()
     else:
         sraids = args.sraids
 
@@ -2,7 +2,7 @@
 # PYTHON_ARGCOMPLETE_OK
 
 __copyright__ = '''
-sra-validator - command line utility for validating SRA reads
+sra-stat - command line utility for reporting statistics of SRA reads
 [https://github.com/vivaxgen/SRA-repo]
 (c) 2023 Hidayat Trimarsanto <trimarsanto@gmail.com>
 
@@ -14,18 +14,24 @@ import sys
 import os
 import argparse
 import argcomplete
-from utils import cexit, cerr
+from sra_repo.utils import cexit, cerr
 
 
 def init_argparse():
     p = argparse.ArgumentParser(
-        description='sra-validator'
+        description='sra-stat'
     )
 
     p.add_argument('-j', '--jobs', default=8, type=int,
                    help='number of jobs (or processors) to use')
+    p.add_argument('--sample', default=0, type=int,
+                   help='estimate statistics from N sampled reads per file, instead of '
+                   'reading all reads')
+    p.add_argument('--max-length', default=1024, type=int,
+                   help='maximum read length of the histograms, longer reads are '
+                   'accumulated into the last bin [1024]')
     p.add_argument('infiles', nargs='+',
-                   help='fastq files to be validated')
+                   help='fastq files to be analyzed')
     return p
 
 
@@ -35,53 +41,31 @@ def main():
     args = p.parse_args()
 
     from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
     import pandas as pd
 
-    infile_list = []
-    maxlen_list = []
-    minlen_list = []
-    avglen_list = []
-    minqual_list = []
-    maxqual_list = []
+    summaries = []
+    stat_func = partial(stat_file, sample=args.sample, max_length=args.max_length)
 
     with ProcessPoolExecutor(max_workers=min(len(args.infiles), args.jobs)) as executor:
-        for results in executor.map(stat_file, args.infiles):
-            infile, reads, bases, minlen, avglen, maxlen, minqual, maxqual = results
-            infile_list.append(infile)
-            maxlen_list.append(maxlen)
-            minlen_list.append(minlen)
-            avglen_list.append(avglen)
-            minqual_list.append(minqual)
-            maxqual_list.append(maxqual)
+        for (infile, summary) in executor.map(stat_func, args.infiles):
+            summaries.append(dict(file=infile, **summary))
             cerr(f'[Finish stating file: {infile}]')
 
-    df = pd.DataFrame({'FILE': infile_list,
-                       'MAXLEN': maxlen_list, 'MINLEN': minlen_list, 'AVGLEN': avglen_list,
-                       'MINQUAL': minqual_list, 'MAXQUAL': maxqual_list})
+    df = pd.DataFrame(summaries)
+    df.columns = [c.upper() for c in df.columns]
     print(df)
 
 
-def stat_file(infile):
+def stat_file(infile, sample=0, max_length=1024):
 
-    import pyfastx
-    import statistics
+    from sra_repo import fastq_stats
 
-    fq = pyfastx.Fastq(infile, build_index=False)
-    lengths = []
-    quals = []
-    for name, seq, qual in fq:
-        lengths.append(len(qual))
-        quals.append(quals)
-
-    return (infile,
-            len(lengths),
-            sum(lengths),
-            min(lengths),
-            statistics.mean(lengths),
-            max(lengths),
-            min(map(min, quals)),
-            max(map(max, quals)),
-            )
+    if sample > 0:
+        stats = fastq_stats.sample_file(infile, sample, max_length)
+    else:
+        stats = fastq_stats.stat_file(infile, max_length)
+    return (infile, stats.summary())
 
 
 if __name__ == '__main__':
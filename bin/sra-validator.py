@@ -26,6 +26,9 @@ def init_argparse():
                    help='number of total reads per fastq files')
     p.add_argument('--bases', required=True, type=int,
                    help='number of total bases from all fastq files')
+    p.add_argument('-j', '--threads', type=int, default=min(os.cpu_count() or 1, 8),
+                   help='number of processes for decompressing the files, a single '
+                   'gzip file is split across processes when possible [min(cpus, 8)]')
     p.add_argument('infiles', nargs='+',
                    help='fastq files to be validated')
     return p
@@ -43,8 +46,8 @@ def main():
         file_bases = []
         file_reads = []
         file_names = []
-        with ProcessPoolExecutor(max_workers=min(len(args.infiles), 8)) as executor:
-            for infile, reads, bases in executor.map(count_file, args.infiles):
+        with ProcessPoolExecutor(max_workers=max(args.threads, 1)) as executor:
+            for infile, reads, bases in count_files(executor, args.infiles, args.threads):
                 file_names.append(infile)
                 file_bases.append(bases)
                 file_reads.append(reads)
@@ -73,17 +76,19 @@ def main():
             path.unlink(missing_ok=True)
 
 
-def count_file(infile):
+def count_files(executor, infiles, threads):
+    """ count reads and bases by decompressing the files in large blocks and counting
+        their line structure, splitting each file into chunks decompressed by separate
+        processes when possible
+    """
 
-    import pyfastx
+    from sra_repo.parallel_gzip import submit_count, collect_count
 
-    bases = 0
-    reads = 0
-    fq = pyfastx.Fastq(infile, build_index=False)
-    for name, seq, qual in fq:
-        reads += 1
-        bases += len(seq)
-    return (infile, reads, bases)
+    nchunks = max(threads // len(infiles), 1)
+    jobs = [(infile, submit_count(executor, infile, nchunks)) for infile in infiles]
+    for (infile, futures) in jobs:
+        reads, bases = collect_count(executor, infile, futures)
+        yield (infile, reads, bases)
 
 
 if __name__ == '__main__':
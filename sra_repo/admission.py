@@ -0,0 +1,171 @@
+import os
+import pathlib
+import shutil
+import threading
+
+
+"""
+Disk-space admission control
+
+Before an SRA run is queued for download, the space needed in the temporary
+directory (downloaded files, converted files and conversion scratch space) and in
+the storage is reserved.  A run that does not fit is held back until other runs
+release their reservations, instead of failing with ENOSPC in the middle of a batch.
+
+Free space reported by the filesystem already includes the files written so far,
+hence the bytes of a run already materialized in the temporary directory (eg. by
+partial downloads) are subtracted from its outstanding reservation.
+"""
+
+# space needed for converting a file relative to its size, as (converted files,
+# scratch space during conversion); fasterq-dump writes uncompressed fastq files
+# before compressing them, unless streaming conversion is used
+conversion_factors = {
+    'sra': (1.3, 4.0),
+    'cram': (1.5, 2.0),
+}
+
+
+def file_kind(filename: str):
+    if filename.endswith('.fastq.gz'):
+        return 'fastq'
+    if filename.endswith('.cram'):
+        return 'cram'
+    # files from NCBI/Entrez are named with SRA ID only
+    return 'sra'
+
+
+class InsufficientSpace(ValueError):
+    """ the SRA run will never fit in the temporary directory or the storage """
+
+
+class Reservation(object):
+
+    def __init__(self, sra_id: str, amounts: dict[int, int]):
+        self.sra_id = sra_id
+        self.amounts = amounts
+
+
+class SpaceAdmission(object):
+    """ reserve space in the temporary directory and the storage for SRA runs """
+
+    def __init__(
+        self,
+        temp_directory: str | pathlib.Path,
+        store_directory: str | pathlib.Path,
+        *,
+        headroom: int = 1024 ** 3,
+        stream_convert: bool = False,
+        poll_interval: float = 30,
+    ):
+        self.temp_directory = pathlib.Path(temp_directory)
+        self.tmp_dev = os.stat(temp_directory).st_dev
+        self.store_dev = os.stat(store_directory).st_dev
+        self.volumes = {self.tmp_dev: temp_directory, self.store_dev: store_directory}
+        self.headroom = headroom
+        self.stream_convert = stream_convert
+        self.poll_interval = poll_interval
+        self.active = {}
+        self.cond = threading.Condition()
+
+    def estimate(self, info):
+        """ return (temporary space, storage space) needed for the SRA run """
+
+        tmp_space = store_space = 0
+        for (filename, size) in zip(info.files, info.sizes or []):
+            if not size or size < 0:
+                continue
+            kind = file_kind(filename)
+            if kind in conversion_factors:
+                output_factor, scratch_factor = conversion_factors[kind]
+                if kind == 'sra' and self.stream_convert:
+                    scratch_factor = 0
+                tmp_space += int(size * (1 + output_factor + scratch_factor))
+                store_space += int(size * output_factor)
+            else:
+                tmp_space += size
+                store_space += size
+
+        return (tmp_space, store_space)
+
+    def _materialized(self, reservation):
+        """ return the bytes already allocated by the files of the SRA run """
+        total = 0
+        sra_id = reservation.sra_id
+        for path in self.temp_directory.glob(f'{sra_id}*'):
+            # skip files of other SRA IDs sharing the same prefix
+            if path.name != sra_id and path.name[len(sra_id)] not in '._':
+                continue
+            try:
+                # use allocated blocks, since preallocated files may be sparse
+                total += path.stat().st_blocks * 512
+            except FileNotFoundError:
+                pass
+        return total
+
+    def _outstanding(self, dev, reservation):
+        amount = reservation.amounts.get(dev, 0)
+        if dev == self.tmp_dev and amount > 0:
+            amount -= self._materialized(reservation)
+        return max(0, amount)
+
+    def _never_fits(self, reservation):
+        for (dev, amount) in reservation.amounts.items():
+            if amount + self.headroom > shutil.disk_usage(self.volumes[dev]).total:
+                return True
+        return False
+
+    def _fits(self, reservation):
+        for dev in reservation.amounts:
+            need = self._outstanding(dev, reservation)
+            if need == 0:
+                continue
+            free = shutil.disk_usage(self.volumes[dev]).free
+            reserved = sum(self._outstanding(dev, r) for r in self.active.values())
+            if free - reserved - self.headroom < need:
+                return False
+        return True
+
+    def acquire(self, info, log=None):
+        """ block until the space for the SRA run can be reserved, or raise
+            InsufficientSpace if the SRA run will never fit
+        """
+
+        tmp_space, store_space = self.estimate(info)
+        amounts = {self.tmp_dev: tmp_space}
+        if self.store_dev != self.tmp_dev:
+            # on the same filesystem, the files are moved to the storage without copying
+            amounts[self.store_dev] = store_space
+        reservation = Reservation(info.sra_id, amounts)
+
+        with self.cond:
+            waiting = False
+            while not self._fits(reservation):
+                if not self.active or self._never_fits(reservation):
+                    # nothing will be released, hence waiting will not help
+                    raise InsufficientSpace(f'not enough disk space for {info.sra_id}, needing '
+                                     f'{tmp_space} bytes of temporary space and {store_space} '
+                                     f'bytes of storage space')
+                if log and not waiting:
+                    log(f'Waiting for disk space for {info.sra_id}')
+                    waiting = True
+                self.cond.wait(self.poll_interval)
+            self.active[info.sra_id] = reservation
+
+        return reservation
+
+    def update(self, sra_id: str, tmp_space: int):
+        """ set the temporary space still needed by the SRA run, eg. 0 once all of its
+            files have been downloaded and converted
+        """
+        with self.cond:
+            if (reservation := self.active.get(sra_id)):
+                reservation.amounts[self.tmp_dev] = tmp_space
+            self.cond.notify_all()
+
+    def release(self, sra_id: str):
+        with self.cond:
+            self.active.pop(sra_id, None)
+            self.cond.notify_all()
+
+# EOF
@@ -0,0 +1,225 @@
+import json
+import sqlite3
+import threading
+import time
+import pathlib
+
+
+"""
+SRA catalog database
+
+The catalog is a SQLite database kept in the .sra-repo-db file at the root of the
+storage, so that list, check, info and path queries do not need to walk the sharded
+directory tree.  The files in the storage are always the primary data, the catalog
+can be rebuilt from them at anytime with: sra-repo.py reindex
+
+The file_fingerprint table records the (inode, size, mtime_ns, ctime_ns) of each file
+after its MD5 hash has been successfully verified, so that unchanged files can be
+skipped by the next validation.  It does not reference the sra table, since the
+sra entries are replaced whenever the SRA info is updated, and is kept by reindex.
+"""
+
+catalog_schema = """
+CREATE TABLE IF NOT EXISTS sra (
+    sra_id TEXT PRIMARY KEY,
+    source TEXT,
+    read_count INTEGER,
+    base_count INTEGER,
+    metadata TEXT,
+    info TEXT,
+    updated REAL
+);
+
+CREATE TABLE IF NOT EXISTS sra_file (
+    sra_id TEXT NOT NULL REFERENCES sra(sra_id) ON DELETE CASCADE,
+    filename TEXT NOT NULL,
+    size INTEGER,
+    md5sum TEXT,
+    PRIMARY KEY (sra_id, filename)
+);
+
+CREATE TABLE IF NOT EXISTS file_fingerprint (
+    sra_id TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    inode INTEGER,
+    size INTEGER,
+    mtime_ns INTEGER,
+    ctime_ns INTEGER,
+    md5sum TEXT,
+    verified_at REAL,
+    PRIMARY KEY (sra_id, filename)
+);
+
+CREATE TABLE IF NOT EXISTS catalog_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class SRACatalog(object):
+    """ SQLite-based index of all SRA IDs in the storage
+
+        each thread uses its own connection, and all updates are performed
+        in a single transaction per SRA ID
+    """
+
+    def __init__(self, db_path: str | pathlib.Path, timeout: float = 60):
+        self.db_path = pathlib.Path(db_path)
+        self.timeout = timeout
+        self._local = threading.local()
+
+        # create tables if not exist yet, this will raise sqlite3.DatabaseError
+        # if db_path is not a SQLite database
+        with self._conn() as conn:
+            conn.executescript(catalog_schema)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path.as_posix(), timeout=self.timeout)
+            conn.execute('PRAGMA foreign_keys = ON')
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _insert(self, conn, sra_id, info, files):
+        """ info is a dictionary from SRA_Info or None, files is a list of
+            (filename, size, md5sum)
+        """
+
+        if info is not None:
+            source = info['source']
+            read_count = info['read_count']
+            base_count = info['base_count']
+            metadata = json.dumps(info['metadata'])
+            info = json.dumps(info)
+        else:
+            source = read_count = base_count = metadata = None
+
+        conn.execute('DELETE FROM sra WHERE sra_id = ?', (sra_id,))
+        conn.execute(
+            'INSERT INTO sra (sra_id, source, read_count, base_count, metadata, info, updated) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (sra_id, source, read_count, base_count, metadata, info, time.time())
+        )
+        conn.executemany(
+            'INSERT INTO sra_file (sra_id, filename, size, md5sum) VALUES (?, ?, ?, ?)',
+            [(sra_id, filename, size, md5sum) for (filename, size, md5sum) in files]
+        )
+
+    def update(self, info: dict):
+        """ add or replace the entry of an SRA ID using dictionary from SRA_Info """
+
+        files = list(zip(info['files'],
+                         info['sizes'] or [None] * len(info['files']),
+                         info['md5sums'] or [None] * len(info['files'])))
+        with self._conn() as conn:
+            self._insert(conn, info['sra_id'], info, files)
+
+    def remove(self, sra_id: str):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM sra WHERE sra_id = ?', (sra_id,))
+            conn.execute('DELETE FROM file_fingerprint WHERE sra_id = ?', (sra_id,))
+
+    def has(self, sra_id: str):
+        cur = self._conn().execute('SELECT 1 FROM sra WHERE sra_id = ?', (sra_id,))
+        return cur.fetchone() is not None
+
+    def get_info(self, sra_id: str):
+        """ return the dictionary of SRA_Info or None if SRA ID does not have info """
+        cur = self._conn().execute('SELECT info FROM sra WHERE sra_id = ?', (sra_id,))
+        row = cur.fetchone()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    def get_files(self, sra_id: str):
+        """ return list of filenames or None if SRA ID is not in the catalog """
+        if not self.has(sra_id):
+            return None
+        cur = self._conn().execute(
+            'SELECT filename FROM sra_file WHERE sra_id = ? ORDER BY filename', (sra_id,)
+        )
+        return [row[0] for row in cur]
+
+    def get_fingerprints(self, sra_id: str):
+        """ return a dictionary of filename to (inode, size, mtime_ns, ctime_ns, md5sum)
+            of the verified files of the SRA ID
+        """
+        cur = self._conn().execute(
+            'SELECT filename, inode, size, mtime_ns, ctime_ns, md5sum FROM file_fingerprint '
+            'WHERE sra_id = ?', (sra_id,)
+        )
+        return {row[0]: tuple(row[1:]) for row in cur}
+
+    def set_fingerprints(self, sra_id: str, fingerprints: list[tuple]):
+        """ record fingerprints of verified files as a list of
+            (filename, inode, size, mtime_ns, ctime_ns, md5sum)
+        """
+        verified_at = time.time()
+        with self._conn() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO file_fingerprint (sra_id, filename, inode, size, '
+                'mtime_ns, ctime_ns, md5sum, verified_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(sra_id, *fingerprint, verified_at) for fingerprint in fingerprints]
+            )
+
+    def iter_ids(self, patterns: list[str] | None = None):
+        """ iterate over SRA IDs matching any of the glob patterns """
+        if patterns:
+            cur = self._conn().execute(
+                'SELECT sra_id FROM sra WHERE ' + ' OR '.join(['sra_id GLOB ?'] * len(patterns)),
+                patterns
+            )
+        else:
+            cur = self._conn().execute('SELECT sra_id FROM sra')
+        for row in cur:
+            yield row[0]
+
+    def count(self):
+        return self._conn().execute('SELECT COUNT(*) FROM sra').fetchone()[0]
+
+    def is_indexed(self):
+        """ return True if the catalog has been (re)built from the storage, hence
+            it has all SRA IDs
+        """
+        cur = self._conn().execute("SELECT value FROM catalog_meta WHERE key = 'indexed'")
+        return cur.fetchone() is not None
+
+    def rebuild(self, entries):
+        """ rebuild the catalog from entries of (sra_id, info, files), with info is a
+            dictionary from SRA_Info or None and files is a list of (filename, size, md5sum)
+        """
+
+        counter = 0
+        with self._conn() as conn:
+            conn.execute('DELETE FROM sra_file')
+            conn.execute('DELETE FROM sra')
+            for (sra_id, info, files) in entries:
+                self._insert(conn, sra_id, info, files)
+                counter += 1
+            conn.execute("INSERT OR REPLACE INTO catalog_meta (key, value) VALUES ('indexed', ?)",
+                         (str(time.time()),))
+
+        return counter
+
+
+def open_catalog(db_path: str | pathlib.Path):
+    """ return SRACatalog instance or None if db_path can not be used as a catalog """
+
+    from sra_repo.utils import cerr
+
+    try:
+        return SRACatalog(db_path)
+    except sqlite3.Error as err:
+        cerr(f'WARN: cannot use {db_path} as catalog database ({err}), '
+             f'walking the storage directly')
+        return None
+
+# EOF
@@ -2,7 +2,7 @@
 import os
 import argparse
 
-from sra_repo.utils import cerr, cout, cexit, byte_conversion
+from sra_repo.utils import cerr, cout, cexit, byte_conversion, parse_size
 
 
 def site_args(p):
@@ -13,6 +13,23 @@ def site_args(p):
                         'NCBI/Entrez [ena-entrez]')
 
 
+def metadata_args(p):
+
+    p.add_argument('--offline', default=False, action='store_true',
+                   help='only use metadata from the metadata cache, without querying '
+                        'EBI/ENA or NCBI/Entrez')
+    p.add_argument('--no-metadata-cache', default=False, action='store_true',
+                   help='do not use the metadata cache (set by SRA_REPO_METADATA_CACHE)')
+    p.add_argument('--metadata-ttl', default=30, type=float,
+                   help='number of days the cached metadata is valid [30]')
+    p.add_argument('--ena-rate', default=None, type=float,
+                   help='maximum number of requests per second to EBI/ENA, overriding '
+                        'SRA_REPO_ENA_RATE env [10]')
+    p.add_argument('--ncbi-rate', default=None, type=float,
+                   help='maximum number of requests per second to NCBI/Entrez, overriding '
+                        'SRA_REPO_NCBI_RATE env [3, or 10 with NCBI_API_KEY]')
+
+
 def input_args(p):
 
     p.add_argument('--idfile', default=None,
@@ -48,18 +65,48 @@ def init_argparse():
                                help='show SRA information')
     input_args(cmd_info)
 
+    # command: stats
+    cmd_stats = cmds.add_parser('stats',
+                                help='show read statistics of SRA, computing and storing them '
+                                'for SRA without statistics')
+    cmd_stats.add_argument('--cached-only', default=False, action='store_true',
+                           help='only show stored statistics, without reading fastq files')
+    cmd_stats.add_argument('--sample', default=0, type=int,
+                           help='estimate statistics from N sampled reads per file when '
+                           'computing them, without storing the estimates; single-member '
+                           'gzip files are sampled from their leading reads')
+    cmd_stats.add_argument('--json', default=False, action='store_true',
+                           help='output the full statistics including histograms as JSON lines')
+    input_args(cmd_stats)
+
     # command: check
     cmd_check = cmds.add_parser('check',
                                 help='check SRA ACCID in database')
     cmd_check.add_argument('--validate', default=False, action='store_true',
                            help='perform validation on number of reads and bases')
+    cmd_check.add_argument('--deep', default=False, action='store_true',
+                           help='with --validate, rehash all files including files that have '
+                           'not changed since their last successful verification')
     cmd_check.add_argument('--showcmds', default=False, action='store_true',
                            help='show commands to be remotely run')
     cmd_check.add_argument('--ntasks', default=4, type=int,
                            help='number of threads (ie samples) to run in parallel [4]')
+    cmd_check.add_argument('--device-readers', default=[], action='append',
+                           help='with --validate, maximum number of concurrent readers per device '
+                           'as KEY=N, with KEY either '
+                           'rotational, network, solid or a path in a device, can be used '
+                           'multiple times, overriding SRA_REPO_DEVICE_READERS env '
+                           '(eg. rotational=2,network=4,solid=8)')
+    cmd_check.add_argument('--executor', default=None,
+                           choices=['auto', 'local', 'srun', 'sbatch'],
+                           help='backend to run external tools, either local processes, '
+                           'Slurm job steps (srun) or Slurm batch jobs (sbatch), overriding '
+                           'SRA_REPO_EXECUTOR env [auto, ie. srun within Slurm allocation, '
+                           'otherwise local]')
     cmd_check.add_argument('--count', default=-1, type=int,
                            help='number of SRA IDs to be checked')
     site_args(cmd_check)
+    metadata_args(cmd_check)
     input_args(cmd_check)
 
     # command: link
@@ -87,8 +134,11 @@ def init_argparse():
     cmd_fetch.add_argument('--tmpdir', default=None,
                            help='directory to temporarily put donwloaded files, overriding '
                            'SRA_REPO_TMPDIR env')
-    cmd_fetch.add_argument('--ntasks', default=4, type=int,
+    cmd_fetch.add_argument('--download-tasks', '--ntasks', dest='ntasks', default=4, type=int,
                            help='number or tasks/workers performing downloads [4]')
+    cmd_fetch.add_argument('--process-tasks', default=2, type=int,
+                           help='number of tasks/workers verifying and converting downloaded '
+                           'files, running concurrently with downloads [2]')
     cmd_fetch.add_argument('--count', default=-1, type=int,
                            help='use for debugging - number of SRAs to download from list [-1]')
     cmd_fetch.add_argument('--reverselist', default=False, action='store_true',
@@ -97,10 +147,53 @@ def init_argparse():
                            help='show commands to run externally')
     cmd_fetch.add_argument('--showurl', default=False, action='store_true',
                            help='show URL during downloading')
+    cmd_fetch.add_argument('--engine', default='easy', choices=['easy', 'multi'],
+                           help='download engine, either a thread per transfer (easy) or '
+                           'a single CurlMulti event loop with --ntasks concurrent '
+                           'transfers (multi) [easy]')
+    cmd_fetch.add_argument('--segments', default=1, type=int,
+                           help='number of parallel connections for downloading a large file '
+                           'with known size [1]')
+    cmd_fetch.add_argument('--segment-threshold', default='1G',
+                           help='minimum file size for segmented download [1G]')
+    cmd_fetch.add_argument('--resolver', default='batch', choices=['batch', 'concurrent'],
+                           help='metadata resolver, either sequential batches (batch) or '
+                           'concurrent lookups in a thread pool (concurrent) [batch]')
+    cmd_fetch.add_argument('--lookups', default=8, type=int,
+                           help='number of concurrent metadata lookups with concurrent '
+                           'resolver [8]')
+    cmd_fetch.add_argument('--host-limit', default=[], action='append',
+                           help='maximum number of connections to a host as HOST=N, with * '
+                           'for any other hosts, can be used multiple times, overriding '
+                           'SRA_REPO_HOST_LIMITS env (eg. ftp.sra.ebi.ac.uk=4,*=8)')
+    cmd_fetch.add_argument('--bandwidth', default=None,
+                           help='maximum total download speed in bytes per second (eg. 50M), '
+                           'overriding SRA_REPO_BANDWIDTH env')
+    cmd_fetch.add_argument('--select-transport', default=False, action='store_true',
+                           help='choose between FTP, HTTPS and mirror urls by measured '
+                           'throughput, and switch stalled transfers to other urls')
+    cmd_fetch.add_argument('--stream-convert', default=False, action='store_true',
+                           help='convert .sra files by streaming fasterq-dump output directly '
+                           'into compressors, without writing uncompressed fastq files')
+    cmd_fetch.add_argument('--collect-stats', default=False, action='store_true',
+                           help='compute read statistics (length and quality histograms, '
+                           'GC content) during processing and store them in the SRA info')
+    cmd_fetch.add_argument('--executor', default=None,
+                           choices=['auto', 'local', 'srun', 'sbatch'],
+                           help='backend to run external tools, either local processes, '
+                           'Slurm job steps (srun) or Slurm batch jobs (sbatch), overriding '
+                           'SRA_REPO_EXECUTOR env [auto, ie. srun within Slurm allocation, '
+                           'otherwise local]')
+    cmd_fetch.add_argument('--space-headroom', default='1G',
+                           help='disk space to keep free when reserving space for each SRA '
+                           'in the temporary directory and the storage [1G]')
+    cmd_fetch.add_argument('--no-space-check', default=False, action='store_true',
+                           help='do not reserve disk space before downloading each SRA')
     cmd_fetch.add_argument('--targetdir', default=None,
                            help='instead of storing to central repository, move the '
                            'downloaded files to this target directory')
     site_args(cmd_fetch)
+    metadata_args(cmd_fetch)
     input_args(cmd_fetch)
 
     # command: list
@@ -117,6 +210,10 @@ def init_argparse():
     cmd_inventory.add_argument('--species', default=False, action='store_true',
                                help='count number of each species')
 
+    # command: reindex
+    cmds.add_parser('reindex',
+                    help='rebuild catalog database from the files in the storage')
+
     # common arguments
     p.add_argument('--rootfs', default=None,
                    help='set root storage filesystem, default is using environment '
@@ -154,9 +251,15 @@ def do_command(args):
         case 'info':
             do_info(args, fs)
 
+        case 'stats':
+            do_stats(args, fs)
+
         case 'inventory':
             do_inventory(args, fs)
 
+        case 'reindex':
+            do_reindex(args, fs)
+
         case _:
             cexit('ERR: please provide command')
 
@@ -180,13 +283,17 @@ def do_check(args, fs):
         sraids = sraids[:args.count]
 
     helpers = get_helpers(args)
+    cache = init_metadata_cache(args)
+    init_executor(args)
 
     validator = sra_validator.SRA_Validator(
         sraids,
         fs,
         helpers=helpers,
         validate=args.validate,
-        showcmds=args.showcmds
+        deep=args.deep,
+        showcmds=args.showcmds,
+        scheduler=init_device_scheduler(args),
     )
     validator.validate(threads=args.ntasks)
 
@@ -198,9 +305,13 @@ def do_check(args, fs):
         cerr('\n'.join(errors))
     if args.validate:
         cerr(f'{validator.finished - len(errors)} SRA ID(s) have been validated successfully.')
+        cerr(f'{validator.skipped_files} file(s) skipped with unchanged fingerprints, '
+             f'{validator.rehashed_files} file(s) rehashed.')
     else:
         cerr(f'{validator.finished - len(errors)} SRA ID(s) are in repository '
              f'(but no validation checks were performed)')
+    if cache:
+        cerr(cache.summary())
 
 
 def do_link(args, fs):
@@ -287,9 +398,17 @@ def do_link(args, fs):
 
 def do_list(args, fs):
 
-    sra_list = fs.list()
+    # stream SRA IDs instead of collecting them, and only show the IDs
+    # when requested
+    show_ids = args.all or any(args.patterns)
+
+    counter = 0
+    for sra_id in fs.iter_list(args.patterns):
+        if show_ids:
+            cout(sra_id)
+        counter += 1
 
-    cout(f'Total SRA number: {len(sra_list)}')
+    cout(f'Total SRA number: {counter}')
 
 
 def do_path(args, fs):
@@ -333,6 +452,44 @@ def do_info(args, fs):
     cout(yaml.dump(d))
 
 
+def do_stats(args, fs):
+    """ show read statistics from SRA info, which are computed from the fastq files
+        and stored on the first request
+    """
+
+    import json
+
+    summary_fields = ['reads', 'bases', 'min_length', 'avg_length', 'max_length',
+                      'min_qual', 'max_qual', 'mean_qual', 'q30', 'gc', 'n_content']
+
+    SRAIDs = get_sraids(args)
+
+    if not args.json:
+        cout('\t'.join(['SRA'] + [f.upper() for f in summary_fields]))
+
+    err_list = []
+    for sra_id in SRAIDs:
+        if not fs.check(sra_id=sra_id, throw_exc=False):
+            err_list.append(f'{sra_id} is not found in database')
+            continue
+        try:
+            stats = fs.get_stats(sra_id, compute=not args.cached_only, sample=args.sample)
+        except (OSError, ValueError) as err:
+            err_list.append(f'{sra_id}: {err}')
+            continue
+        if stats is None:
+            err_list.append(f'{sra_id} does not have stored statistics')
+            continue
+
+        if args.json:
+            cout(json.dumps(dict(sra_id=sra_id, **stats)))
+        else:
+            cout('\t'.join([sra_id] + [str(stats[f]) for f in summary_fields]))
+
+    if err_list:
+        cerr('\n'.join(err_list))
+
+
 def do_fetch(args, fs):
     """ fetch fastq files from provided ENA IDs """
 
@@ -365,6 +522,14 @@ def do_fetch(args, fs):
         cexit('ERROR: please set SRA_REPO_TMPDIR or supply --tmpdir')
 
     repos = get_helpers(args)
+    cache = init_metadata_cache(args)
+    limiter = init_limiter(args)
+    init_executor(args)
+
+    transport = None
+    if args.select_transport:
+        from sra_repo.transport import TransportSelector
+        transport = TransportSelector()
 
     fetcher = SRA_Fetcher(
         sraid_dl,
@@ -373,11 +538,25 @@ def do_fetch(args, fs):
         repos=repos,
         showcmds=args.showcmds,
         showurl=args.showurl,
-        target_directory=args.targetdir
+        target_directory=args.targetdir,
+        segments=args.segments,
+        segment_threshold=parse_size(args.segment_threshold),
+        engine=args.engine,
+        resolver=args.resolver,
+        lookups=args.lookups,
+        process_tasks=args.process_tasks,
+        stream_convert=args.stream_convert,
+        space_headroom=None if args.no_space_check else parse_size(args.space_headroom),
+        limiter=limiter,
+        transport=transport,
+        collect_stats=args.collect_stats,
     )
 
     fetcher.fetch(ntasks=args.ntasks, count=args.count)
 
+    if transport:
+        transport.save()
+
     if any(fetcher.sra_errors) or any(fetcher.sra_d):
         cerr(f'Completed {fetcher.completed} out of {len(sraid_dl)} SRAs to download.')
         cerr(f'WARNING: there are unsuccessful {len(fetcher.sra_errors) + len(fetcher.sra_d)} SRA(s) downloads:')
@@ -385,6 +564,8 @@ def do_fetch(args, fs):
         cerr('\n'.join(fetcher.sra_d.keys()))
     else:
         cerr(f'All {fetcher.completed} SRA(s) have been successfully downloaded.')
+    if cache:
+        cerr(cache.summary())
 
     # report = ena_downloader.fetch_ena(enaid_dl, args.tmpdir, fs)
 
@@ -401,8 +582,8 @@ def do_inventory(args, fs):
 
     cerr(f'Root DB directory: {fs.__storage_root_path__}')
 
-    sra_list = fs.list()
-    cerr(f'Total SRA number: {len(sra_list)}')
+    counter = sum(1 for _ in fs.iter_list())
+    cerr(f'Total SRA number: {counter}')
 
     res = shutil.disk_usage(fs.__storage_root_path__)
     cerr(f'Used space: {byte_conversion(res.used)}')
@@ -410,6 +591,13 @@ def do_inventory(args, fs):
     cerr(f'Allocated space: {byte_conversion(res.total)}')
 
 
+def do_reindex(args, fs):
+
+    cerr(f'Rebuilding catalog for {fs.__storage_root_path__}')
+    counter = fs.reindex()
+    cerr(f'Catalog has been rebuilt with {counter} SRA ID(s)')
+
+
 def iter_samplefile(samplefile):
     """ return a list of (sample, [SRAID, ...]) """
 
@@ -486,6 +674,72 @@ def get_sraids(args):
     return SRAIDs
 
 
+def init_metadata_cache(args):
+
+    from sra_repo import metadata_cache, http_utils
+
+    # request rates are part of the metadata access settings
+    for service in ['ena', 'ncbi']:
+        if (rate := getattr(args, f'{service}_rate', None)):
+            http_utils.set_rate(service, rate)
+
+    try:
+        return metadata_cache.init_cache(
+            offline=getattr(args, 'offline', False),
+            ttl=getattr(args, 'metadata_ttl', 30) * 24 * 3600,
+            disabled=getattr(args, 'no_metadata_cache', False),
+        )
+    except ValueError as err:
+        cexit(f'ERROR: {err}')
+
+
+def init_limiter(args):
+    """ return TransferLimiter from command line arguments and environment, or None
+        if no limits are set
+    """
+
+    from sra_repo.download_utils import TransferLimiter, parse_host_limits
+
+    try:
+        host_limits = parse_host_limits(os.environ.get('SRA_REPO_HOST_LIMITS', ''))
+        for spec in args.host_limit:
+            host_limits.update(parse_host_limits(spec))
+        bandwidth = args.bandwidth or os.environ.get('SRA_REPO_BANDWIDTH', None)
+        bandwidth = parse_size(bandwidth) if bandwidth else None
+    except ValueError as err:
+        cexit(f'ERROR: {err}')
+
+    if not host_limits and not bandwidth:
+        return None
+    return TransferLimiter(host_limits, bandwidth)
+
+
+def init_device_scheduler(args):
+    """ return DeviceScheduler from command line arguments and environment """
+
+    from sra_repo.device_scheduler import DeviceScheduler, parse_device_readers
+
+    try:
+        readers = parse_device_readers(os.environ.get('SRA_REPO_DEVICE_READERS', ''))
+        for spec in args.device_readers:
+            readers.update(parse_device_readers(spec))
+        return DeviceScheduler(readers)
+    except ValueError as err:
+        cexit(f'ERROR: {err}')
+
+
+def init_executor(args):
+    """ set the global executor from command line arguments and environment """
+
+    from sra_repo.executor import create_executor, set_executor
+
+    try:
+        set_executor(executor := create_executor(args.executor))
+    except ValueError as err:
+        cexit(f'ERROR: {err}')
+    return executor
+
+
 def get_helpers(args):
 
     match args.site:
@@ -0,0 +1,143 @@
+import os
+import pathlib
+import threading
+
+from contextlib import contextmanager
+
+
+"""
+Device-aware I/O scheduling
+
+The number of concurrent readers is limited per underlying device (st_dev of the
+files), so that rotational disks and network filesystems are not thrashed by too
+many concurrent streams, while solid-state devices are read at full speed.
+
+The kind of each device is detected as:
+
+ - network, if it is mounted as a network filesystem (eg. NFS, CIFS, Lustre)
+ - rotational, if the block device or any of its underlying disks (for partitions,
+   device-mapper or md devices) is rotational according to /sys/dev/block
+ - solid, otherwise
+
+The limits can be set with SRA_REPO_DEVICE_READERS environment or --device-readers
+argument, as KEY=N[,KEY=N...] with KEY either rotational, network or solid to set the
+limit of a kind of device, or a path to set the limit of the device containing the
+path, eg. rotational=1,/shared/SRA/store=4
+"""
+
+default_readers = {'rotational': 2, 'network': 4, 'solid': 8}
+
+network_fstypes = {'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'lustre', 'gpfs', 'beegfs',
+                   'ceph', 'glusterfs', 'fuse.glusterfs', 'fuse.sshfs', 'panfs', 'afs'}
+
+
+def parse_device_readers(spec: str):
+    """ parse device reader limits in the form of KEY=N[,KEY=N...] """
+    readers = {}
+    for item in spec.replace(';', ',').split(','):
+        if not (item := item.strip()):
+            continue
+        key, sep, limit = item.rpartition('=')
+        if not sep or not key:
+            raise ValueError(f'invalid device reader limit: {item}')
+        readers[key.strip()] = int(limit)
+    return readers
+
+
+def _mount_fstypes():
+    """ return a dictionary of MAJOR:MINOR to the filesystem type mounted on it """
+    fstypes = {}
+    try:
+        with open('/proc/self/mountinfo') as f:
+            for line in f:
+                fields = line.split()
+                # optional fields are terminated by a single hyphen
+                fstypes[fields[2]] = fields[fields.index('-') + 1]
+    except (OSError, ValueError, IndexError):
+        pass
+    return fstypes
+
+
+def _is_rotational(sys_path: pathlib.Path, depth: int = 0):
+    """ check the block device in /sys/block or /sys/dev/block, its parent disk for a
+        partition, or its underlying disks for device-mapper and md devices
+    """
+
+    if depth > 4 or not sys_path.exists():
+        return False
+    sys_path = sys_path.resolve()
+
+    slaves = sys_path / 'slaves'
+    if slaves.is_dir() and any(slaves.iterdir()):
+        return any(_is_rotational(slave, depth + 1) for slave in slaves.iterdir())
+
+    for path in [sys_path, sys_path.parent]:
+        if (rotational := path / 'queue' / 'rotational').is_file():
+            return rotational.read_text().strip() == '1'
+    return False
+
+
+def device_kind(dev: int):
+    """ return rotational, network or solid for the device number """
+
+    major_minor = f'{os.major(dev)}:{os.minor(dev)}'
+    if _mount_fstypes().get(major_minor, '') in network_fstypes:
+        return 'network'
+    if _is_rotational(pathlib.Path('/sys/dev/block') / major_minor):
+        return 'rotational'
+    return 'solid'
+
+
+class DeviceScheduler(object):
+    """ limit the number of concurrent readers per device """
+
+    def __init__(self, readers: dict[str, int] | None = None):
+        readers = dict(readers or {})
+        self.kind_readers = {kind: readers.pop(kind, limit)
+                             for (kind, limit) in default_readers.items()}
+        self.device_readers = {}
+        for (path, limit) in readers.items():
+            try:
+                self.device_readers[os.stat(path).st_dev] = limit
+            except OSError as err:
+                raise ValueError(f'invalid path for device reader limit: {path} ({err})')
+
+        self.kinds = {}
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def device_of(self, path: str | pathlib.Path):
+        return os.stat(path).st_dev
+
+    def limit_of(self, dev: int):
+        if dev in self.device_readers:
+            return max(self.device_readers[dev], 1)
+        with self._lock:
+            if dev not in self.kinds:
+                self.kinds[dev] = device_kind(dev)
+            kind = self.kinds[dev]
+        return max(self.kind_readers[kind], 1)
+
+    def _semaphore(self, dev):
+        limit = self.limit_of(dev)
+        with self._lock:
+            if dev not in self._semaphores:
+                self._semaphores[dev] = threading.BoundedSemaphore(limit)
+            return self._semaphores[dev]
+
+    @contextmanager
+    def reader(self, path: str | pathlib.Path):
+        """ hold a reader slot of the device containing the path """
+        with self._semaphore(self.device_of(path)):
+            yield
+
+    def summary(self):
+        with self._lock:
+            devices = sorted(self._semaphores)
+        return 'Device readers: ' + ', '.join(
+            f'{os.major(dev)}:{os.minor(dev)} ({self.kinds.get(dev, "configured")}) '
+            f'{self.limit_of(dev)}'
+            for dev in devices
+        )
+
+# EOF
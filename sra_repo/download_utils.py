@@ -2,8 +2,12 @@
 A rudimentary URL downloader (like wget or curl) to demonstrate Rich progress bars.
 """
 
+import os
 import time
+import hashlib
+import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Queue, Empty
 from typing import Iterable, Callable, Any
 from urllib.parse import urlparse
 import pycurl
@@ -22,24 +26,200 @@ from rich.progress import (
 block_size = 128 * 1024
 fatal_error = False
 
-
 def get_protocol(url):
     parsed_url = urlparse(url)  # Parse the URL
     return parsed_url.scheme.lower()  # Extract the protocol (scheme)
 
 
+class CurlPool(object):
+    """ pool of curl handles keyed by host, so that connections (FTP logins, TLS
+        sessions) kept by each handle are reused across downloads to the same host;
+        with share=True, the DNS cache and TLS sessions are also shared among all
+        handles using CurlShare (the connection cache is not shared, as sharing it
+        among concurrent threads is not safe)
+    """
+
+    def __init__(self, max_idle_per_host=16, share=True):
+        self.max_idle_per_host = max_idle_per_host
+        self.share = None
+        if share:
+            self.share = pycurl.CurlShare()
+            self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+            self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        self._idle = {}
+        self._lock = threading.Lock()
+
+        # metrics
+        self.handles = 0
+        self.new_connections = 0
+        self.reused_transfers = 0
+        self.transfers = 0
+
+    def acquire(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if (handles := self._idle.get(host)):
+                c = handles.pop()
+                # reset options, but keep live connections and caches
+                c.reset()
+            else:
+                c = pycurl.Curl()
+                self.handles += 1
+                # the share is kept by reset()
+                if self.share is not None:
+                    c.setopt(pycurl.SHARE, self.share)
+        return c
+
+    def release(self, url, c):
+        host = urlparse(url).netloc
+        try:
+            connects = c.getinfo(pycurl.NUM_CONNECTS)
+        except pycurl.error:
+            connects = 0
+        with self._lock:
+            self.transfers += 1
+            self.new_connections += connects
+            if connects == 0:
+                self.reused_transfers += 1
+            handles = self._idle.setdefault(host, [])
+            if len(handles) < self.max_idle_per_host:
+                handles.append(c)
+                return
+        c.close()
+
+    def close(self):
+        with self._lock:
+            for handles in self._idle.values():
+                for c in handles:
+                    c.close()
+            self._idle = {}
+        if self.share is not None:
+            self.share.close()
+            self.share = None
+
+    def summary(self):
+        return (f"Connections: {self.new_connections} new, {self.reused_transfers} of "
+                f"{self.transfers} transfer(s) reused existing connection, "
+                f"{self.handles} curl handle(s)")
+
+
+def parse_host_limits(spec: str):
+    """ parse host limits in the form of HOST=N[,HOST=N...], with * as the host
+        for the default limit
+    """
+    host_limits = {}
+    for item in spec.replace(';', ',').split(','):
+        if not (item := item.strip()):
+            continue
+        host, sep, limit = item.rpartition('=')
+        if not sep or not host:
+            raise ValueError(f'invalid host limit: {item}')
+        host_limits[host.strip().lower()] = int(limit)
+    return host_limits
+
+
+class TransferLimiter(object):
+    """ per-host connection limits and global bandwidth limit shared by all transfers;
+        the bandwidth is enforced by a token bucket of bytes, in which the written
+        bytes are consumed and the transfers wait until the debt is paid
+    """
+
+    def __init__(self, host_limits: dict[str, int] | None = None, bandwidth: int | None = None):
+        self.host_limits = dict(host_limits or {})
+        self.default_limit = self.host_limits.pop('*', None)
+        self._slots = {}
+        self._cond = threading.Condition()
+
+        self.bandwidth = bandwidth
+        self._tokens = float(bandwidth or 0)
+        self._updated = time.monotonic()
+        self._bucket_lock = threading.Lock()
+
+    def limit_of(self, url):
+        host = (urlparse(url).hostname or '').lower()
+        return host, self.host_limits.get(host, self.default_limit)
+
+    def try_acquire(self, url):
+        """ take a connection slot for the host of url without blocking """
+        host, limit = self.limit_of(url)
+        with self._cond:
+            if limit is not None and self._slots.get(host, 0) >= limit:
+                return False
+            self._slots[host] = self._slots.get(host, 0) + 1
+            return True
+
+    def acquire(self, url):
+        host, limit = self.limit_of(url)
+        with self._cond:
+            while limit is not None and self._slots.get(host, 0) >= limit:
+                self._cond.wait()
+            self._slots[host] = self._slots.get(host, 0) + 1
+
+    def release(self, url):
+        host, _ = self.limit_of(url)
+        with self._cond:
+            self._slots[host] -= 1
+            self._cond.notify_all()
+
+    def consume(self, nbytes):
+        """ consume nbytes from the bucket, and return the number of seconds to wait """
+        if not self.bandwidth:
+            return 0
+        with self._bucket_lock:
+            now = time.monotonic()
+            self._tokens = min(self.bandwidth, self._tokens + (now - self._updated) * self.bandwidth)
+            self._updated = now
+            self._tokens -= nbytes
+            return max(0, -self._tokens / self.bandwidth)
+
+    def delay(self):
+        """ return the number of seconds to wait until the debt is paid """
+        return self.consume(0)
+
+    def summary(self):
+        limits = [f'{host}={limit}' for (host, limit) in self.host_limits.items()]
+        if self.default_limit is not None:
+            limits.append(f'*={self.default_limit}')
+        return (f"Host limits: {', '.join(limits) or 'none'}, bandwidth: "
+                + (f'{self.bandwidth} bytes/s' if self.bandwidth else 'unlimited'))
+
+
 class EasyCURL(object):
 
-    def __init__(self, progress, proxy=None):
+    def __init__(self, progress, proxy=None, *, size=None, segments=1, pool=None,
+                 limiter=None, blocking_throttle=True, transport=None):
         self.proxy = proxy
+        self.pool = pool
+
+        # measure throughput, detect stalled transfers and switch endpoints
+        self.transport = transport
+
+        # with blocking_throttle=False (eg. in CurlMulti event loop), the caller is
+        # responsible for waiting for the bandwidth limit
+        self.limiter = limiter
+        self.blocking_throttle = blocking_throttle
+        self.url = None
         self.curl = None
         self.resume_from = 0
         self.downloaded = -1
         self.total_size = 0
         self.console = None
         self.taskid = None
+        self.task_id = None
         self.progress = progress
 
+        # incremental MD5 hash of the data written to the target file
+        self.hasher = None
+        self.hashed = 0
+        self.md5sum = None
+        self.dest_file = None
+
+        # segmented download, only used when the size of the file is known
+        self.size = size
+        self.segments = segments
+        self.segments_done = None
+        self.segments_lock = threading.Lock()
+
     def _progress_monitor(self, download_t, download_d, upload_t, upload_d):
         # download_t = total for this session (after resume)
         # download_d = current downloaded for this session
@@ -55,6 +235,37 @@ class EasyCURL(object):
             if self.downloaded == self.total_size:
                 self.progress.update(self.task_id, visible=False)
 
+    def _write(self, data):
+        self.dest_file.write(data)
+        self.hasher.update(data)
+        self.hashed += len(data)
+        self._throttle(len(data))
+
+    def _throttle(self, nbytes):
+        if self.limiter and (wait := self.limiter.consume(nbytes)) > 0 and self.blocking_throttle:
+            time.sleep(wait)
+
+    def _prepare_hasher(self, target_path, offset):
+        """ prepare the hasher to continue from offset, only re-hashing the existing
+            part of the file if the hasher has not seen all of it
+        """
+
+        if offset > 0 and self.hasher is not None and self.hashed == offset:
+            return
+
+        self.hasher = hashlib.md5()
+        self.hashed = 0
+        if offset == 0:
+            return
+
+        with open(target_path, 'rb') as f:
+            while self.hashed < offset:
+                data = f.read(min(block_size * 64, offset - self.hashed))
+                if not data:
+                    break
+                self.hasher.update(data)
+                self.hashed += len(data)
+
     def download(
         self,
         url,
@@ -64,6 +275,8 @@ class EasyCURL(object):
         before_started=False,
         after_finished=False,
         tries=3,
+        after_failed=None,
+        with_md5sum=False,
     ):
         global fatal_error
 
@@ -87,7 +300,10 @@ class EasyCURL(object):
 
             try:
                 tries -= 1
-                completed = self._download(url, target_path, resume)
+                if self.segments > 1 and self.size:
+                    completed = self._download_segmented(url, target_path, resume)
+                else:
+                    completed = self._download(url, target_path, resume)
 
             # handling error
             except pycurl.error as err:
@@ -100,6 +316,14 @@ class EasyCURL(object):
                     f"ERROR downloading {url}!. Error is {type(err)} with msg: {str(err)} "
                     + (f"Aborting..." if tries <= 0 else f"Retrying [{tries} more]...")
                 )
+                if self.transport and tries > 0:
+                    if eno == pycurl.E_OPERATION_TIMEDOUT:
+                        self.transport.record_stall(url)
+                    if (alternate := self.transport.alternate(url, target_path)):
+                        # the content is identical, hence continue from current position
+                        _c(f"Switching from {url} to {alternate}")
+                        url = alternate
+                        resume = True
 
             except OSError as err:
                 # catch OS errors
@@ -122,14 +346,21 @@ class EasyCURL(object):
                     self.task_id = None
 
             # the following will be executed only if download process completed successfully
-            if completed and after_finished:
-                after_finished(url, target_path)
+            if completed:
+                if after_finished:
+                    if with_md5sum:
+                        after_finished(url, target_path, md5sum=self.md5sum)
+                    else:
+                        after_finished(url, target_path)
                 break
 
             if tries > 0:
                 _c(f"sleeping for 5 seconds before retrying {url}")
                 time.sleep(5)
 
+        if not completed and after_failed:
+            after_failed(url, target_path)
+
     def _download(
         self,
         url,
@@ -141,62 +372,265 @@ class EasyCURL(object):
 
         while self.downloaded < self.total_size:
 
-            # reset counter
-            self.downloaded = -1
-            self.total_size = 0
+            if self.limiter:
+                self.limiter.acquire(url)
 
-            # check if file is already exists:
-            mode = "wb"
-            if resume:
-                if target_path.is_file():
-                    self.resume_from = target_path.stat().st_size
-                    _c(f"Started at: {self.resume_from}")
-                    mode = "ab"
+            try:
+                c = self._prepare(url, target_path, resume)
 
-            # set resume for persistent download
-            resume = True
+                # set resume for persistent download
+                resume = True
 
-            with open(target_path, mode) as dest_file:
+                # perform download
+                _c(f"Connecting to {url}...")
+                c.perform()
+            finally:
+                self._close()
+                if self.limiter:
+                    self.limiter.release(url)
 
-                self.curl = c = pycurl.Curl()
-                c.setopt(c.URL, url)
+        return self._check_completed(url, target_path)
 
-                if get_protocol(url) == "ftp":
-                    c.setopt(c.FTP_USE_EPSV, 0)  # Disable passive mode, use active mode
+    def _prepare(self, url, target_path, resume=False):
+        """ open the target file and return a curl handle ready to perform the download,
+            used by both _download() and the CurlMulti engine
+        """
 
-                if self.resume_from > 0:
-                    c.setopt(c.RESUME_FROM, self.resume_from)
-                c.setopt(c.WRITEDATA, dest_file)
+        _c = self.progress.console.log
 
-                # display progress
-                c.setopt(c.NOPROGRESS, False)
-                c.setopt(c.XFERINFOFUNCTION, self._progress_monitor)
+        # reset counter
+        self.downloaded = -1
+        self.total_size = 0
 
-                # perform download
-                _c(f"Connecting to {url}...")
-                c.perform()
-                c.close()
+        # check if file is already exists:
+        mode = "wb"
+        self.resume_from = 0
+        if resume:
+            if target_path.is_file():
+                self.resume_from = target_path.stat().st_size
+                _c(f"Started at: {self.resume_from}")
+                mode = "ab"
+
+        self._prepare_hasher(target_path, self.resume_from)
+        self.dest_file = open(target_path, mode)
+
+        self.url = url
+        self.curl = c = self.pool.acquire(url) if self.pool else pycurl.Curl()
+        c.setopt(c.URL, url)
+
+        if get_protocol(url) == "ftp":
+            c.setopt(c.FTP_USE_EPSV, 0)  # Disable passive mode, use active mode
+
+        self._set_stall_detection(c)
+
+        if self.resume_from > 0:
+            c.setopt(c.RESUME_FROM, self.resume_from)
+
+        # write through the hasher, so that MD5 hash is available when finished
+        c.setopt(c.BUFFERSIZE, block_size)
+        c.setopt(c.WRITEFUNCTION, self._write)
+
+        # display progress
+        c.setopt(c.NOPROGRESS, False)
+        c.setopt(c.XFERINFOFUNCTION, self._progress_monitor)
+
+        return c
+
+    def _set_stall_detection(self, c):
+        if self.transport:
+            c.setopt(c.LOW_SPEED_LIMIT, self.transport.low_speed_limit)
+            c.setopt(c.LOW_SPEED_TIME, self.transport.low_speed_time)
+
+    def _record_throughput(self, url, c):
+        if self.transport:
+            try:
+                self.transport.record(url, c.getinfo(pycurl.SIZE_DOWNLOAD),
+                                      c.getinfo(pycurl.TOTAL_TIME))
+            except pycurl.error:
+                pass
+
+    def _close(self):
+        if self.dest_file is not None:
+            self.dest_file.close()
+            self.dest_file = None
+        if self.curl is not None:
+            self._record_throughput(self.url, self.curl)
+            if self.pool:
+                self.pool.release(self.url, self.curl)
+            else:
+                self.curl.close()
+            self.curl = None
+
+    def _check_completed(self, url, target_path):
+
+        _c = self.progress.console.log
 
         _c(f"Downloaded: {self.downloaded} out of: {self.total_size} for {url}")
         if self.total_size == 0:
             return False
+
+        # only use the MD5 hash if the hasher has seen the whole file
+        if self.hashed == target_path.stat().st_size:
+            self.md5sum = self.hasher.hexdigest()
         return True
 
+    def _download_segmented(
+        self,
+        url,
+        target_path,
+        resume=False,
+    ):
+        """ download a file of known size using several connections, each fetching a
+            byte range and writing directly to its position in the preallocated target
+            file, so that no stitching is needed; each segment is retried and resumed
+            independently, and when retried, only unfinished segments are fetched
+        """
+
+        _c = self.progress.console.log
+
+        # the MD5 hash can not be computed on the fly since the segments are written
+        # out of order
+        self.md5sum = None
+
+        size = self.size
+        segment_size = -(-size // self.segments)
+        ranges = [(start, min(start + segment_size, size) - 1)
+                  for start in range(0, size, segment_size)]
+
+        if (not resume or self.segments_done is None or len(self.segments_done) != len(ranges)
+                or not target_path.is_file() or target_path.stat().st_size != size):
+            self.segments_done = [0] * len(ranges)
+            with open(target_path, 'wb') as f:
+                try:
+                    os.posix_fallocate(f.fileno(), 0, size)
+                except AttributeError:
+                    f.truncate(size)
+                except OSError as err:
+                    # only fall back to a sparse file if preallocation is not supported,
+                    # other errors (eg. ENOSPC) are raised
+                    if err.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                        raise
+                    f.truncate(size)
+        else:
+            _c(f"Resuming {sum(self.segments_done)} of {size} bytes for {url}")
+
+        if self.task_id is not None:
+            self.progress.start_task(self.task_id)
+            self.progress.update(self.task_id, total=size, completed=sum(self.segments_done))
+
+        range_unsupported = threading.Event()
+
+        # a failed write to the target file (eg. ENOSPC) stops all segments
+        write_errors = []
+
+        def fetch_segment(fd, idx, tries=3):
+            start, end = ranges[idx]
+            length = end - start + 1
+            is_http = get_protocol(url) in ("http", "https")
+
+            # status of the last HTTP response, as there can be several responses
+            # (eg. redirects) in a single transfer
+            status = [None]
+
+            def header(line):
+                if line.startswith(b"HTTP/"):
+                    try:
+                        status[0] = int(line.split()[1])
+                    except (IndexError, ValueError):
+                        status[0] = None
+
+            def write(data):
+                if is_http and status[0] != 206:
+                    # only partial content of the requested range can be written
+                    if status[0] == 200:
+                        # server ignores the range request and sends the whole file
+                        range_unsupported.set()
+                    return 0
+                with self.segments_lock:
+                    if write_errors:
+                        return 0
+                    done = self.segments_done[idx]
+                    if done + len(data) > length:
+                        # server ignores the range request and sends the whole file
+                        range_unsupported.set()
+                        return 0
+                    try:
+                        os.pwrite(fd, data, start + done)
+                    except OSError as err:
+                        write_errors.append(err)
+                        return 0
+                    self.segments_done[idx] = done + len(data)
+                self._throttle(len(data))
+
+            while (self.segments_done[idx] < length and tries > 0 and not fatal_error
+                    and not write_errors):
+                tries -= 1
+                if self.limiter:
+                    self.limiter.acquire(url)
+                c = self.pool.acquire(url) if self.pool else pycurl.Curl()
+                try:
+                    c.setopt(c.URL, url)
+                    if get_protocol(url) == "ftp":
+                        c.setopt(c.FTP_USE_EPSV, 0)
+                    c.setopt(c.RANGE, f"{start + self.segments_done[idx]}-{end}")
+                    c.setopt(c.BUFFERSIZE, block_size)
+                    c.setopt(c.FAILONERROR, 1)
+                    c.setopt(c.HEADERFUNCTION, header)
+                    c.setopt(c.WRITEFUNCTION, write)
+                    self._set_stall_detection(c)
+                    status[0] = None
+                    c.perform()
+                    if is_http and status[0] == 200:
+                        range_unsupported.set()
+                        return
+                except pycurl.error as err:
+                    if range_unsupported.is_set() or write_errors:
+                        return
+                    _c(f"ERROR downloading segment {idx + 1}/{len(ranges)} of {url}: {err} "
+                       + (f"Retrying [{tries} more]..." if tries > 0 else ""))
+                    time.sleep(2)
+                finally:
+                    self._record_throughput(url, c)
+                    if self.pool:
+                        self.pool.release(url, c)
+                    else:
+                        c.close()
+                    if self.limiter:
+                        self.limiter.release(url)
+                if self.task_id is not None:
+                    self.progress.update(self.task_id, completed=sum(self.segments_done))
+
+        _c(f"Connecting to {url} with {len(ranges)} segments...")
+        with open(target_path, 'r+b') as f:
+            with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+                futures = [pool.submit(fetch_segment, f.fileno(), idx)
+                           for idx in range(len(ranges))
+                           if self.segments_done[idx] < ranges[idx][1] - ranges[idx][0] + 1]
+                for future in as_completed(futures):
+                    future.result()
+
+        if write_errors:
+            # handled as fatal error by download(), as with single connection
+            raise pycurl.error(pycurl.E_WRITE_ERROR, f"cannot write to {target_path}: "
+                               f"{write_errors[0]}")
+
+        if range_unsupported.is_set():
+            _c(f"Range request is not supported for {url}, using single connection")
+            self.segments = 1
+            return self._download(url, target_path, False)
+
+        downloaded = sum(self.segments_done)
+        _c(f"Downloaded: {downloaded} out of: {size} for {url}")
+        if downloaded != size:
+            raise ValueError(f"incomplete segmented download: {downloaded} out of {size} bytes")
+
+        if self.task_id is not None:
+            self.progress.update(self.task_id, visible=False)
+        return True
 
-def download(
-    url_dest_paths: Iterable[tuple[str, str]],
-    total: int | Callable = -1,
-    ntasks: int = 4,
-    before_started: Callable[[str, Any, Any], None] | None = None,
-    after_finished: Callable[[str, Any, Any], None] | None = None,
-    console: Any = None,
-):
-    """Download multiple urls to the given destination paths (including filenames),
-    and for each finished download, execute after_finsihed function.
-    """
-    global fatal_error
 
-    progress = Progress(
+def new_progress(console=None):
+    return Progress(
         TextColumn("[bold blue]{task.fields[filename]}", justify="right"),
         BarColumn(bar_width=None),
         "[progress.percentage]{task.percentage:>3.1f}%",
@@ -210,59 +644,371 @@ def download(
         refresh_per_second=2,
     )
 
-    _c = progress.console.log
 
-    if ntasks == 1:
-        with progress:
-            for idx, (url, dest_path) in enumerate(url_dest_paths, 1):
-                if fatal_error:
-                    break
+def download(
+    url_dest_paths: Iterable[tuple[str, str]],
+    total: int | Callable = -1,
+    ntasks: int = 4,
+    before_started: Callable[[str, Any, Any], None] | None = None,
+    after_finished: Callable[[str, Any, Any], None] | None = None,
+    console: Any = None,
+    segments: int = 1,
+    segment_threshold: int = 1024 ** 3,
+    size_of: Callable[[str, Any], int | None] | None = None,
+    resume_of: Callable[[str, Any], bool] | None = None,
+    after_failed: Callable[[str, Any], None] | None = None,
+    limiter: TransferLimiter | None = None,
+    transport: Any = None,
+    with_md5sum: bool = False,
+):
+    """Download multiple urls to the given destination paths (including filenames),
+    and for each finished download, execute after_finsihed function with the url and
+    the path, or after_failed function if the download can not be completed.
+    With with_md5sum=True, after_finished is also given md5sum keyword argument of the
+    MD5 hash computed while downloading (None if not available, eg. for segmented
+    downloads).
+    Files with known size (from size_of function) of at least segment_threshold are
+    downloaded with segments number of parallel connections.
+    Existing partial files are resumed if resume_of function returns True.
+    Connections per host and total bandwidth are limited by limiter.
+    With transport (TransportSelector), stalled transfers are switched to alternative
+    urls of the files.
+    """
+    global fatal_error
 
-                actual_total = total() if callable(total) else total
+    # curl handles and connections are reused across all downloads
+    pool = CurlPool()
 
-                ec = EasyCURL(progress=progress)
-                ec.download(
-                    url,
-                    dest_path,
-                    False,
-                    f"[{idx}/{actual_total}] {dest_path.name}",
-                    before_started,
-                    after_finished,
-                )
+    def new_curl(url, dest_path, resume=False):
+        size = size_of(url, dest_path) if size_of else None
+        # the state of the segments is not kept across runs, hence partial files
+        # are resumed with a single connection
+        if segments > 1 and size and size >= segment_threshold and not resume:
+            return EasyCURL(progress=progress, size=size, segments=segments, pool=pool,
+                            limiter=limiter, transport=transport)
+        return EasyCURL(progress=progress, pool=pool, limiter=limiter, transport=transport)
 
-        _c("All files has been downloaded")
-        return
+    progress = new_progress(console)
 
-    with progress:
-        with ThreadPoolExecutor(max_workers=ntasks) as pool:
-            futures = []
-            for idx, (url, dest_path) in enumerate(url_dest_paths, 1):
-                if fatal_error:
-                    break
+    _c = progress.console.log
+    if limiter:
+        _c(limiter.summary())
+
+    if ntasks == 1:
+        try:
+            with progress:
+                for idx, (url, dest_path) in enumerate(url_dest_paths, 1):
+                    if fatal_error:
+                        break
 
-                def label(idx=idx, total=total, filename=dest_path.name):
-                    return f"[{idx}/{total() if callable(total) else total}] {filename}"
+                    actual_total = total() if callable(total) else total
 
-                ec = EasyCURL(progress=progress)
-                futures.append(
-                    pool.submit(
-                        ec.download,
+                    resume = resume_of(url, dest_path) if resume_of else False
+                    ec = new_curl(url, dest_path, resume)
+                    ec.download(
                         url,
                         dest_path,
-                        False,
-                        label,
+                        resume,
+                        f"[{idx}/{actual_total}] {dest_path.name}",
                         before_started,
                         after_finished,
+                        after_failed=after_failed,
+                        with_md5sum=with_md5sum,
                     )
-                )
-                time.sleep(1)
+
+            _c("All files has been downloaded")
+            _c(pool.summary())
+            if transport:
+                _c(transport.summary())
+        finally:
+            pool.close()
+        return
+
+    try:
+        with progress:
+            with ThreadPoolExecutor(max_workers=ntasks) as executor:
+                futures = []
+                for idx, (url, dest_path) in enumerate(url_dest_paths, 1):
+                    if fatal_error:
+                        break
+
+                    def label(idx=idx, total=total, filename=dest_path.name):
+                        return f"[{idx}/{total() if callable(total) else total}] {filename}"
+
+                    resume = resume_of(url, dest_path) if resume_of else False
+                    ec = new_curl(url, dest_path, resume)
+                    futures.append(
+                        executor.submit(
+                            ec.download,
+                            url,
+                            dest_path,
+                            resume,
+                            label,
+                            before_started,
+                            after_finished,
+                            after_failed=after_failed,
+                            with_md5sum=with_md5sum,
+                        )
+                    )
+                    time.sleep(1)
+
+                # catch all exceptions here
+                for future in as_completed(futures):
+                    # get the result
+                    future.result()
+
+            _c("All files has been processed.")
+            _c(pool.summary())
+            if transport:
+                _c(transport.summary())
+    finally:
+        pool.close()
+
+
+class _Transfer(object):
+    """ state of a single transfer in the CurlMulti engine """
+
+    def __init__(self, ec, url, dest_path, label, tries):
+        self.ec = ec
+        self.url = url
+        self.dest_path = dest_path
+        self.label = label
+        self.tries = tries
+        self.resume = False
+        self.has_slot = False
+
+
+def download_multi(
+    url_dest_paths: Iterable[tuple[str, str]],
+    total: int | Callable = -1,
+    max_transfers: int = 100,
+    before_started: Callable[[str, Any, Any], None] | None = None,
+    after_finished: Callable[[str, Any, Any], None] | None = None,
+    console: Any = None,
+    callback_tasks: int = 4,
+    tries: int = 3,
+    resume_of: Callable[[str, Any], bool] | None = None,
+    after_failed: Callable[[str, Any], None] | None = None,
+    limiter: TransferLimiter | None = None,
+    transport: Any = None,
+    with_md5sum: bool = False,
+):
+    """Download multiple urls to the given destination paths (including filenames)
+    using a single pycurl.CurlMulti event loop for up to max_transfers concurrent
+    transfers, instead of a thread per transfer.
+    before_started is called from the event loop, while after_finished is executed
+    in a pool of callback_tasks threads so that post-download processing does not
+    stall the transfers; with with_md5sum=True, after_finished is also given md5sum
+    keyword argument as in download().
+    Existing partial files are resumed if resume_of function returns True.
+    Transfers to a host that has reached its limit wait until a connection slot is
+    available, and the event loop waits whenever the bandwidth limit is exceeded.
+    With transport (TransportSelector), stalled transfers are switched to alternative
+    urls of the files.
+    """
+    global fatal_error
+
+    progress = new_progress(console)
+    _c = progress.console.log
+    if limiter:
+        _c(limiter.summary())
+
+    # url_dest_paths may block (eg. iterating over a queue), hence feed them
+    # to the event loop from a separate thread
+    incoming = Queue()
+
+    def feed():
+        try:
+            for url_dest_path in url_dest_paths:
+                incoming.put(url_dest_path)
+        finally:
+            incoming.put(None)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    # the multi handle has its own connection cache, hence the pool only
+    # reuses the curl handles
+    multi = pycurl.CurlMulti()
+    pool = CurlPool(share=False)
+    active = {}
+    retries = []
+    futures = []
+
+    # transfers waiting for a connection slot of their host
+    waiting = []
+
+    def label_of(idx, filename):
+        return f"[{idx}/{total() if callable(total) else total}] {filename}"
+
+    def remove_task(tr):
+        if tr.ec.task_id is not None:
+            progress.remove_task(tr.ec.task_id)
+            tr.ec.task_id = None
+
+    def release_slot(tr):
+        if tr.has_slot:
+            limiter.release(tr.url)
+            tr.has_slot = False
+
+    def start(tr):
+        global fatal_error
+        if limiter and not tr.has_slot:
+            if not limiter.try_acquire(tr.url):
+                waiting.append(tr)
+                return
+            tr.has_slot = True
+        tr.ec.task_id = progress.add_task("download", filename=tr.label, start=False)
+        progress.update(tr.ec.task_id, total=0)
+        if before_started:
+            before_started(tr.url, tr.dest_path)
+        try:
+            c = tr.ec._prepare(tr.url, tr.dest_path, tr.resume)
+        except OSError as err:
+            tr.ec._close()
+            remove_task(tr)
+            if err.errno == errno.ENOSPC:
+                fatal_error = True
+                _c("FATAL ERROR: not enough disk space. Aborting...")
+                return
+            failed(tr, str(err))
+            return
+        _c(f"Connecting to {tr.url}...")
+        multi.add_handle(c)
+        active[c] = tr
+
+    def failed(tr, msg, eno=None):
+        release_slot(tr)
+        tr.tries -= 1
+        _c(
+            f"ERROR downloading {tr.url}!. Error msg: {msg} "
+            + ("Aborting..." if tr.tries <= 0 else f"Retrying [{tr.tries} more]...")
+        )
+        if tr.tries > 0:
+            tr.resume = True
+            if transport:
+                if eno == pycurl.E_OPERATION_TIMEDOUT:
+                    transport.record_stall(tr.url)
+                if (alternate := transport.alternate(tr.url, tr.dest_path)):
+                    _c(f"Switching from {tr.url} to {alternate}")
+                    tr.url = alternate
+            retries.append((time.monotonic() + 5, tr))
+        elif after_failed:
+            futures.append(callbacks.submit(after_failed, tr.url, tr.dest_path))
+
+    def finished(tr):
+        ec = tr.ec
+        remove_task(tr)
+        if 0 <= ec.downloaded < ec.total_size:
+            # short transfer, retried from the current position as a failed attempt,
+            # so that a server closing connections early is not reconnected endlessly
+            failed(tr, "short transfer")
+            return
+        release_slot(tr)
+        if not ec._check_completed(tr.url, tr.dest_path):
+            failed(tr, "no data received")
+            return
+        if after_finished:
+            kwargs = dict(md5sum=ec.md5sum) if with_md5sum else {}
+            futures.append(callbacks.submit(after_finished, tr.url, tr.dest_path, **kwargs))
+
+    counter = 0
+    exhausted = False
+
+    try:
+        with progress, ThreadPoolExecutor(max_workers=callback_tasks) as callbacks:
+
+            while not fatal_error:
+
+                # restart failed transfers whose retry delay has passed
+                now = time.monotonic()
+                for item in [item for item in retries if item[0] <= now]:
+                    if len(active) >= max_transfers:
+                        break
+                    retries.remove(item)
+                    start(item[1])
+
+                # start waiting transfers whose hosts have available slots
+                for tr in list(waiting):
+                    if len(active) >= max_transfers:
+                        break
+                    waiting.remove(tr)
+                    start(tr)
+
+                # add new transfers, without reading too far ahead when transfers are
+                # waiting for their hosts
+                while (len(active) < max_transfers and len(waiting) < max_transfers
+                        and not exhausted and not fatal_error):
+                    try:
+                        url_dest_path = incoming.get_nowait()
+                    except Empty:
+                        break
+                    if url_dest_path is None:
+                        exhausted = True
+                        break
+                    counter += 1
+                    url, dest_path = url_dest_path
+                    ec = EasyCURL(progress=progress, pool=pool, limiter=limiter,
+                                  blocking_throttle=False, transport=transport)
+                    tr = _Transfer(ec, url, dest_path, label_of(counter, dest_path.name), tries)
+                    tr.resume = resume_of(url, dest_path) if resume_of else False
+                    start(tr)
+
+                if not active:
+                    if exhausted and not retries and not waiting:
+                        break
+                    time.sleep(0.1)
+                    continue
+
+                # the write callbacks only consume the bandwidth, hence wait here
+                if limiter and (wait := limiter.delay()) > 0:
+                    time.sleep(min(wait, 1.0))
+
+                while True:
+                    ret, _ = multi.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+
+                while True:
+                    num_q, ok_list, err_list = multi.info_read()
+                    for c in ok_list:
+                        multi.remove_handle(c)
+                        tr = active.pop(c)
+                        tr.ec._close()
+                        finished(tr)
+                    for (c, eno, msg) in err_list:
+                        multi.remove_handle(c)
+                        tr = active.pop(c)
+                        tr.ec._close()
+                        remove_task(tr)
+                        if eno == pycurl.E_WRITE_ERROR:
+                            fatal_error = True
+                            _c("FATAL ERROR: cannot write to disk. Aborting...")
+                            break
+                        failed(tr, msg, eno)
+                    if num_q == 0:
+                        break
+
+                multi.select(1.0)
+
+            # clean up remaining transfers when aborted
+            for (c, tr) in active.items():
+                multi.remove_handle(c)
+                tr.ec._close()
+                remove_task(tr)
+                release_slot(tr)
+            multi.close()
 
             # catch all exceptions here
             for future in as_completed(futures):
-                # get the result
                 future.result()
+    finally:
+        pool.close()
 
-        _c("All files has been processed.")
+    _c("All files has been processed.")
+    _c(pool.summary())
+    if transport:
+        _c(transport.summary())
 
 
 # EOF
@@ -1,52 +1,105 @@
 
-import requests
+import os
+import json
 import pathlib
-import subprocess
-import time
 
+from sra_repo import http_utils
 from sra_repo.utils import md5sum_file
 from sra_repo.filestore import SRA_Info
+from sra_repo.metadata_cache import get_cache
+from sra_repo.executor import Resources, get_executor
+
+
+ena_portal_url = os.environ.get('SRA_REPO_ENA_PORTAL_URL', 'https://www.ebi.ac.uk/ena/portal/api')
+
+ena_fields = ('study_accession,sample_accession,experiment_accession,run_accession,'
+              'tax_id,scientific_name,library_name,'
+              'fastq_ftp,submitted_ftp,read_count,base_count,fastq_md5,fastq_bytes')
 
 
 def get_ena_filereport(
     sra_id: str,
-    query: str = 'study_accession,sample_accession,experiment_accession,run_accession,'
-                 'tax_id,scientific_name,library_name,'
-                 'fastq_ftp,submitted_ftp,read_count,base_count,fastq_md5,fastq_bytes'
+    query: str = ena_fields,
 ):
 
+    # only responses with the default fields are cached
+    cache = get_cache() if query == ena_fields else None
+    if cache:
+        if (content := cache.get('ena/read_run', sra_id)) is not None:
+            return json.loads(content)
+        cache.ensure_online('ena/read_run', sra_id)
+
     payload = dict(result='read_run',
                    fields=query,
                    format='JSON',
                    accession=sra_id,
                    )
 
-    status_code = -1
-    tries = 0
-
-    while status_code != 200 and tries < 5:
-        r = requests.get('https://www.ebi.ac.uk/ena/portal/api/filereport',
-                         params=payload)
-
-        status_code = r.status_code
+    r = http_utils.request('ena', 'GET', f'{ena_portal_url}/filereport', params=payload)
 
-        if status_code == 429:
-            time.sleep(5)
-            tries += 1
-            continue
-
-        if status_code != 200:
-            raise ValueError(f'SRA accession not found: {sra_id} with HTTP Error {r.status_code} '
-                             f'and error message of: {r.content}')
+    if r.status_code != 200:
+        raise ValueError(f'SRA accession not found: {sra_id} with HTTP Error {r.status_code} '
+                         f'and error message of: {r.content}')
 
     result_resp = r.json()
 
     if not any(result_resp):
         raise ValueError(f'SRA accession probably suppresed or not existed: {sra_id}')
 
+    if cache:
+        cache.put('ena/read_run', sra_id, r.content)
+
     return result_resp
 
 
+def get_ena_filereports(
+    sra_ids: list[str],
+    query: str = ena_fields,
+    chunk_size: int = 500,
+):
+    """ return a dictionary of run accession to its report for all SRA IDs, by POST-ing
+        chunks of SRA IDs to ENA portal search endpoint; SRA IDs not found in ENA
+        will not be in the dictionary
+    """
+
+    reports = {}
+
+    # use cached reports, in the same format as the response of get_ena_filereport()
+    cache = get_cache() if query == ena_fields else None
+    if cache:
+        for sra_id in sra_ids:
+            if (content := cache.get('ena/read_run', sra_id)) is not None:
+                reports[sra_id] = json.loads(content)[0]
+        sra_ids = [sra_id for sra_id in sra_ids if sra_id not in reports]
+        if any(sra_ids):
+            cache.ensure_online('ena/read_run', sra_ids[0])
+
+    for idx in range(0, len(sra_ids), chunk_size):
+        chunk = sra_ids[idx:idx + chunk_size]
+
+        payload = dict(result='read_run',
+                       fields=query,
+                       format='json',
+                       includeAccessionType='run',
+                       includeAccessions=','.join(chunk),
+                       limit=0,
+                       )
+
+        r = http_utils.request('ena', 'POST', f'{ena_portal_url}/search', data=payload)
+
+        if r.status_code != 200:
+            raise ValueError(f'Error querying {len(chunk)} SRA accessions with HTTP Error '
+                             f'{r.status_code} and error message of: {r.content}')
+
+        # ENA returns empty content if none of the accessions is found
+        for resp in (r.json() if r.content.strip() else []):
+            reports[resp['run_accession']] = resp
+            if cache:
+                cache.put('ena/read_run', resp['run_accession'], json.dumps([resp]).encode())
+
+    return reports
+
+
 class ENA_Helper(object):
 
     label = 'EBI/ENA'
@@ -57,14 +110,35 @@ class ENA_Helper(object):
     def get_sra_info(self, sra_id):
         """ return urls, paths, total_read_count, total_base_count """
         resp = get_ena_filereport(sra_id)[0]
+        return self.info_from_report(sra_id, resp)
+
+    def get_sra_infos(self, sra_ids):
+        """ generate (sra_id, SRA_Info) for all SRA IDs using batched queries, with
+            ValueError instance instead of SRA_Info for SRA IDs that are not available
+        """
+
+        reports = get_ena_filereports(sra_ids)
+        for sra_id in sra_ids:
+            try:
+                if sra_id not in reports:
+                    raise ValueError(f'SRA accession probably suppresed or not existed: {sra_id}')
+                yield (sra_id, self.info_from_report(sra_id, reports[sra_id]))
+            except ValueError as exc:
+                yield (sra_id, exc)
+
+    @staticmethod
+    def info_from_report(sra_id, resp):
+        """ create SRA_Info from a single ENA report """
 
         for tag in ['fastq_ftp', 'submitted_ftp']:
             if tag in resp and (urls := resp[tag]):
-                urls = ['ftp://' + url for url in urls.split(';')]
+                # ENA serves the same files over both FTP and HTTPS
+                mirrors = [['ftp://' + url, 'https://' + url] for url in urls.split(';')]
+                urls = [m[0] for m in mirrors]
                 files = [pathlib.Path(url).name for url in urls]
                 break
         else:
-            urls, files = [], []
+            urls, files, mirrors = [], [], None
 
         # create dictionary
 
@@ -82,7 +156,8 @@ class ENA_Helper(object):
                           sample=resp['library_name'],
                           experiment_id=resp['experiment_accession'],
                           tax_id=resp['tax_id'],
-                          species=resp['scientific_name'])
+                          species=resp['scientific_name']),
+            mirrors=mirrors,
         )
 
         return sra_info
@@ -106,7 +181,8 @@ class ENA_Helper(object):
             # with EBI/ENA repository, we will have MD5sum hash to use
             for (source_path, source_md5sum) in zip(sra.paths, sra.md5sums):
                 if path == source_path:
-                    md5sum = md5sum_file(source_path)
+                    # use the MD5 hash computed during downloading if available
+                    md5sum = sra.digests.get(path) or md5sum_file(source_path)
                     if md5sum != source_md5sum:
                         _c(f'Corrupt file {path}')
                         sra.error += 1
@@ -127,9 +203,6 @@ class ENA_Helper(object):
                 sra.error += 1
                 raise
 
-            # change sra.pending to 1 to ensure that store() is executed after this call
-            sra.pending = 1
-
 
 def cram_to_fastq(localpath, destfiles):
 
@@ -141,10 +214,7 @@ def cram_to_fastq(localpath, destfiles):
             f"samtools fastq -1 {destfiles[0]} -2 {destfiles[1]} -0 /dev/null -s /dev/null -n")
 
     bash_cmds = ['bash', '-c', cmds]
-    run_cmds = ['srun'] + bash_cmds
-    if subprocess.call(
-        run_cmds, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-    ) != 0:
+    if get_executor().run(bash_cmds, resources=Resources(cpus=2)) != 0:
         raise ValueError('process did not finish properly')
 
     return destfiles
@@ -1,40 +1,128 @@
 
-import requests
+import os
 import pathlib
-import subprocess
-import time
 
 import xml.etree.ElementTree as ET
 
-from sra_repo.utils import md5sum_file
+from sra_repo import http_utils
 from sra_repo.filestore import SRA_Info
-from sra_repo.sra_validator import validate_read_base_counts
+from sra_repo.metadata_cache import get_cache
+from sra_repo.fastq_verifier import verify_files
+from sra_repo.sra_converter import stream_convert
+from sra_repo.executor import Resources, get_executor
+
+
+eutils_url = os.environ.get('SRA_REPO_EUTILS_URL', 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils')
 
 
 def get_xml_entry(acc_id):
 
+    cache = get_cache()
+    if cache:
+        if (content := cache.get('entrez/efetch', acc_id)) is not None:
+            return ET.fromstring(content)
+        cache.ensure_online('entrez/efetch', acc_id)
+
     payload = dict(db='sra',
                    id=acc_id,
                    )
+    if http_utils.ncbi_api_key:
+        payload['api_key'] = http_utils.ncbi_api_key
+
+    r = http_utils.request('ncbi', 'GET', f'{eutils_url}/efetch.fcgi', params=payload)
+
+    if r.status_code != 200:
+        raise ValueError(f'SRA accession not found: {acc_id} with HTTP Error {r.status_code} '
+                         f'and error message of: {r.content}')
+
+    root = ET.fromstring(r.content)
+    if cache and root.find('./EXPERIMENT_PACKAGE') is not None:
+        cache.put('entrez/efetch', acc_id, r.content)
+
+    return root
+
 
-    status_code = -1
-    tries = 0
+def _post_eutils(cgi, payload, stream=False):
 
-    while status_code != 200 and tries < 5:
-        r = requests.get('https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi',
-                         params=payload)
-        status_code = r.status_code
+    if http_utils.ncbi_api_key:
+        payload = dict(payload, api_key=http_utils.ncbi_api_key)
 
-        if status_code == 429:
-            time.sleep(5)
-            tries += 1
-            continue
+    r = http_utils.request('ncbi', 'POST', f'{eutils_url}/{cgi}', data=payload, stream=stream)
 
-        if status_code != 200:
-            raise ValueError(f'SRA accession not found: {acc_id} with HTTP Error {r.status_code} '
-                             f'and error message of: {r.content}')
+    if r.status_code != 200:
+        raise ValueError(f'Error querying {cgi} with HTTP Error {r.status_code} '
+                         f'and error message of: {r.content}')
 
-    return ET.fromstring(r.content)
+    return r
+
+
+def iter_xml_packages(acc_ids, chunk_size=200, use_history=False):
+    """ generate EXPERIMENT_PACKAGE elements for all accession IDs, fetching
+        chunk_size IDs per efetch request (either as comma-separated IDs or, with
+        use_history=True, via epost and WebEnv) and parsing the response incrementally;
+        each element is cleared after the consumer is done with it, hence the consumer
+        should not keep any reference to the element
+    """
+
+    # use cached entries, in the same format as the response of get_xml_entry()
+    cache = get_cache()
+    if cache:
+        uncached = []
+        for acc_id in acc_ids:
+            if (content := cache.get('entrez/efetch', acc_id)) is not None:
+                yield ET.fromstring(content).find('./EXPERIMENT_PACKAGE')
+            else:
+                uncached.append(acc_id)
+        acc_ids = uncached
+        if any(acc_ids):
+            cache.ensure_online('entrez/efetch', acc_ids[0])
+
+    for idx in range(0, len(acc_ids), chunk_size):
+        chunk = acc_ids[idx:idx + chunk_size]
+
+        if use_history:
+            r = _post_eutils('epost.fcgi', dict(db='sra', id=','.join(chunk)))
+            result = ET.fromstring(r.content)
+            payload = dict(db='sra',
+                           query_key=result.findtext('QueryKey'),
+                           WebEnv=result.findtext('WebEnv'),
+                           retmax=len(chunk),
+                           )
+        else:
+            payload = dict(db='sra',
+                           id=','.join(chunk),
+                           )
+
+        r = _post_eutils('efetch.fcgi', payload, stream=True)
+        r.raw.decode_content = True
+
+        try:
+            root = None
+            for event, elem in ET.iterparse(r.raw, events=('start', 'end')):
+                if root is None:
+                    root = elem
+                if event == 'end' and elem.tag == 'EXPERIMENT_PACKAGE':
+                    if cache:
+                        cache_package(cache, elem, chunk)
+                    yield elem
+                    # free all parsed packages
+                    root.clear()
+        except ET.ParseError as err:
+            raise ValueError(f'Error parsing efetch result: {err}')
+        finally:
+            r.close()
+
+
+def cache_package(cache, package, acc_ids):
+    """ cache the package for each of its runs requested in acc_ids """
+
+    content = None
+    for run in package.findall('./RUN_SET/RUN'):
+        if (acc_id := run.attrib.get('accession')) in acc_ids:
+            if content is None:
+                content = (b'<EXPERIMENT_PACKAGE_SET>' + ET.tostring(package)
+                           + b'</EXPERIMENT_PACKAGE_SET>')
+            cache.put('entrez/efetch', acc_id, content)
 
 
 class Entrez_Helper(object):
@@ -50,45 +138,84 @@ class Entrez_Helper(object):
 
         root = get_xml_entry(sra_id)
 
-        sras = root.findall('.//SRAFile')
+        package = root.find('./EXPERIMENT_PACKAGE')
+        if package is None:
+            raise ValueError(f'ENA accession probably suppresed: {sra_id}')
+
+        return self.info_from_package(sra_id, package)
+
+    def get_sra_infos(self, sra_ids):
+        """ generate (sra_id, SRA_Info) for all SRA IDs using batched efetch, with
+            ValueError instance instead of SRA_Info for SRA IDs that are not available
+        """
+
+        pending = set(sra_ids)
+        for package in iter_xml_packages(sra_ids):
+            for run in package.findall('./RUN_SET/RUN'):
+                sra_id = run.attrib.get('accession')
+                if sra_id not in pending:
+                    continue
+                pending.discard(sra_id)
+                try:
+                    yield (sra_id, self.info_from_package(sra_id, package))
+                except ValueError as exc:
+                    yield (sra_id, exc)
+
+        for sra_id in sra_ids:
+            if sra_id in pending:
+                pending.discard(sra_id)
+                yield (sra_id, ValueError(f'ENA accession probably suppresed: {sra_id}'))
+
+    @staticmethod
+    def info_from_package(sra_id, package):
+        """ create SRA_Info from EXPERIMENT_PACKAGE element for the SRA ID """
+
+        runs = [run for run in package.findall('./RUN_SET/RUN')
+                if run.attrib.get('accession') == sra_id]
+
+        if len(runs) != 1:
+            raise ValueError(
+                f'{sra_id} - runs is not single item!'
+            )
+
+        curr_run = runs[0]
 
-        if not any(sras):
+        sras = curr_run.findall('.//SRAFile')
+
+        if not sras:
             raise ValueError(f'ENA accession probably suppresed: {sra_id}')
 
         for el in sras:
             if el.attrib['cluster'] == 'public' and el.attrib['semantic_name'] == 'SRA Normalized':
                 urls = el.attrib['url']
+                size = el.attrib.get('size')
+                # other public locations of the same file, eg. cloud mirrors
+                alternatives = [alt.attrib['url'] for alt in el.findall('./Alternatives')
+                                if alt.attrib.get('access_type') == 'anonymous'
+                                and alt.attrib.get('url')]
                 break
         else:
             raise ValueError(f'SRA accession {sra_id} does not have public entry.')
 
         urls = urls.split(';')
+        # the size of .sra file is used for reserving disk space and segmented download
+        sizes = [int(size)] if size and len(urls) == 1 else None
+        mirrors = None
+        if len(urls) == 1:
+            mirrors = [urls + [url for url in alternatives if url not in urls]]
 
         paths = [pathlib.Path(url).name for url in urls]
         if paths[0] != sra_id:
             raise ValueError(f'SRA accession {sra_id} has {paths[0]} file.')
 
-        runs = root.findall('*//RUN')
-
-        if len(runs) != 1:
-            raise ValueError(
-                f'{sra_id} - runs is not single item!'
-            )
-
-        curr_run = runs[0]
-        if curr_run.attrib['accession'] != sra_id:
-            raise ValueError(
-                f'{sra_id} - accession is not identical with {curr_run.attrib["accession"]}'
-            )
-
         # prepare metadata
 
         # get sample name
-        sample_tree = root.find('./EXPERIMENT_PACKAGE/SAMPLE/TITLE')
+        sample_tree = package.find('./SAMPLE/TITLE')
         if sample_tree is None:
             # fine something else:
-            sample_tree = root.find(
-                './EXPERIMENT_PACKAGE/SAMPLE/IDENTIFIERS/SUBMITTER_ID[@label="Sample name"]'
+            sample_tree = package.find(
+                './SAMPLE/IDENTIFIERS/SUBMITTER_ID[@label="Sample name"]'
             )
             if sample_tree is None:
                 raise ValueError(f"Cannot find sample name for SRA {sra_id} from Entrez XML file.")
@@ -96,17 +223,17 @@ class Entrez_Helper(object):
         sample = sample_tree.text
 
         metadata = dict(
-            tax_id=root.find('./EXPERIMENT_PACKAGE/SAMPLE/SAMPLE_NAME/TAXON_ID').text,
-            species=root.find('./EXPERIMENT_PACKAGE/SAMPLE/SAMPLE_NAME/SCIENTIFIC_NAME').text,
-            study_id=root.find(
-                './EXPERIMENT_PACKAGE/STUDY/IDENTIFIERS/EXTERNAL_ID[@namespace="BioProject"]'
+            tax_id=package.find('./SAMPLE/SAMPLE_NAME/TAXON_ID').text,
+            species=package.find('./SAMPLE/SAMPLE_NAME/SCIENTIFIC_NAME').text,
+            study_id=package.find(
+                './STUDY/IDENTIFIERS/EXTERNAL_ID[@namespace="BioProject"]'
             ).text,
-            sample_id=root.find(
-                './EXPERIMENT_PACKAGE/SAMPLE/IDENTIFIERS/EXTERNAL_ID[@namespace="BioSample"]'
+            sample_id=package.find(
+                './SAMPLE/IDENTIFIERS/EXTERNAL_ID[@namespace="BioSample"]'
             ).text,
             sample=sample,
-            experiment_id=root.find(
-                './EXPERIMENT_PACKAGE/EXPERIMENT/IDENTIFIERS/PRIMARY_ID'
+            experiment_id=package.find(
+                './EXPERIMENT/IDENTIFIERS/PRIMARY_ID'
             ).text,
         )
 
@@ -119,8 +246,9 @@ class Entrez_Helper(object):
             read_count=int(curr_run.attrib['total_spots']),
             base_count=int(curr_run.attrib['total_bases']),
             md5sums=None,
-            sizes=None,
+            sizes=sizes,
             metadata=metadata,
+            mirrors=mirrors,
         )
 
         return sra_info
@@ -131,50 +259,80 @@ class Entrez_Helper(object):
 
         _c(f'Processing {path}...')
 
-        # run fasterq-dump
-        _c(f'Converting {path} to fastq files...')
         temp_dir = path.parent.as_posix()
+        collect_stats = getattr(self.parent, 'collect_stats', False)
+
+        if getattr(self.parent, 'stream_convert', False):
+            # convert, compress and validate in a single stream
+            _c(f'Converting {path} to compressed fastq files...')
+            sra.paths = [pathlib.Path(f'{path}_1.fastq.gz'), pathlib.Path(f'{path}_2.fastq.gz')]
+            try:
+                report = stream_convert(path, sra.paths, tmpdir=temp_dir,
+                                        collect_stats=collect_stats,
+                                        log=_c if self.showcmds else None)
+            except (ValueError, OSError) as err:
+                _c(f'ERR during converting SRA {sra.acc_id}: {err}')
+                sra.error += 1
+                return
+
+        else:
+            if not self.convert_to_fastq(path, sra):
+                return
+
+            # verify gzip integrity, read and base counts and calculate MD5 hashes
+            # in a single pass
+            _c(f'Validating read and base counts and calculating MD5 hashes for {sra.acc_id}')
+            report = verify_files(sra.paths, collect_stats=collect_stats)
+
+        try:
+            report.check(sra.read_count, sra.base_count)
+        except ValueError as err:
+            _c(f'ERR during validation of read and base count for SRA {sra.acc_id}: {err}')
+            sra.error += 1
+            return
+
+        sra.info.files = [p.name for p in sra.paths]
+        sra.info.md5sums = sra.md5sums = report.md5sums
+        sra.info.sizes = report.sizes
+        sra.info.stats = report.merged_stats()
+
+        path.unlink()
+        _c(f'Removed {path}')
+
+    def convert_to_fastq(self, path, sra):
+        """ convert with fasterq-dump and compress the fastq files, return True if
+            successful
+        """
+
+        _c = self.parent.console.log
+
+        temp_dir = path.parent.as_posix()
+
+        # run fasterq-dump, which uses 6 threads by default
+        _c(f'Converting {path} to fastq files...')
+        executor = get_executor()
         cmds = ['fasterq-dump', '-O', temp_dir, '-t', temp_dir, path.as_posix()]
-        run_cmds = ['srun'] + cmds
+        resources = Resources(cpus=6)
         if self.showcmds:
-            _c('Running: ' + ' '.join(run_cmds))
-        if subprocess.call(
-            run_cmds, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-        ) != 0:
+            _c('Running: ' + executor.describe(cmds, resources))
+        if executor.run(cmds, resources=resources) != 0:
             _c(f'ERR during fasterq-dump for SRA {sra.acc_id}')
             sra.error += 1
-            return
+            return False
 
-        # run gzip
+        # run gzip for both files concurrently
         _c(f'Compressing {path}')
-        cmds = ['parallel', 'gzip', '-f', ':::', f'{path}_1.fastq', f'{path}_2.fastq']
-        run_cmds = ['srun'] + cmds
+        cmds_list = [['gzip', '-f', f'{path}_1.fastq'], ['gzip', '-f', f'{path}_2.fastq']]
         if self.showcmds:
-            _c('Running: ' + ' '.join(run_cmds))
-        if subprocess.call(
-            run_cmds, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-        ) != 0:
+            for cmds in cmds_list:
+                _c('Running: ' + executor.describe(cmds))
+        if any(executor.run_many(cmds_list, cwd=temp_dir)):
             _c(f'ERR during compressing fastq files for SRA {sra.acc_id}')
             sra.error += 1
-            return
+            return False
 
         sra.paths = [pathlib.Path(f'{path}_1.fastq.gz'), pathlib.Path(f'{path}_2.fastq.gz')]
 
-        _c(f'Validating read and base counts for {sra.acc_id}')
-        retcode = validate_read_base_counts(sra.paths,
-                                            sra.read_count, sra.base_count,
-                                            prefix_cmd=['srun'])
-        if retcode != 0:
-            _c(f'ERR during validation of read and base count for SRA {sra.acc_id}')
-            sra.error += 1
-            return
-
-        _c(f'Calculating MD5 sum hashes for {sra.acc_id}')
-        sra.info.files = [p.name for p in sra.paths]
-        sra.info.md5sums = sra.md5sums = [md5sum_file(p) for p in sra.paths]
-        sra.info.sizes = [p.stat().st_size for p in sra.paths]
-
-        path.unlink()
-        _c(f'Removed {path}')
+        return True
 
 # EOF
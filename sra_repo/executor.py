@@ -0,0 +1,272 @@
+import os
+import pathlib
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+
+"""
+Execution backends for external tools
+
+External tools (fasterq-dump, compressors, samtools, sra-validator.py) are run as
+steps by an executor, selected by SRA_REPO_EXECUTOR environment or --executor
+argument:
+
+ - local: run as local processes, with the total cpus of concurrent steps limited
+   to SRA_REPO_LOCAL_CPUS environment (defaulting to the number of cpus)
+ - srun: run as Slurm job steps within the current allocation
+ - sbatch: submit as Slurm batch jobs and wait for them to finish, with the steps
+   of run_many() submitted as a single job array
+ - auto: srun inside a Slurm allocation (SLURM_JOB_ID is set), otherwise local
+
+Each step can have resource hints (cpus, memory and scratch space), which are passed
+to Slurm as --cpus-per-task, --mem and --tmp.  Steps whose output is streamed back
+(eg. fasterq-dump --stdout) can not be run as batch jobs, hence are run as job steps
+within an allocation or as local processes by the sbatch executor.
+
+Additional options for srun and sbatch can be set with SRA_REPO_SRUN_OPTS and
+SRA_REPO_SBATCH_OPTS environment, eg. SRA_REPO_SBATCH_OPTS='-p short --qos=normal'
+"""
+
+
+@dataclass
+class Resources:
+
+    cpus: int | None = None
+    memory: str | None = None
+    scratch: str | None = None
+
+    def slurm_args(self):
+        args = []
+        if self.cpus:
+            args.append(f'--cpus-per-task={self.cpus}')
+        if self.memory:
+            args.append(f'--mem={self.memory}')
+        if self.scratch:
+            args.append(f'--tmp={self.scratch}')
+        return args
+
+
+class Executor(object):
+    """ base executor, running steps as local processes without any limit """
+
+    name = 'base'
+
+    def command(self, cmds: list[str], resources: Resources | None = None):
+        """ return the command line actually run for the step """
+        return list(cmds)
+
+    def popen(self, cmds: list[str], *, resources: Resources | None = None, **kwargs):
+        """ start a step and return subprocess.Popen, eg. for streaming its output """
+        return subprocess.Popen(self.command(cmds, resources), **kwargs)
+
+    def run(self, cmds: list[str], *, resources: Resources | None = None,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **kwargs):
+        """ run a step and return its exit code """
+        return self.popen(cmds, resources=resources, stdout=stdout, stderr=stderr,
+                          **kwargs).wait()
+
+    def run_many(self, cmds_list: list[list[str]], *, resources: Resources | None = None,
+                 **kwargs):
+        """ run steps concurrently and return the list of their exit codes """
+        if len(cmds_list) <= 1:
+            return [self.run(cmds, resources=resources, **kwargs) for cmds in cmds_list]
+        with ThreadPoolExecutor(max_workers=len(cmds_list)) as executor:
+            return list(executor.map(
+                lambda cmds: self.run(cmds, resources=resources, **kwargs), cmds_list
+            ))
+
+    def describe(self, cmds: list[str], resources: Resources | None = None):
+        return ' '.join(shlex.quote(c) for c in self.command(cmds, resources))
+
+
+class _LocalProcess(subprocess.Popen):
+    """ Popen releasing the cpus of the local executor once the process has finished """
+
+    def __init__(self, cmds, release, **kwargs):
+        self._release = release
+        try:
+            super().__init__(cmds, **kwargs)
+        except BaseException:
+            self._finish()
+            raise
+
+    def _finish(self):
+        if self._release is not None:
+            release, self._release = self._release, None
+            release()
+
+    def wait(self, timeout=None):
+        returncode = super().wait(timeout)
+        self._finish()
+        return returncode
+
+    def poll(self):
+        if (returncode := super().poll()) is not None:
+            self._finish()
+        return returncode
+
+
+class LocalExecutor(Executor):
+    """ run steps as local processes, limiting the total cpus of concurrent steps """
+
+    name = 'local'
+
+    def __init__(self, cpus: int | None = None):
+        self.cpus = cpus or int(os.environ.get('SRA_REPO_LOCAL_CPUS') or 0) or os.cpu_count() or 1
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def _acquire(self, cpus):
+        # a step needing more cpus than available runs alone
+        cpus = min(max(cpus or 1, 1), self.cpus)
+        with self._cond:
+            while self.used + cpus > self.cpus:
+                self._cond.wait()
+            self.used += cpus
+
+        def release():
+            with self._cond:
+                self.used -= cpus
+                self._cond.notify_all()
+
+        return release
+
+    def popen(self, cmds: list[str], *, resources: Resources | None = None, **kwargs):
+        release = self._acquire(resources.cpus if resources else None)
+        return _LocalProcess(self.command(cmds, resources), release, **kwargs)
+
+
+class SrunExecutor(Executor):
+    """ run steps as Slurm job steps within the current allocation """
+
+    name = 'srun'
+
+    def __init__(self, options: list[str] | None = None):
+        self.options = (options if options is not None
+                        else shlex.split(os.environ.get('SRA_REPO_SRUN_OPTS', '')))
+
+    def command(self, cmds: list[str], resources: Resources | None = None):
+        if resources and resources.cpus and (node_cpus := os.environ.get('SLURM_CPUS_ON_NODE')):
+            # a step can not use more cpus than allocated
+            resources = Resources(min(resources.cpus, int(node_cpus)), resources.memory,
+                                  resources.scratch)
+        return (['srun', '--ntasks=1'] + self.options
+                + (resources.slurm_args() if resources else []) + list(cmds))
+
+
+class SbatchExecutor(Executor):
+    """ submit steps as Slurm batch jobs, waiting for them to finish """
+
+    name = 'sbatch'
+
+    def __init__(self, options: list[str] | None = None):
+        self.options = (options if options is not None
+                        else shlex.split(os.environ.get('SRA_REPO_SBATCH_OPTS', '')))
+
+        # streamed steps can not be batch jobs
+        self.stream_executor = SrunExecutor() if in_allocation() else LocalExecutor()
+
+    def command(self, cmds: list[str], resources: Resources | None = None):
+        return (['sbatch', '--wait', '--parsable', '--output=/dev/null'] + self.options
+                + (resources.slurm_args() if resources else [])
+                + ['--wrap', ' '.join(shlex.quote(c) for c in cmds)])
+
+    def popen(self, cmds: list[str], *, resources: Resources | None = None, **kwargs):
+        return self.stream_executor.popen(cmds, resources=resources, **kwargs)
+
+    def run(self, cmds: list[str], *, resources: Resources | None = None,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=None, **kwargs):
+        # output of batch jobs is not returned to the submitting process
+        return subprocess.call(self.command(cmds, resources), stdout=subprocess.DEVNULL,
+                               stderr=stderr, cwd=cwd)
+
+    def run_many(self, cmds_list: list[list[str]], *, resources: Resources | None = None,
+                 stderr=subprocess.DEVNULL, cwd=None, **kwargs):
+        """ submit the steps as a job array, and return the exit code of each step,
+            which is written by each task to a status directory in cwd (which needs to be
+            in a shared filesystem)
+        """
+
+        if len(cmds_list) <= 1:
+            return [self.run(cmds, resources=resources, stderr=stderr, cwd=cwd)
+                    for cmds in cmds_list]
+
+        status_dir = pathlib.Path(tempfile.mkdtemp(prefix='sra-repo-array-', dir=cwd))
+        try:
+            script = ['#!/bin/bash', 'case "$SLURM_ARRAY_TASK_ID" in']
+            for (idx, cmds) in enumerate(cmds_list):
+                script.append(f'  {idx}) ' + ' '.join(shlex.quote(c) for c in cmds) + ' ;;')
+            script += ['  *) exit 1 ;;', 'esac',
+                       f'echo $? > {shlex.quote(status_dir.as_posix())}/$SLURM_ARRAY_TASK_ID']
+            script_path = status_dir / 'array.sh'
+            script_path.write_text('\n'.join(script) + '\n')
+
+            subprocess.call(['sbatch', '--wait', '--parsable', '--output=/dev/null',
+                             f'--array=0-{len(cmds_list) - 1}'] + self.options
+                            + (resources.slurm_args() if resources else [])
+                            + [script_path.as_posix()],
+                            stdout=subprocess.DEVNULL, stderr=stderr, cwd=cwd)
+
+            # a task without status file did not finish properly
+            returncodes = []
+            for idx in range(len(cmds_list)):
+                try:
+                    returncodes.append(int((status_dir / str(idx)).read_text()))
+                except (OSError, ValueError):
+                    returncodes.append(1)
+            return returncodes
+
+        finally:
+            shutil.rmtree(status_dir, ignore_errors=True)
+
+
+executors = {
+    'local': LocalExecutor,
+    'srun': SrunExecutor,
+    'sbatch': SbatchExecutor,
+}
+
+
+def in_allocation():
+    return 'SLURM_JOB_ID' in os.environ and shutil.which('srun') is not None
+
+
+def create_executor(name: str | None = None):
+    """ create executor by its name, or from SRA_REPO_EXECUTOR environment """
+
+    name = (name or os.environ.get('SRA_REPO_EXECUTOR', 'auto')).lower()
+    if name == 'auto':
+        name = 'srun' if in_allocation() else 'local'
+    if name not in executors:
+        raise ValueError(f'unknown executor: {name}, choose one of auto, '
+                         f'{", ".join(executors)}')
+    return executors[name]()
+
+
+_executor = None
+_lock = threading.Lock()
+
+
+def get_executor():
+    """ return the global executor, creating it from SRA_REPO_EXECUTOR environment
+        if not set yet
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = create_executor()
+        return _executor
+
+
+def set_executor(executor: Executor | None):
+    global _executor
+    with _lock:
+        _executor = executor
+
+# EOF
@@ -0,0 +1,423 @@
+import os
+import pathlib
+import zlib
+
+import numpy as np
+
+from sra_repo.fastq_verifier import decompress_blocks, read_size
+
+
+"""
+Streaming FASTQ statistics
+
+Records are parsed from large decompressed blocks, and accumulated into fixed-size
+histograms (read length, quality per position, mean quality per read and base
+composition), hence the memory usage does not depend on the number of reads.
+Positions beyond max_length are accumulated into the last position, and read
+lengths beyond max_length into the last bin of the read length histogram.
+
+With sampling, statistics are estimated from a subset of the reads:
+
+ - plain FASTQ and multi-member gzip files (eg. BGZF) are sampled by reading blocks
+   at evenly spaced offsets of the file, hence only a small part of the file is read
+ - single-member gzip files (as written by gzip and pigz) can not be read from an
+   arbitrary offset, hence only the leading records of the file are sampled
+ - files smaller than the sampled segments are read whole, with reads
+   reservoir-sampled from the whole stream and exact read and base counts
+
+The read and base counts of sampled blocks are estimated from the compressed bytes
+consumed relative to the file size.
+"""
+
+max_length = 1024
+max_qual = 64
+phred_offset = 33
+
+# number of evenly spaced segments read for block sampling, and the size of each
+# read within a segment
+sample_segments = 32
+sample_read_size = 64 * 1024
+
+
+class FastqStats(object):
+    """ fixed-size histograms of a set of FASTQ records """
+
+    def __init__(self, max_length: int = max_length, phred_offset: int = phred_offset):
+        self.max_length = max_length
+        self.phred_offset = phred_offset
+        self.read_count = 0
+        self.base_count = 0
+        self.min_length = None
+        self.max_read_length = 0
+        self.length_hist = np.zeros(max_length + 1, dtype=np.int64)
+        self.pos_qual_hist = np.zeros((max_length, max_qual), dtype=np.int64)
+        self.read_qual_hist = np.zeros(max_qual, dtype=np.int64)
+        self.base_hist = np.zeros(256, dtype=np.int64)
+        self.sampled = False
+        self._splitter = None
+
+    def update(self, data: bytes):
+        """ add the records of a block of FASTQ stream fed in arbitrary blocks """
+        if self._splitter is None:
+            self._splitter = RecordSplitter()
+        self.add_records(*self._splitter.update(data))
+
+    def close(self):
+        if self._splitter is not None:
+            self.add_records(*self._splitter.close())
+            self._splitter = None
+
+    def add_records(self, seqs: list[bytes], quals: list[bytes]):
+
+        if not quals:
+            return
+
+        lengths = np.fromiter(map(len, quals), dtype=np.int64, count=len(quals))
+        self.read_count += len(lengths)
+        self.base_count += int(lengths.sum())
+        min_length = int(lengths.min())
+        if self.min_length is None or min_length < self.min_length:
+            self.min_length = min_length
+        self.max_read_length = max(self.max_read_length, int(lengths.max()))
+        self.length_hist += np.bincount(np.minimum(lengths, self.max_length),
+                                        minlength=self.max_length + 1)
+
+        self.base_hist += np.bincount(np.frombuffer(b''.join(seqs), dtype=np.uint8),
+                                      minlength=256)
+
+        qvals = np.frombuffer(b''.join(quals), dtype=np.uint8).astype(np.int64)
+        if len(qvals) == 0:
+            return
+        qvals -= self.phred_offset
+        np.clip(qvals, 0, max_qual - 1, out=qvals)
+
+        # position of each base within its read
+        starts = np.cumsum(lengths) - lengths
+        positions = np.arange(len(qvals)) - np.repeat(starts, lengths)
+        np.minimum(positions, self.max_length - 1, out=positions)
+        self.pos_qual_hist += np.bincount(
+            positions * max_qual + qvals, minlength=self.max_length * max_qual
+        ).reshape(self.max_length, max_qual)
+
+        nonempty = lengths > 0
+        means = np.add.reduceat(qvals, starts[nonempty]) // lengths[nonempty]
+        self.read_qual_hist += np.bincount(means, minlength=max_qual)
+
+    def merge(self, other):
+        self.read_count += other.read_count
+        self.base_count += other.base_count
+        if other.min_length is not None:
+            self.min_length = (other.min_length if self.min_length is None
+                               else min(self.min_length, other.min_length))
+        self.max_read_length = max(self.max_read_length, other.max_read_length)
+        self.length_hist += other.length_hist
+        self.pos_qual_hist += other.pos_qual_hist
+        self.read_qual_hist += other.read_qual_hist
+        self.base_hist += other.base_hist
+        self.sampled = self.sampled or other.sampled
+        return self
+
+    def summary(self):
+        """ return a dictionary of summary statistics """
+
+        qual_hist = self.pos_qual_hist.sum(axis=0)
+        observed_quals = np.flatnonzero(qual_hist)
+        total_quals = int(qual_hist.sum()) or 1
+        bases = {b: int(self.base_hist[ord(b)] + self.base_hist[ord(b.lower())])
+                 for b in 'ACGTN'}
+        called = sum(bases[b] for b in 'ACGT') or 1
+
+        return dict(
+            reads=self.read_count,
+            bases=self.base_count,
+            min_length=self.min_length or 0,
+            avg_length=round(self.base_count / self.read_count, 2) if self.read_count else 0,
+            max_length=self.max_read_length,
+            min_qual=int(observed_quals[0]) if len(observed_quals) else 0,
+            max_qual=int(observed_quals[-1]) if len(observed_quals) else 0,
+            mean_qual=round(float((qual_hist * np.arange(max_qual)).sum()) / total_quals, 2),
+            q30=round(float(qual_hist[30:].sum()) / total_quals, 4),
+            gc=round((bases['G'] + bases['C']) / called, 4),
+            n_content=round(bases['N'] / (int(self.base_hist.sum()) or 1), 4),
+        )
+
+    def as_dict(self):
+        """ return a dictionary of summary statistics and histograms, trimmed to the
+            observed ranges, suitable for JSON
+        """
+
+        def trim(hist):
+            nonzero = np.flatnonzero(hist)
+            return hist[:nonzero[-1] + 1 if len(nonzero) else 0].tolist()
+
+        qual_sums = (self.pos_qual_hist * np.arange(max_qual)).sum(axis=1)
+        pos_counts = self.pos_qual_hist.sum(axis=1)
+        positions = len(trim(pos_counts))
+
+        return dict(
+            self.summary(),
+            sampled=self.sampled,
+            length_hist=trim(self.length_hist),
+            read_qual_hist=trim(self.read_qual_hist),
+            pos_mean_qual=[round(q / n, 2) if n else 0
+                           for (q, n) in zip(qual_sums[:positions].tolist(),
+                                             pos_counts[:positions].tolist())],
+            base_counts={b: int(self.base_hist[ord(b)] + self.base_hist[ord(b.lower())])
+                         for b in 'ACGTN'},
+        )
+
+
+class RecordSplitter(object):
+    """ split a FASTQ stream fed in arbitrary blocks into (sequences, qualities)
+        of complete records
+    """
+
+    def __init__(self):
+        self._lines = []
+        self._partial = b''
+
+    def update(self, data: bytes):
+        lines = data.split(b'\n')
+        lines[0] = self._partial + lines[0]
+        self._partial = lines.pop()
+        if self._lines:
+            lines = self._lines + lines
+        n = len(lines) // 4 * 4
+        self._lines = lines[n:]
+        return (lines[1:n:4], lines[3:n:4])
+
+    def close(self):
+        lines = self._lines + ([self._partial] if self._partial else [])
+        self._lines = []
+        self._partial = b''
+        if len(lines) == 4:
+            return ([lines[1]], [lines[3]])
+        if lines:
+            raise ValueError(f'FASTQ stream ends with an incomplete record of {len(lines)} line(s)')
+        return ([], [])
+
+
+def is_gzip(path: str | pathlib.Path):
+    with open(path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def data_blocks(path: str | pathlib.Path, bufsize: int = read_size):
+    """ generate decompressed blocks of a plain or gzip-compressed file """
+    with open(path, 'rb') as f:
+        blocks = iter(lambda: f.read(bufsize), b'')
+        if is_gzip(path):
+            blocks = decompress_blocks(blocks)
+        yield from blocks
+
+
+def record_blocks(blocks):
+    """ generate (sequences, qualities) of complete records from each block of a
+        FASTQ stream starting at a record
+    """
+
+    splitter = RecordSplitter()
+    for data in blocks:
+        yield splitter.update(data)
+    yield splitter.close()
+
+
+def record_start(lines: list[bytes]):
+    """ return the index of the first line starting a record, for a FASTQ stream
+        starting at an arbitrary position
+    """
+    for i in range(len(lines) - 3):
+        if (lines[i].startswith(b'@') and lines[i + 2].startswith(b'+')
+                and len(lines[i + 1]) == len(lines[i + 3])):
+            return i
+    return None
+
+
+def stat_file(path: str | pathlib.Path, max_length: int = max_length):
+    """ return FastqStats of all records of a FASTQ file """
+
+    stats = FastqStats(max_length)
+    for data in data_blocks(path):
+        stats.update(data)
+    stats.close()
+    return stats
+
+
+def _segment_starts(path, segments):
+    """ return the offsets of evenly spaced segments of the file which can be read
+        independently, only the start of a single-member gzip file, or None if the
+        file should be read whole
+    """
+
+    filesize = os.stat(path).st_size
+    if filesize < segments * read_size:
+        # small enough to be read whole
+        return None
+    if not is_gzip(path):
+        return [filesize * i // segments for i in range(segments)]
+
+    from sra_repo.parallel_gzip import _find_boundary, find_member_ranges, search_size
+
+    # probe for a member near the first segment before searching at all segments,
+    # so that a single-member file is not searched throughout
+    offset = filesize // segments
+    with open(path, 'rb') as f:
+        boundary = _find_boundary(f, offset, min(offset + search_size, filesize))
+    ranges = find_member_ranges(path, segments) if boundary is not None else []
+    if len(ranges) <= 1:
+        # a single member can only be decompressed from its start, hence only its
+        # leading records are sampled
+        return [0]
+    return [start for (start, end) in ranges]
+
+
+def _read_segment(f, nlines: int, gzipped: bool):
+    """ return (data, compressed size) of at least nlines lines read from the current
+        position of the file, which must be at a gzip member for gzipped file
+    """
+
+    chunks = []
+    consumed = 0
+
+    def blocks():
+        # stop reading once enough lines have been decompressed
+        nonlocal consumed
+        while nlines >= 0 and (data := f.read(sample_read_size)):
+            consumed += len(data)
+            yield data
+
+    try:
+        for data in (decompress_blocks(blocks()) if gzipped else blocks()):
+            chunks.append(data)
+            nlines -= data.count(b'\n')
+    except zlib.error:
+        # the member is cut at the end of the segment, or can not be continued
+        pass
+
+    return (b''.join(chunks), consumed)
+
+
+def sample_blocks(path: str | pathlib.Path, sample_size: int, max_length: int = max_length,
+                  segments: int = sample_segments):
+    """ return FastqStats of about sample_size records read from evenly spaced
+        segments of the file, with the read and base counts estimated from the
+        compressed size, or None if the file should be read whole
+    """
+
+    starts = _segment_starts(path, segments)
+    if starts is None:
+        return None
+
+    gzipped = is_gzip(path)
+    per_segment = -(-sample_size // len(starts))
+    stats = FastqStats(max_length)
+    stats.sampled = True
+    consumed = produced = used = 0
+
+    with open(path, 'rb') as f:
+        for start in starts:
+            f.seek(start)
+            data, size = _read_segment(f, per_segment * 4 + 8, gzipped)
+            consumed += size
+            produced += len(data)
+
+            lines = data.split(b'\n')
+            idx = record_start(lines) if start > 0 else 0
+            if idx is None:
+                continue
+
+            # the last line may be incomplete
+            n = min(len(lines) - idx - 1, per_segment * 4) // 4 * 4
+            lines = lines[idx:idx + n]
+            stats.add_records(lines[1::4], lines[3::4])
+            used += sum(map(len, lines)) + n
+
+    # estimate the totals from the compression ratio and the bytes per read of
+    # the sampled records
+    if used:
+        ratio = os.stat(path).st_size * (produced / consumed) / used
+        stats.read_count = round(stats.read_count * ratio)
+        stats.base_count = round(stats.base_count * ratio)
+    return stats
+
+
+class Reservoir(object):
+    """ uniform sample of records from a stream, by keeping the records with the
+        smallest random keys
+    """
+
+    def __init__(self, sample_size: int, seed: int | None = None):
+        self.sample_size = sample_size
+        self.rng = np.random.default_rng(seed)
+        self.keys = np.empty(0)
+        self.records = []
+        self.read_count = 0
+        self.base_count = 0
+
+    def add_records(self, seqs: list[bytes], quals: list[bytes]):
+
+        self.read_count += len(quals)
+        self.base_count += sum(map(len, seqs))
+        keys = self.rng.random(len(quals))
+        if len(self.keys) >= self.sample_size:
+            candidates = np.flatnonzero(keys < self.keys.max())
+        else:
+            candidates = np.arange(len(quals))
+        if len(candidates) == 0:
+            return
+
+        keys = np.concatenate([self.keys, keys[candidates]])
+        records = self.records + [(seqs[i], quals[i]) for i in candidates]
+        if len(keys) > self.sample_size:
+            selected = np.argpartition(keys, self.sample_size)[:self.sample_size]
+            keys = keys[selected]
+            records = [records[i] for i in selected]
+        self.keys = keys
+        self.records = records
+
+    def stats(self, max_length: int = max_length):
+        stats = FastqStats(max_length)
+        if self.records:
+            seqs, quals = zip(*self.records)
+            stats.add_records(list(seqs), list(quals))
+        stats.read_count = self.read_count
+        stats.base_count = self.base_count
+        stats.sampled = True
+        return stats
+
+
+def sample_file(path: str | pathlib.Path, sample_size: int, max_length: int = max_length,
+                seed: int | None = None):
+    """ return FastqStats estimated from about sample_size records of a FASTQ file """
+
+    if (stats := sample_blocks(path, sample_size, max_length)) is not None:
+        return stats
+
+    reservoir = Reservoir(sample_size, seed)
+    for (seqs, quals) in record_blocks(data_blocks(path)):
+        reservoir.add_records(seqs, quals)
+    return reservoir.stats(max_length)
+
+
+def stat_files(paths: list[str | pathlib.Path], sample: int = 0,
+               max_length: int = max_length):
+    """ return FastqStats of all files of a run (eg. R1 and R2), computed in parallel,
+        and estimated from about sample reads per file if sample > 0
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    def stat_path(path):
+        if sample > 0:
+            return sample_file(path, sample, max_length)
+        return stat_file(path, max_length)
+
+    stats = FastqStats(max_length)
+    if not paths:
+        return stats
+    with ThreadPoolExecutor(max_workers=len(paths)) as executor:
+        for file_stats in executor.map(stat_path, paths):
+            stats.merge(file_stats)
+    return stats
+
+# EOF
@@ -0,0 +1,296 @@
+import hashlib
+import pathlib
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+"""
+Single-pass FASTQ verifier
+
+Each .fastq.gz file is read once in large buffers, with the compressed data fed to
+the MD5 hasher and to the gzip decompressor, and the decompressed data fed to the
+read and base counter, replacing separate gzip -t, md5sum and sra-validator.py runs.
+
+If NumPy is available, reads and bases are counted from the positions of newlines
+in each block, without creating a Python object for each line.
+"""
+
+read_size = 4 * 1024 * 1024
+
+
+class FastqCounter(object):
+    """ count reads and bases of a 4-line FASTQ stream fed in arbitrary blocks """
+
+    def __init__(self, vectorized: bool | None = None):
+        self.lines = 0
+        self.base_count = 0
+        self.vectorized = (np is not None) if vectorized is None else vectorized
+
+        # the incomplete last line of the previous block, either as bytes or as
+        # its length only with vectorized counting
+        self._partial = b''
+        self._partial_len = 0
+
+    def update(self, data: bytes):
+        if not data:
+            return
+        if self.vectorized:
+            self._update_vectorized(data)
+        else:
+            self._update_bytes(data)
+
+    def _update_bytes(self, data):
+        lines = data.split(b'\n')
+        lines[0] = self._partial + lines[0]
+        self._partial = lines.pop()
+
+        # sequence lines are the 2nd line of every 4 lines, and lines[i]
+        # is the (self.lines + i)-th line of the file
+        self.base_count += sum(map(len, lines[(1 - self.lines) % 4::4]))
+        self.lines += len(lines)
+
+    def _update_vectorized(self, data):
+        ends = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)
+        if len(ends) == 0:
+            self._partial_len += len(data)
+            return
+
+        # line lengths without newlines, with the first line continuing
+        # the incomplete line of the previous block
+        lengths = np.diff(ends, prepend=-1) - 1
+        lengths[0] += self._partial_len
+        self._partial_len = len(data) - int(ends[-1]) - 1
+
+        self.base_count += int(lengths[(1 - self.lines) % 4::4].sum())
+        self.lines += len(ends)
+
+    def close(self):
+        # last line without newline
+        partial_len = len(self._partial) if not self.vectorized else self._partial_len
+        if partial_len:
+            if self.lines % 4 == 1:
+                self.base_count += partial_len
+            self.lines += 1
+            self._partial = b''
+            self._partial_len = 0
+
+    @property
+    def read_count(self):
+        return self.lines // 4
+
+    @property
+    def is_complete(self):
+        return self.lines % 4 == 0
+
+
+def decompress_blocks(blocks):
+    """ generate decompressed data from blocks of gzip data, which can have several
+        members (eg. concatenated gzip files); raise zlib.error for invalid or
+        truncated data
+    """
+
+    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    pending = b''
+    for data in blocks:
+        data = pending + data
+        pending = b''
+        while data:
+            if decompressor.eof:
+                if len(data) < 2 and b'\x1f\x8b'.startswith(data):
+                    # the magic of the next member is split across blocks
+                    pending = data
+                    break
+                if not data.startswith(b'\x1f\x8b'):
+                    raise zlib.error('trailing garbage after gzip data')
+                decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+            yield decompressor.decompress(data)
+            data = decompressor.unused_data
+
+    if pending:
+        raise zlib.error('trailing garbage after gzip data')
+    yield decompressor.flush()
+    if not decompressor.eof:
+        raise zlib.error('truncated gzip file')
+
+
+def count_fastq(path: str | pathlib.Path, bufsize: int = read_size):
+    """ return (read_count, base_count) of a FASTQ file, either plain or gzip-compressed,
+        raising ValueError if the file is not valid
+    """
+
+    counter = FastqCounter()
+    with open(path, 'rb') as f:
+        blocks = iter(lambda: f.read(bufsize), b'')
+        if f.peek(2)[:2] == b'\x1f\x8b':
+            try:
+                blocks = decompress_blocks(blocks)
+                for data in blocks:
+                    counter.update(data)
+            except zlib.error as err:
+                raise ValueError(f'gzip error in {path}: {err}')
+        else:
+            for data in blocks:
+                counter.update(data)
+
+    counter.close()
+    if not counter.is_complete:
+        raise ValueError(f'incomplete FASTQ record in {path}, found {counter.lines} lines')
+    return (counter.read_count, counter.base_count)
+
+
+@dataclass
+class FileReport:
+
+    path: pathlib.Path
+    size: int = 0
+    md5sum: str | None = None
+    read_count: int = 0
+    base_count: int = 0
+    gzip_ok: bool = False
+    errmsg: str = ''
+
+    # FastqStats of the file, if collected
+    stats: Any = None
+
+    @property
+    def is_valid(self):
+        return self.gzip_ok and not self.errmsg
+
+
+@dataclass
+class RunReport:
+
+    files: list[FileReport]
+
+    @property
+    def is_valid(self):
+        return all(f.is_valid for f in self.files)
+
+    @property
+    def is_paired_consistent(self):
+        """ all files (eg. R1 and R2) have identical read counts """
+        return len(set(f.read_count for f in self.files)) <= 1
+
+    @property
+    def read_count(self):
+        return self.files[0].read_count if self.files else 0
+
+    @property
+    def base_count(self):
+        return sum(f.base_count for f in self.files)
+
+    @property
+    def md5sums(self):
+        return [f.md5sum for f in self.files]
+
+    @property
+    def sizes(self):
+        return [f.size for f in self.files]
+
+    def merged_stats(self):
+        """ return the dictionary of statistics of all files, or None if not collected """
+        if not self.files or any(f.stats is None for f in self.files):
+            return None
+        from sra_repo.fastq_stats import FastqStats
+        first = self.files[0].stats
+        stats = FastqStats(first.max_length, first.phred_offset)
+        for f in self.files:
+            stats.merge(f.stats)
+        return stats.as_dict()
+
+    def check(self, read_count: int | None = None, base_count: int | None = None):
+        """ raise ValueError if the files are not valid, or if the counts do not match,
+            following the rules of sra-validator.py
+        """
+
+        for f in self.files:
+            if not f.is_valid:
+                raise ValueError(f'file {f.path} is not valid: {f.errmsg or "gzip error"}')
+
+        if not self.is_paired_consistent:
+            raise ValueError('Read counts are not identical for all fastq files')
+
+        if base_count is not None and self.base_count != base_count:
+            raise ValueError(f'Total bases {self.base_count} does not match {base_count}!')
+
+        if (read_count is not None
+                and self.read_count != read_count and self.read_count * 2 != read_count):
+            raise ValueError(f'Read counts {self.read_count} does not match {read_count}')
+
+
+def verify_file(path: str | pathlib.Path, bufsize: int = read_size, stats=None):
+    """ read a .fastq.gz file once, and return FileReport with gzip validity, MD5 hash
+        and size of the compressed file, and read and base counts; the decompressed
+        data is also fed to stats (eg. FastqStats) if provided
+    """
+
+    path = pathlib.Path(path)
+    report = FileReport(path=path, stats=stats)
+    hasher = hashlib.md5()
+    counter = FastqCounter()
+
+    def read_blocks(f):
+        while (data := f.read(bufsize)):
+            hasher.update(data)
+            report.size += len(data)
+            yield data
+
+    try:
+        with open(path, 'rb') as f:
+            for data in decompress_blocks(read_blocks(f)):
+                counter.update(data)
+                if stats is not None:
+                    stats.update(data)
+
+        counter.close()
+        report.gzip_ok = True
+
+        if not counter.is_complete:
+            report.errmsg = f'incomplete FASTQ record, found {counter.lines} lines'
+        elif stats is not None:
+            stats.close()
+
+    except zlib.error as err:
+        report.errmsg = f'gzip error: {err}'
+
+    report.md5sum = hasher.hexdigest()
+    report.read_count = counter.read_count
+    report.base_count = counter.base_count
+    return report
+
+
+def verify_files(paths: list[str | pathlib.Path], threads: int = 2,
+                 collect_stats: bool = False, scheduler=None):
+    """ verify all files of a run (eg. R1 and R2) in parallel, and return RunReport,
+        with the statistics of each file if collect_stats is True; each file is read
+        while holding a reader slot of its device if scheduler (DeviceScheduler) is
+        provided
+    """
+
+    def verify(path):
+        if scheduler is not None:
+            with scheduler.reader(path):
+                return _verify(path)
+        return _verify(path)
+
+    def _verify(path):
+        if collect_stats:
+            from sra_repo.fastq_stats import FastqStats
+            return verify_file(path, stats=FastqStats())
+        return verify_file(path)
+
+    if threads <= 1 or len(paths) <= 1:
+        return RunReport(files=[verify(p) for p in paths])
+
+    with ThreadPoolExecutor(max_workers=min(threads, len(paths))) as executor:
+        return RunReport(files=list(executor.map(verify, paths)))
+
+# EOF
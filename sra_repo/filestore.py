@@ -1,13 +1,23 @@
 
+import os
 import re
+import fnmatch
 import pathlib
+import threading
 import shutil
 import stat
 import json
+import sqlite3
 
 from dataclasses import dataclass
+from typing import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Full
 from flufl.lock import Lock, TimeOutError
-from sra_repo.utils import cexit, cerr, check_gzip_file
+from sra_repo.utils import cexit, cerr
+from sra_repo.fastq_verifier import verify_file
+from sra_repo.ingest import ingest_file
+from sra_repo.catalog import open_catalog
 
 
 re_sraid = re.compile(r'(\D+)(.+)')
@@ -31,6 +41,14 @@ class SRA_Info:
     md5sums: list[str] | None
     metadata: dict[str] | None = None
 
+    # read statistics (counts, length and quality histograms, base composition),
+    # see FastqStats.as_dict()
+    stats: dict | None = None
+
+    # alternative urls of each file (including the url itself), only used for
+    # downloading, hence not saved
+    mirrors: list[list[str]] | None = None
+
     def _idx(self, filename):
         return self.files.index(filename)
 
@@ -57,8 +75,8 @@ class SRA_Info:
         del self.sizes[idx]
         del self.md5sums[idx]
 
-    def save(self, path):
-        d = dict(
+    def as_dict(self):
+        return dict(
             sra_id=self.sra_id,
             source=self.source,
             urls=self.urls,
@@ -68,9 +86,12 @@ class SRA_Info:
             sizes=self.sizes,
             md5sums=self.md5sums,
             metadata=self.metadata,
+            stats=self.stats,
         )
+
+    def save(self, path):
         with open(path, 'w') as f:
-            json.dump(d, f)
+            json.dump(self.as_dict(), f)
 
     @classmethod
     def load(cls, path):
@@ -99,6 +120,7 @@ class SRAFileStorage(object):
         self.__storage_root_path__ = pathlib.Path(storage_root_path)
         if not (self.__storage_root_path__ / '.sra-repo-db').is_file():
             cexit(f'ERROR: root fs {self.__storage_root_path__} is not a SRA repo storage')
+        self.catalog = open_catalog(self.__storage_root_path__ / '.sra-repo-db')
 
     def store(
         self,
@@ -108,6 +130,10 @@ class SRAFileStorage(object):
         *,
         use_move: bool = False,
     ):
+        """ store fastq files and SRA info, and return the list of ingest strategies
+            used for the files
+        """
+
         fullpaths = [pathlib.Path(fullpath) for fullpath in fullpaths]
 
         # cheap sanity checks
@@ -134,14 +160,17 @@ class SRAFileStorage(object):
             with sra_lock:
 
                 # save the fastq files
-                for path in fullpaths:
+                strategies = [
                     self.store_fastq(path, store_dir=store_dir, use_move=use_move)
+                    for path in fullpaths
+                ]
 
                 # save the read and base counts
                 self.__store_validation_info(
                     store_dir,
                     info
                 )
+                self.__update_catalog(info)
 
         except TimeOutError:
             raise ValueError(f'timeout lock error for SRA {sra_id}')
@@ -149,6 +178,8 @@ class SRAFileStorage(object):
         finally:
             store_dir.chmod(self.dir_secure_mode)
 
+        return strategies
+
     def store_fastq(
         self,
         fullpath: pathlib.Path,
@@ -156,17 +187,20 @@ class SRAFileStorage(object):
         *,
         use_move: bool = False,
     ):
+        """ store a fastq file using the cheapest ingest strategy, and return the name
+            of the strategy used (link, reflink, copy_file_range, sendfile or copy)
+        """
+
         filename = fullpath.name
 
         dest_file = store_dir / filename
         unlink_if_exists(dest_file)
 
-        if use_move:
-            shutil.move(fullpath, store_dir)
-        else:
-            shutil.copy2(fullpath, store_dir)
+        strategy = ingest_file(fullpath, dest_file, move=use_move)
         dest_file.chmod(stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
 
+        return strategy
+
         # excerpt code for changing mode
         # filename = "path/to/file"
         # mode = os.stat(filename).st_mode
@@ -204,15 +238,96 @@ class SRAFileStorage(object):
             store_dir.chmod(self.dir_edit_mode)
             with sra_lock:
                 self.__store_validation_info(store_dir, info)
+                self.__update_catalog(info)
 
         finally:
             store_dir.chmod(self.dir_secure_mode)
 
+    def __update_catalog(self, info: SRA_Info):
+        """ the catalog is only an index, hence failure to update it should not fail
+            the storing process, as the catalog can always be rebuilt with reindex
+        """
+
+        if not self.catalog:
+            return
+        try:
+            self.catalog.update(info.as_dict())
+        except sqlite3.Error as err:
+            cerr(f'WARN: failed to update catalog for SRA {info.sra_id}: {err}. '
+                 f'Please run: sra-repo.py reindex')
+
+    def has_validation_info(self, sra_id: str):
+        if self.catalog and self.catalog.get_info(sra_id):
+            return True
+        return (self.get_dirpath(sra_id) / 'info.json').is_file()
+
     def get_validation_info(self, sra_id: str):
+        if self.catalog and (d := self.catalog.get_info(sra_id)):
+            return SRA_Info(**d)
         store_dir = self.get_dirpath(sra_id)
         info_file = store_dir / 'info.json'
         return SRA_Info.load(info_file)
 
+    def get_verified_files(self, sra_id: str, read_files: list[pathlib.Path], info: SRA_Info):
+        """ return the read files whose fingerprint (inode, size, mtime and ctime) has not
+            changed since their MD5 hashes were last verified against the SRA info
+        """
+
+        if not self.catalog:
+            return []
+        try:
+            fingerprints = self.catalog.get_fingerprints(sra_id)
+        except sqlite3.Error:
+            return []
+
+        verified = []
+        for path in read_files:
+            if (fingerprint := fingerprints.get(path.name)) is None:
+                continue
+            if (fingerprint[:4] == file_fingerprint(path)
+                    and fingerprint[4] == info.get_md5(path.name)):
+                verified.append(path)
+        return verified
+
+    def record_verified_files(self, sra_id: str, fingerprints: dict, info: SRA_Info):
+        """ record fingerprints of files whose MD5 hashes have been verified, with
+            fingerprints is a dictionary of path to fingerprint taken before hashing
+        """
+
+        if not self.catalog:
+            return
+        try:
+            self.catalog.set_fingerprints(sra_id, [
+                (path.name, *fingerprint, info.get_md5(path.name))
+                for (path, fingerprint) in fingerprints.items()
+            ])
+        except sqlite3.Error as err:
+            cerr(f'WARN: failed to record file fingerprints for SRA {sra_id}: {err}')
+
+    def get_stats(self, sra_id: str, *, compute: bool = True, sample: int = 0):
+        """ return the read statistics of the SRA from its info, or compute them from the
+            fastq files on the first request and store them in the info; statistics
+            estimated from sampled reads (sample > 0) are not stored, and stored
+            sampled statistics are recomputed if sample is 0; return None if the
+            statistics are not available and compute is False
+        """
+
+        info = self.get_validation_info(sra_id)
+        stats = info.stats
+        if not compute or (stats is not None and (sample > 0 or not stats.get('sampled'))):
+            return stats
+
+        from sra_repo.fastq_stats import stat_files
+        stats = stat_files(self.get_read_files(sra_id), sample=sample).as_dict()
+        if not stats['sampled']:
+            info.stats = stats
+            try:
+                self.store_validation_info(sra_id, info)
+            except OSError as err:
+                # eg. read-only storage, the statistics are still usable
+                cerr(f'WARN: failed to store statistics for SRA {sra_id}: {err}')
+        return stats
+
     def link(
         self,
         sraid: str,
@@ -261,34 +376,140 @@ class SRAFileStorage(object):
 
         return files
 
-    def list(self, pattern: str | None = None):
+    def list(self, pattern: str | list[str] | None = None):
         """ provide unsorted list of all available SRA IDs """
 
-        sra_ids = []
+        return list(self.iter_list(pattern))
 
-        # walk across 1st layer
-        for dir_1 in self.__storage_root_path__.iterdir():
+    def iter_list(
+        self,
+        patterns: str | Iterable[str] | None = None,
+        *,
+        threads: int = 8,
+        use_catalog: bool = True,
+    ):
+        """ iterate over available SRA IDs matching any of the patterns, either using
+            the catalog or by walking the storage directories
 
-            if dir_1.name == '.sra-repo-db':
-                continue
+            a pattern without any wildcard is treated as a prefix, eg. ERR17 is ERR17*
+        """
+
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        patterns = [p if any(c in p for c in '*?[') else p + '*' for p in patterns or []]
+
+        if use_catalog and self.catalog and self.catalog.is_indexed():
+            yield from self.catalog.iter_ids(patterns)
+            return
+
+        yield from self._walk(patterns, threads=threads)
+
+    def _walk(self, patterns: Iterable[str] | None = None, *, threads: int = 8):
+        """ iterate over SRA IDs by walking the directories in the storage, with each
+            of the 1st layer directories walked by a thread
+        """
+
+        shard_filters = [shard_prefixes(p) for p in patterns] if patterns else [('', '')]
 
-            # walk across 2nd layer
-            for dir_2 in dir_1.iterdir():
+        def accept(name, level):
+            return any(name.startswith(f[level]) for f in shard_filters)
 
-                for sra_id in dir_2.iterdir():
-                    sra_ids.append(sra_id)
+        # batches of SRA IDs from walkers, with None as the finish mark of each walker
+        batch_queue = Queue(64)
+        stop = threading.Event()
 
-        if not pattern:
-            return sra_ids
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batch_queue.put(item, timeout=1)
+                    return
+                except Full:
+                    continue
 
-        # process pattern here
-        return sra_ids
+        def walk_dir_1(dir_1):
+            try:
+                batch = []
+                with os.scandir(dir_1) as it_2:
+                    for dir_2 in it_2:
+                        if stop.is_set():
+                            return
+                        if not dir_2.is_dir() or not accept(dir_2.name, 1):
+                            continue
+                        with os.scandir(dir_2.path) as it_3:
+                            for sra_dir in it_3:
+                                if patterns and not any(fnmatch.fnmatchcase(sra_dir.name, p)
+                                                        for p in patterns):
+                                    continue
+                                batch.append(sra_dir.name)
+                        if len(batch) >= 1000:
+                            put(batch)
+                            batch = []
+                if batch:
+                    put(batch)
+            finally:
+                put(None)
+
+        # walk across 1st layer, skipping .sra-repo-db, .lock and catalog journal files
+        with os.scandir(self.__storage_root_path__) as it_1:
+            dirs_1 = [dir_1.path for dir_1 in it_1
+                      if not dir_1.name.startswith('.') and dir_1.is_dir()
+                      and accept(dir_1.name, 0)]
+
+        if not dirs_1:
+            return
+
+        with ThreadPoolExecutor(max_workers=max(1, min(threads, len(dirs_1)))) as executor:
+            futures = [executor.submit(walk_dir_1, dir_1) for dir_1 in dirs_1]
+            try:
+                pending = len(dirs_1)
+                while pending > 0:
+                    batch = batch_queue.get()
+                    if batch is None:
+                        pending -= 1
+                        continue
+                    yield from batch
+            finally:
+                stop.set()
+
+        # raise any exception from the walkers
+        for future in futures:
+            future.result()
 
     def delete(self, sra_id: str):
         store_dir = self.get_dirpath(sra_id)
         if not store_dir.is_dir():
             raise ValueError(f'SRA ID: {sra_id} does not exist in DB')
         shutil.rmdir(store_dir)
+        if self.catalog:
+            self.catalog.remove(sra_id)
+
+    def reindex(self):
+        """ rebuild the catalog from the directories and info files in the storage,
+            return the number of SRA IDs in the catalog
+        """
+
+        if not self.catalog:
+            raise ValueError(f'catalog database is not available for {self.__storage_root_path__}')
+
+        def iter_entries():
+            for counter, sra_id in enumerate(self._walk(), 1):
+                if counter % 10000 == 0:
+                    cerr(f' - indexed {counter} SRA IDs')
+                store_dir = self.get_dirpath(sra_id)
+                try:
+                    info = SRA_Info.load(store_dir / 'info.json')
+                    files = list(zip(info.files,
+                                     info.sizes or [None] * len(info.files),
+                                     info.md5sums or [None] * len(info.files)))
+                    yield (sra_id, info.as_dict(), files)
+                except FileNotFoundError:
+                    # no info file yet, use the fastq files in the directory
+                    files = [(a_file.name, a_file.stat().st_size, None)
+                             for a_file in store_dir.iterdir()
+                             if a_file.name.endswith('.fastq.gz')]
+                    yield (sra_id, None, files)
+
+        return self.catalog.rebuild(iter_entries())
 
     def get_dirpath(self, sra_id: str, check: bool = False):
         """ return a Path """
@@ -307,6 +528,10 @@ class SRAFileStorage(object):
         return path
 
     def get_read_files(self, sra_id: str):
+        if self.catalog and (files := self.catalog.get_files(sra_id)) is not None:
+            sra_dir = self.get_dirpath(sra_id)
+            return [sra_dir / filename for filename in files
+                    if filename.endswith('.fastq.gz')]
         sra_dir = self.get_dirpath(sra_id, check=True)
         return [a_file for a_file in sra_dir.iterdir() if a_file.name.endswith('.fastq.gz')]
 
@@ -319,6 +544,8 @@ class SRAFileStorage(object):
     ):
 
         if sra_id:
+            if not verify and self.catalog and self.catalog.has(sra_id):
+                return True
             store_dir = self.get_dirpath(sra_id)
 
         if store_dir:
@@ -329,8 +556,10 @@ class SRAFileStorage(object):
                     return ValueError(f'SRA {sra_id} does not have any files!')
                 if verify:
                     for a_file in store_dir.iterdir():
+                        if not a_file.name.endswith('.fastq.gz'):
+                            continue
                         cerr(f' - verifying {a_file}')
-                        if not check_gzip_file(a_file):
+                        if not verify_file(a_file).is_valid:
                             raise ValueError(f'SRA {sra_id} with file {a_file} is not verified!')
             except:
                 if throw_exc:
@@ -345,6 +574,30 @@ class SRAFileStorage(object):
         return (self.__storage_root_path__ / '.lock' / store_dir.name).as_posix()
 
 
+def shard_prefixes(pattern: str):
+    """ return the (1st layer, 2nd layer) directory name prefixes that can contain
+        SRA IDs matching the glob pattern, eg. ERR175* gives ('17', '5')
+    """
+
+    # literal part of the pattern before any wildcard
+    literal = re.split(r'[*?\[]', pattern, maxsplit=1)[0]
+
+    # the shard directories are made from the digits following the alphabetical prefix
+    m = re.search(r'\d', literal)
+    if not m:
+        return ('', '')
+    suffix = literal[m.start():]
+    return (suffix[:2], suffix[2:4])
+
+
+def file_fingerprint(path: pathlib.Path):
+    """ return (inode, size, mtime_ns, ctime_ns) of the file, which changes if the file
+        is modified, replaced or restored
+    """
+    st = path.stat()
+    return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
 def unlink_if_exists(path: pathlib.Path):
     if path.is_file():
         # this file exists, need to remove it first
@@ -0,0 +1,129 @@
+import email.utils
+import os
+import threading
+import time
+
+import requests
+
+
+"""
+HTTP utilities for querying EBI/ENA and NCBI/Entrez
+
+All requests use a pooled keep-alive requests.Session and go through a per-service
+token bucket, so that the request rate stays below the limit of each service.
+When a service responds with 429 or 503, the Retry-After header is honoured and the
+whole service is paused, not only the thread receiving the response.
+
+Default rates (requests per second) can be set with SRA_REPO_ENA_RATE and
+SRA_REPO_NCBI_RATE environment; NCBI allows 3 requests/second, or 10 requests/second
+with an API key (set with NCBI_API_KEY environment).
+"""
+
+ncbi_api_key = os.environ.get('NCBI_API_KEY', None)
+
+default_rates = {
+    'ena': float(os.environ.get('SRA_REPO_ENA_RATE', 10)),
+    'ncbi': float(os.environ.get('SRA_REPO_NCBI_RATE', 10 if ncbi_api_key else 3)),
+}
+
+
+class TokenBucket(object):
+    """ thread-safe token bucket, shared by all threads querying a service """
+
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """ take a token and return 0, or return the number of seconds to wait """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while (wait := self._reserve()) > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+_buckets = {}
+_sessions = {}
+_lock = threading.Lock()
+
+
+def get_bucket(service: str):
+    with _lock:
+        if service not in _buckets:
+            _buckets[service] = TokenBucket(default_rates.get(service, 5))
+        return _buckets[service]
+
+
+def set_rate(service: str, rate: float):
+    with _lock:
+        _buckets[service] = TokenBucket(rate)
+
+
+def get_session(service: str, pool_size: int = 32):
+    """ return a keep-alive session with connection pool for the service """
+    with _lock:
+        if service not in _sessions:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[service] = session
+        return _sessions[service]
+
+
+def retry_after(response, attempt: int):
+    """ return the number of seconds to wait from Retry-After header, or use
+        exponential backoff if the header is not available
+    """
+
+    value = response.headers.get('Retry-After')
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                when = email.utils.parsedate_to_datetime(value)
+                return max(0.0, when.timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return min(60.0, 2.0 ** attempt)
+
+
+def request(service: str, method: str, url: str, *, tries: int = 5, **kwargs):
+    """ perform HTTP request to a service, retrying on 429 and 503 responses; the last
+        response is returned regardless of its status code
+    """
+
+    session = get_session(service)
+    bucket = get_bucket(service)
+
+    for attempt in range(tries):
+        bucket.acquire()
+        r = session.request(method, url, **kwargs)
+        if r.status_code not in (429, 503) or attempt == tries - 1:
+            return r
+        bucket.pause(retry_after(r, attempt))
+        r.close()
+
+    return r
+
+# EOF
@@ -0,0 +1,123 @@
+import errno
+import fcntl
+import os
+import pathlib
+import shutil
+
+
+"""
+Ingest strategies for storing files into the repository
+
+The strategies are tried from the cheapest one:
+ - link: hard link to the source file (only when moving, since both
+   paths share the same inode), with the source unlinked afterward
+ - reflink: copy-on-write clone with FICLONE ioctl (btrfs, XFS)
+ - copy_file_range: in-kernel copy, which can be offloaded by NFS 4.2 servers
+ - sendfile: in-kernel copy without going through user space
+ - copy: large-buffer copy through user space
+"""
+
+# from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+copy_buffer_size = 16 * 1024 * 1024
+
+# errors indicating that a strategy is not supported for the pair of paths,
+# hence the next strategy should be tried; other errors (eg. EACCES) are raised
+unsupported_errnos = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOSYS,
+                      errno.EINVAL, errno.ENOTTY, errno.EBADF, errno.EMLINK}
+
+# hard links are refused with EPERM by filesystems without hard links, and by
+# protected_hardlinks for source files owned by other users
+link_unsupported_errnos = unsupported_errnos | {errno.EPERM}
+
+
+def _link(src, dest):
+    os.link(src, dest)
+
+
+def _reflink(src, dest):
+    with open(src, 'rb') as fin, open(dest, 'wb') as fout:
+        fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+
+
+def _copy_file_range(src, dest):
+    with open(src, 'rb') as fin, open(dest, 'wb') as fout:
+        remaining = os.fstat(fin.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(fin.fileno(), fout.fileno(), remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+        if remaining > 0:
+            raise OSError(errno.EIO, f'copy_file_range stopped with {remaining} bytes left')
+
+
+def _sendfile(src, dest):
+    with open(src, 'rb') as fin, open(dest, 'wb') as fout:
+        remaining = os.fstat(fin.fileno()).st_size
+        offset = 0
+        while remaining > 0:
+            sent = os.sendfile(fout.fileno(), fin.fileno(), offset, remaining)
+            if sent == 0:
+                break
+            offset += sent
+            remaining -= sent
+        if remaining > 0:
+            raise OSError(errno.EIO, f'sendfile stopped with {remaining} bytes left')
+
+
+def _copy(src, dest):
+    with open(src, 'rb') as fin, open(dest, 'wb') as fout:
+        shutil.copyfileobj(fin, fout, copy_buffer_size)
+
+
+strategies = [
+    ('link', _link),
+    ('reflink', _reflink),
+    ('copy_file_range', _copy_file_range if hasattr(os, 'copy_file_range') else None),
+    ('sendfile', _sendfile if hasattr(os, 'sendfile') else None),
+    ('copy', _copy),
+]
+
+
+def ingest_file(
+    src: str | pathlib.Path,
+    dest: str | pathlib.Path,
+    *,
+    move: bool = False,
+):
+    """ put src file as dest file using the cheapest available strategy, and return
+        the name of the strategy used; with move=True, src file is removed afterward
+    """
+
+    src, dest = pathlib.Path(src), pathlib.Path(dest)
+    last_err = None
+
+    for (name, func) in strategies:
+
+        if func is None or (name == 'link' and not move):
+            continue
+
+        try:
+            func(src, dest)
+        except OSError as err:
+            if err.errno not in (link_unsupported_errnos if name == 'link'
+                                 else unsupported_errnos):
+                raise
+            # clean up any partially created file before trying next strategy
+            dest.unlink(missing_ok=True)
+            last_err = err
+            continue
+
+        if name != 'link':
+            shutil.copystat(src, dest)
+        if move:
+            src.unlink()
+        return name
+
+    if last_err is not None:
+        raise last_err
+    raise OSError(errno.EIO, f'cannot ingest {src} to {dest}')
+
+# EOF
@@ -0,0 +1,109 @@
+import json
+import os
+import pathlib
+import threading
+import time
+
+
+"""
+Fetch journal
+
+Each SRA run being fetched has an append-only journal file (SRA_ID.journal) in the
+temporary directory, with a JSON object per line recording the progress of the run:
+
+ - info: the SRA_Info dictionary and the label of the helper providing it
+ - started: a file has started downloading, hence a partial file can be resumed
+ - downloaded: a file has been downloaded, with its size and MD5 hash if available
+ - processed: the files have been verified or converted, with the updated SRA_Info
+ - failed: the files failed verification or conversion, hence need to be downloaded
+   again
+ - stored: the files have been stored, after which the journal is removed
+
+A restarted fetch replays the journal to skip the stages that have been completed.
+"""
+
+
+class RunJournal(object):
+
+    def __init__(self, directory: str | pathlib.Path, sra_id: str):
+        self.path = pathlib.Path(directory) / f'{sra_id}.journal'
+        self.sra_id = sra_id
+        self.info = None
+        self.helper = None
+        self.started = set()
+        self.downloaded = {}
+        self.processed = None
+        self.stored = False
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """ replay the journal; a truncated last line, eg. from a crash during
+            writing, is ignored
+        """
+
+        if not self.path.exists():
+            return
+
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    self._apply(json.loads(line))
+                except (ValueError, KeyError):
+                    break
+
+    def _apply(self, record):
+
+        match record['event']:
+            case 'info':
+                self.info = record['info']
+                self.helper = record['helper']
+                # new metadata invalidates everything after it
+                self.started = set()
+                self.downloaded = {}
+                self.processed = None
+                self.stored = False
+            case 'started':
+                self.started.add(record['filename'])
+            case 'downloaded':
+                self.downloaded[record['filename']] = (record['size'], record['md5sum'])
+            case 'processed':
+                self.processed = record['info']
+            case 'failed':
+                self.started = set()
+                self.downloaded = {}
+                self.processed = None
+            case 'stored':
+                self.stored = True
+
+    def record(self, event: str, **fields):
+
+        record = dict(event=event, time=time.time(), **fields)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._apply(record)
+
+    def is_downloaded(self, path: pathlib.Path):
+        """ check that the file has been downloaded and is still intact """
+        if path.name not in self.downloaded:
+            return False
+        return path.is_file() and path.stat().st_size == self.downloaded[path.name][0]
+
+    def is_processed(self, directory: pathlib.Path):
+        """ check that the processed files are still intact """
+        if self.processed is None:
+            return False
+        files = self.processed['files']
+        for (filename, size) in zip(files, self.processed['sizes'] or [None] * len(files)):
+            path = directory / filename
+            if not path.is_file() or (size is not None and path.stat().st_size != size):
+                return False
+        return True
+
+    def remove(self):
+        self.path.unlink(missing_ok=True)
+
+# EOF
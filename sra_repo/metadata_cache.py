@@ -0,0 +1,163 @@
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+
+
+"""
+Persistent metadata cache
+
+Raw responses from ENA and Entrez are stored in a SQLite database keyed by
+(endpoint, accession), with a TTL and a size-bounded LRU eviction.  In offline
+mode, a cache miss raises ValueError instead of querying the remote services.
+
+The cache file is set by SRA_REPO_METADATA_CACHE environment, defaulting to
+~/.cache/sra-repo/metadata.sqlite
+"""
+
+cache_schema = """
+CREATE TABLE IF NOT EXISTS response (
+    endpoint TEXT NOT NULL,
+    accession TEXT NOT NULL,
+    content BLOB,
+    size INTEGER,
+    fetched REAL,
+    accessed REAL,
+    PRIMARY KEY (endpoint, accession)
+);
+
+CREATE INDEX IF NOT EXISTS response_accessed ON response (accessed);
+"""
+
+
+class MetadataCache(object):
+
+    def __init__(
+        self,
+        db_path: str | pathlib.Path,
+        *,
+        ttl: float = 30 * 24 * 3600,
+        max_size: int = 1024 ** 3,
+        offline: bool = False,
+    ):
+        self.db_path = pathlib.Path(db_path)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._conn() as conn:
+            conn.executescript(cache_schema)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path.as_posix(), timeout=60)
+            self._local.conn = conn
+        return conn
+
+    def get(self, endpoint: str, accession: str):
+        """ return cached content or None if not available or expired """
+
+        conn = self._conn()
+        row = conn.execute(
+            'SELECT content, fetched FROM response WHERE endpoint = ? AND accession = ?',
+            (endpoint, accession)
+        ).fetchone()
+
+        # in offline mode, expired content is still better than nothing
+        if row is None or (not self.offline and time.time() - row[1] > self.ttl):
+            self.misses += 1
+            return None
+
+        with conn:
+            conn.execute(
+                'UPDATE response SET accessed = ? WHERE endpoint = ? AND accession = ?',
+                (time.time(), endpoint, accession)
+            )
+        self.hits += 1
+        return row[0]
+
+    def put(self, endpoint: str, accession: str, content: bytes):
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO response '
+                '(endpoint, accession, content, size, fetched, accessed) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (endpoint, accession, content, len(content), now, now)
+            )
+
+        # summing up sizes needs a full scan, hence only check periodically
+        self._puts += 1
+        if self._puts % 100 == 1:
+            self.evict()
+
+    def evict(self):
+        """ remove least recently used entries until the total size is below max_size """
+
+        with self._conn() as conn:
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM response').fetchone()[0]
+            if total <= self.max_size:
+                return
+            cur = conn.execute('SELECT endpoint, accession, size FROM response ORDER BY accessed')
+            victims = []
+            for (endpoint, accession, size) in cur:
+                if total <= self.max_size * 0.9:
+                    break
+                victims.append((endpoint, accession))
+                total -= size
+            conn.executemany('DELETE FROM response WHERE endpoint = ? AND accession = ?', victims)
+
+    def ensure_online(self, endpoint: str, accession: str):
+        """ raise ValueError in offline mode, to be called after a cache miss """
+        if self.offline:
+            raise ValueError(f'{accession} is not in the metadata cache for {endpoint} '
+                             f'(offline mode)')
+
+    def summary(self):
+        return f'Metadata cache: {self.hits} hit(s), {self.misses} miss(es)'
+
+
+_cache = None
+
+
+def get_cache():
+    """ return the global MetadataCache instance, or None if caching is disabled """
+    return _cache
+
+
+def set_cache(cache: MetadataCache | None):
+    global _cache
+    _cache = cache
+
+
+def init_cache(*, offline: bool = False, ttl: float | None = None, disabled: bool = False):
+    """ set up the global cache from SRA_REPO_METADATA_CACHE environment """
+
+    if disabled:
+        if offline:
+            raise ValueError('offline mode requires metadata cache')
+        set_cache(None)
+        return None
+
+    db_path = os.environ.get(
+        'SRA_REPO_METADATA_CACHE',
+        pathlib.Path.home() / '.cache' / 'sra-repo' / 'metadata.sqlite'
+    )
+    kwargs = dict(offline=offline)
+    if ttl is not None:
+        kwargs['ttl'] = ttl
+    if (max_size := os.environ.get('SRA_REPO_METADATA_CACHE_SIZE')):
+        from sra_repo.utils import parse_size
+        kwargs['max_size'] = parse_size(max_size)
+    cache = MetadataCache(db_path, **kwargs)
+    set_cache(cache)
+    return cache
+
+# EOF
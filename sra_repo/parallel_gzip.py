@@ -0,0 +1,249 @@
+import importlib.util
+import os
+import pathlib
+import zlib
+
+from dataclasses import dataclass, field
+
+from sra_repo.fastq_verifier import FastqCounter, count_fastq, decompress_blocks, np, read_size
+
+
+"""
+Parallel counting of a single FASTQ.gz file
+
+A gzip file is split into byte ranges of whole gzip members, which are decompressed
+and counted by separate processes.  Member boundaries are searched speculatively
+near evenly spaced offsets of the file, by looking for a valid gzip header from
+which data can be decompressed.  A false boundary lies inside a member, which makes
+the preceding range end before its last member is complete, hence it is detected by
+that range failing to decompress, after which the file is counted sequentially.
+
+Since a range generally does not start at the beginning of a FASTQ record, each
+range reports the length of its first (partial) line, the total length of its
+complete lines by line index modulo 4, and the length of its last (partial) line,
+which are merged in order to obtain the read and base counts of the file.
+
+Files compressed as a single member (eg. by gzip or pigz) can only be decompressed
+in parallel with rapidgzip, which is used if installed, together with its index file
+(FILENAME.gzindex) if one exists.
+"""
+
+gzip_magic = b'\x1f\x8b\x08'
+index_suffix = '.gzindex'
+
+# maximum distance from an offset to search for a member boundary
+search_size = 16 * 1024 * 1024
+
+
+def has_rapidgzip():
+    return importlib.util.find_spec('rapidgzip') is not None
+
+
+def is_gzip(path: str | pathlib.Path):
+    with open(path, 'rb') as f:
+        return f.read(2) == gzip_magic[:2]
+
+
+def is_member_start(data: bytes):
+    """ check that data starts with a gzip header followed by valid deflate data """
+    # FLG reserved bits must be zero
+    if not data.startswith(gzip_magic) or len(data) < 10 or data[3] & 0xe0:
+        return False
+    try:
+        return len(zlib.decompressobj(wbits=zlib.MAX_WBITS | 16).decompress(data)) > 0
+    except zlib.error:
+        return False
+
+
+def _find_boundary(f, offset: int, limit: int):
+    """ return the position of the first member start within [offset, limit), or None """
+
+    # each candidate is checked with the following 64 KiB of data
+    probe_size = 64 * 1024
+    while offset < limit:
+        f.seek(offset)
+        data = f.read(read_size + probe_size)
+        pos = data.find(gzip_magic)
+        while 0 <= pos < min(read_size, limit - offset):
+            if is_member_start(data[pos:pos + probe_size]):
+                return offset + pos
+            pos = data.find(gzip_magic, pos + 1)
+        offset += read_size
+    return None
+
+
+def find_member_ranges(path: str | pathlib.Path, nchunks: int):
+    """ return a list of (start, end) byte ranges consisting of whole gzip members,
+        with boundaries near evenly spaced offsets of the file
+    """
+
+    filesize = os.stat(path).st_size
+    boundaries = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, nchunks):
+            offset = max(filesize * i // nchunks, boundaries[-1] + 1)
+            boundary = _find_boundary(f, offset, min(offset + search_size, filesize))
+            if boundary is not None:
+                boundaries.append(boundary)
+
+    boundaries.append(filesize)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+@dataclass
+class ChunkCount:
+
+    start: int
+    has_newline: bool = False
+    head_len: int = 0
+    lines: int = 0
+    sums: list[int] = field(default_factory=lambda: [0, 0, 0, 0])
+    tail_len: int = 0
+
+
+class ChunkCounter(object):
+    """ count lines of a chunk starting at an unknown line of the FASTQ stream """
+
+    def __init__(self, start: int = 0):
+        self.count = ChunkCount(start=start)
+
+    def update(self, data: bytes):
+        c = self.count
+        if not c.has_newline:
+            pos = data.find(b'\n')
+            if pos < 0:
+                c.head_len += len(data)
+                return
+            c.head_len += pos
+            c.has_newline = True
+            data = data[pos + 1:]
+
+        if np is not None:
+            ends = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)
+            if len(ends) == 0:
+                c.tail_len += len(data)
+                return
+            lengths = np.diff(ends, prepend=-1) - 1
+            lengths[0] += c.tail_len
+            c.tail_len = len(data) - int(ends[-1]) - 1
+            sums = [int(lengths[(j - c.lines) % 4::4].sum()) for j in range(4)]
+            nlines = len(ends)
+        else:
+            lines = data.split(b'\n')
+            partial = lines.pop()
+            if not lines:
+                c.tail_len += len(partial)
+                return
+            lengths = list(map(len, lines))
+            lengths[0] += c.tail_len
+            c.tail_len = len(partial)
+            sums = [sum(lengths[(j - c.lines) % 4::4]) for j in range(4)]
+            nlines = len(lines)
+
+        # sums[j] holds lines whose index in the chunk (after the first newline)
+        # is j modulo 4
+        c.sums = [a + b for (a, b) in zip(c.sums, sums)]
+        c.lines += nlines
+
+
+def count_chunk(path: str | pathlib.Path, start: int, end: int, bufsize: int = read_size):
+    """ decompress and count the whole gzip members within the byte range,
+        raising zlib.error if the range does not end at a member boundary
+    """
+
+    def read_blocks(f):
+        remaining = end - start
+        while remaining > 0 and (data := f.read(min(bufsize, remaining))):
+            remaining -= len(data)
+            yield data
+
+    counter = ChunkCounter(start)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        for data in decompress_blocks(read_blocks(f)):
+            counter.update(data)
+    return counter.count
+
+
+def merge_counts(counts: list[ChunkCount]):
+    """ merge chunk counts in file order, and return (read_count, base_count) """
+
+    lines = partial_len = base_count = 0
+    for c in sorted(counts, key=lambda c: c.start):
+        if not c.has_newline:
+            partial_len += c.head_len
+            continue
+
+        # the first line of the chunk continues the last line of the previous chunk
+        if lines % 4 == 1:
+            base_count += partial_len + c.head_len
+        lines += 1
+        base_count += c.sums[(1 - lines) % 4]
+        lines += c.lines
+        partial_len = c.tail_len
+
+    if partial_len:
+        if lines % 4 == 1:
+            base_count += partial_len
+        lines += 1
+
+    if lines % 4 != 0:
+        raise ValueError(f'incomplete FASTQ record, found {lines} lines')
+    return (lines // 4, base_count)
+
+
+def count_fastq_rapidgzip(path: str | pathlib.Path, threads: int, bufsize: int = read_size):
+    """ return (read_count, base_count) of a FASTQ.gz file decompressed by rapidgzip """
+
+    import rapidgzip
+
+    counter = FastqCounter()
+    index_path = pathlib.Path(str(path) + index_suffix)
+    try:
+        with rapidgzip.open(str(path), parallelization=threads) as f:
+            if index_path.exists():
+                f.import_index(str(index_path))
+            while (data := f.read(bufsize)):
+                counter.update(data)
+    except (OSError, RuntimeError) as err:
+        raise ValueError(f'gzip error in {path}: {err}')
+
+    counter.close()
+    if not counter.is_complete:
+        raise ValueError(f'incomplete FASTQ record in {path}, found {counter.lines} lines')
+    return (counter.read_count, counter.base_count)
+
+
+def submit_count(executor, path: str | pathlib.Path, nchunks: int):
+    """ submit counting of a FASTQ file to a process pool executor, and return
+        the list of futures to be passed to collect_count()
+    """
+
+    if nchunks > 1 and is_gzip(path):
+        if has_rapidgzip():
+            return [executor.submit(count_fastq_rapidgzip, path, nchunks)]
+        ranges = find_member_ranges(path, nchunks)
+        if len(ranges) > 1:
+            return [executor.submit(count_chunk, path, start, end) for (start, end) in ranges]
+    return [executor.submit(count_fastq, path)]
+
+
+def collect_count(executor, path: str | pathlib.Path, futures):
+    """ return (read_count, base_count) from futures of submit_count() """
+
+    if len(futures) == 1:
+        return futures[0].result()
+
+    try:
+        counts = [f.result() for f in futures]
+    except zlib.error:
+        # a speculative boundary was inside a member, or the file is corrupted,
+        # in which case sequential counting reports the actual error
+        return executor.submit(count_fastq, path).result()
+
+    try:
+        return merge_counts(counts)
+    except ValueError as err:
+        raise ValueError(f'{err} in {path}')
+
+# EOF
@@ -0,0 +1,92 @@
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+
+
+"""
+SRA metadata resolver
+
+The resolver turns SRA IDs into SRA_Info instances using the helpers (ENA, Entrez),
+with SRA IDs that can not be resolved by a helper passed to the next helper.
+ConcurrentResolver runs the lookups in a thread pool, keeping several batches in
+flight so that the download queue is fed as fast as the service rate limits
+(enforced per HTTP request by sra_repo.http_utils) allow.
+"""
+
+
+def resolve_infos(helper, sra_ids, log=None):
+    """ generate (sra_id, SRA_Info) with ValueError instance instead of SRA_Info
+        for unresolved SRA ID, using batched queries if the helper supports it
+    """
+
+    resolved = set()
+    if hasattr(helper, 'get_sra_infos'):
+        try:
+            for sra_id, info in helper.get_sra_infos(sra_ids):
+                resolved.add(sra_id)
+                yield (sra_id, info)
+            return
+
+        except Exception as exc:
+            # fall back to query each SRA ID
+            if log:
+                log(f'Error in batched query to {helper.label}: {exc}')
+
+    for sra_id in sra_ids:
+        if sra_id in resolved:
+            continue
+        try:
+            yield (sra_id, helper.get_sra_info(sra_id))
+        except ValueError as exc:
+            yield (sra_id, exc)
+
+
+class ConcurrentResolver(object):
+    """ resolve SRA IDs with up to concurrency lookups in flight, each lookup
+        resolving a batch of batch_size SRA IDs with a single helper
+    """
+
+    def __init__(self, helpers, *, concurrency=8, batch_size=20, log=None):
+        self.helpers = helpers
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.log = log
+
+    def resolve(self, sra_ids):
+        """ generate (sra_id, helper, SRA_Info or ValueError) in order of completion;
+            an SRA ID failing with a helper will be generated again with the next helper
+        """
+
+        results = Queue()
+
+        def resolve_batch(batch):
+            pending = batch
+            for helper in self.helpers:
+                if not pending:
+                    break
+                unresolved = []
+                for sra_id, info in resolve_infos(helper, pending, self.log):
+                    if not isinstance(info, Exception) and not any(info.urls):
+                        info = ValueError(f'SRA {sra_id} does not have any files [{helper.label}]')
+                    if isinstance(info, Exception):
+                        unresolved.append(sra_id)
+                    results.put((sra_id, helper, info))
+                pending = unresolved
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(resolve_batch, sra_ids[idx:idx + self.batch_size])
+                       for idx in range(0, len(sra_ids), self.batch_size)]
+            for future in futures:
+                future.add_done_callback(lambda _: results.put(None))
+
+            # each finished batch puts None after its results
+            remaining = len(futures)
+            while remaining > 0:
+                if (item := results.get()) is None:
+                    remaining -= 1
+                    continue
+                yield item
+
+            for future in futures:
+                future.result()
+
+# EOF
@@ -0,0 +1,224 @@
+import hashlib
+import itertools
+import os
+import pathlib
+import shutil
+import subprocess
+
+from threading import Thread
+
+from sra_repo.fastq_verifier import FileReport, RunReport, read_size
+from sra_repo.executor import Resources, get_executor
+
+
+"""
+Streaming SRA to FASTQ conversion
+
+fasterq-dump writes interleaved FASTQ records to its stdout (read 1 and read 2
+of each spot consecutively), which are split into two streams and piped into
+multi-threaded compressors (pigz, or gzip if pigz is not available).  Read and
+base counts are computed from the uncompressed stream, and MD5 hashes and sizes
+from the compressed streams, hence no uncompressed FASTQ file is ever written to
+the temporary directory and the compressed files do not need to be read again.
+
+The number of compression threads per file can be set with
+SRA_REPO_COMPRESS_THREADS environment [4]
+"""
+
+compress_threads = int(os.environ.get('SRA_REPO_COMPRESS_THREADS', 4))
+
+
+def compressor_cmds(threads: int = compress_threads):
+    if shutil.which('pigz'):
+        return ['pigz', '-p', str(threads), '-c']
+    return ['gzip', '-c']
+
+
+class PairedSplitter(object):
+    """ split interleaved FASTQ stream fed in arbitrary blocks into read 1 and read 2
+        streams, checking that both mates of each pair belong to the same spot
+    """
+
+    def __init__(self, stats=None):
+        self.read_count = 0
+        self.base_counts = [0, 0]
+        self._lines = []
+        self._partial = b''
+
+        # optional pair of FastqStats of read 1 and read 2
+        self.stats = stats
+
+    def update(self, data: bytes):
+        """ return a tuple of (read 1 block, read 2 block) of complete pairs """
+
+        lines = data.split(b'\n')
+        lines[0] = self._partial + lines[0]
+        self._partial = lines.pop()
+        if self._lines:
+            lines = self._lines + lines
+
+        # a pair consists of 8 lines, the rest is carried to the next block
+        n = len(lines) // 8 * 8
+        self._lines = lines[n:]
+        if n == 0:
+            return (b'', b'')
+        return self._split(lines[:n])
+
+    def _split(self, lines):
+
+        headers_1, headers_2 = lines[0::8], lines[4::8]
+        if ([h.split(b' ', 1)[0] for h in headers_1]
+                != [h.split(b' ', 1)[0] for h in headers_2]):
+            raise ValueError('FASTQ stream is not paired, mate headers do not match')
+
+        self.read_count += len(headers_1)
+        blocks = []
+        for (offset, headers) in [(0, headers_1), (4, headers_2)]:
+            seqs = lines[offset + 1::8]
+            self.base_counts[offset // 4] += sum(map(len, seqs))
+            if self.stats:
+                self.stats[offset // 4].add_records(seqs, lines[offset + 3::8])
+            records = zip(headers, seqs, lines[offset + 2::8], lines[offset + 3::8])
+            blocks.append(b'\n'.join(itertools.chain.from_iterable(records)) + b'\n')
+
+        return tuple(blocks)
+
+    def close(self):
+        if self._partial:
+            self._lines.append(self._partial)
+            self._partial = b''
+        if self._lines:
+            raise ValueError(f'FASTQ stream ends with an incomplete pair of '
+                             f'{len(self._lines)} line(s)')
+
+
+class CompressedWriter(object):
+    """ pipe data into a compressor, and write the compressed stream to a file
+        while calculating its MD5 hash and size
+    """
+
+    def __init__(self, path: str | pathlib.Path, threads: int = compress_threads):
+        self.report = FileReport(path=pathlib.Path(path))
+        self._hasher = hashlib.md5()
+        self.error = None
+        self.proc = subprocess.Popen(compressor_cmds(threads),
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._thread = Thread(target=self._drain)
+        self._thread.start()
+
+    def _drain(self):
+        try:
+            with open(self.report.path, 'wb') as f:
+                while (data := self.proc.stdout.read(read_size)):
+                    self._hasher.update(data)
+                    self.report.size += len(data)
+                    f.write(data)
+        except Exception as err:
+            # eg. ENOSPC, stop the compressor so that the writer does not block on
+            # the full pipe
+            self.error = err
+            self.proc.kill()
+
+    def write(self, data: bytes):
+        if self.error:
+            raise self.error
+        if data:
+            try:
+                self.proc.stdin.write(data)
+            except OSError:
+                if self.error:
+                    raise self.error
+                raise
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            if not self.error:
+                raise
+        self._thread.join()
+        if self.proc.wait() != 0:
+            self.report.errmsg = f'compressor exited with code {self.proc.returncode}'
+        self.report.gzip_ok = self.proc.returncode == 0
+        self.report.md5sum = self._hasher.hexdigest()
+        if self.error:
+            self.report.gzip_ok = False
+            self.report.errmsg = f'error writing compressed file: {self.error}'
+            raise self.error
+        return self.report
+
+    def abort(self):
+        self.proc.kill()
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        self._thread.join()
+        self.proc.wait()
+        self.report.path.unlink(missing_ok=True)
+
+
+def stream_convert(
+    sra_path: str | pathlib.Path,
+    dest_paths: list[pathlib.Path],
+    *,
+    tmpdir: str | pathlib.Path | None = None,
+    threads: int = compress_threads,
+    executor=None,
+    collect_stats: bool = False,
+    log=None,
+):
+    """ convert .sra file to a pair of compressed FASTQ files in a single stream, and
+        return RunReport of the files, with the statistics of each file if
+        collect_stats is True
+    """
+
+    sra_path = pathlib.Path(sra_path)
+    tmpdir = tmpdir or sra_path.parent
+    executor = executor or get_executor()
+    cmds = ['fasterq-dump', '--stdout', '--split-spot', '--skip-technical',
+            '-e', str(threads), '-t', str(tmpdir), sra_path.as_posix()]
+    resources = Resources(cpus=threads)
+    if log:
+        log('Running: ' + executor.describe(cmds, resources) + ' | '
+            + ' '.join(compressor_cmds(threads)))
+
+    dumper = executor.popen(cmds, resources=resources,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    writers = [CompressedWriter(p, threads) for p in dest_paths]
+    stats = None
+    if collect_stats:
+        from sra_repo.fastq_stats import FastqStats
+        stats = [FastqStats(), FastqStats()]
+    splitter = PairedSplitter(stats)
+
+    try:
+        while (data := dumper.stdout.read(read_size)):
+            for (writer, block) in zip(writers, splitter.update(data)):
+                writer.write(block)
+        splitter.close()
+        if dumper.wait() != 0:
+            raise ValueError(f'fasterq-dump exited with code {dumper.returncode}')
+
+    except BaseException:
+        dumper.kill()
+        dumper.wait()
+        for writer in writers:
+            writer.abort()
+        raise
+
+    try:
+        files = [writer.close() for writer in writers]
+    except BaseException:
+        for writer in writers:
+            writer.abort()
+        raise
+    for (report, base_count) in zip(files, splitter.base_counts):
+        report.read_count = splitter.read_count
+        report.base_count = base_count
+    for (report, file_stats) in zip(files, stats or []):
+        report.stats = file_stats
+
+    return RunReport(files=files)
+
+# EOF
@@ -4,7 +4,7 @@ import pathlib
 import shutil
 
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from threading import Lock, Thread
 from queue import Queue
 from typing import Any
@@ -12,6 +12,9 @@ from rich.progress import Console
 
 from sra_repo import download_utils
 from sra_repo.filestore import SRA_Info
+from sra_repo.resolver import ConcurrentResolver, resolve_infos
+from sra_repo.journal import RunJournal
+from sra_repo.admission import InsufficientSpace, SpaceAdmission
 
 
 @dataclass
@@ -30,15 +33,26 @@ class SRA(object):
     errmsg: str = ''
     metadata: dict | None = None
 
+    # MD5 hashes computed during downloading, keyed by local path
+    digests: dict = field(default_factory=dict)
+
     helper: Any = None
+    journal: RunJournal | None = None
 
 
 class SRA_Fetcher(object):
 
     helpers = []
 
+    # number of SRA IDs to be resolved in a single batch
+    batch_size = 200
+
     def __init__(self, sraids, *, filestore, temp_directory, repos,
-                 showcmds=False, showurl=False, target_directory=None):
+                 showcmds=False, showurl=False, target_directory=None,
+                 segments=1, segment_threshold=1024 ** 3, engine='easy',
+                 resolver='batch', lookups=8, process_tasks=2, store_tasks=1,
+                 stream_convert=False, space_headroom=None, limiter=None,
+                 transport=None, collect_stats=False):
 
         self.sraids = sraids
         self.filestore = filestore
@@ -47,6 +61,27 @@ class SRA_Fetcher(object):
         self.showcmds = showcmds
         self.showurl = showurl
         self.target_directory = target_directory
+        self.segments = segments
+        self.segment_threshold = segment_threshold
+        self.engine = engine
+        self.resolver = resolver
+        self.lookups = lookups
+        self.process_tasks = process_tasks
+        self.store_tasks = store_tasks
+        self.stream_convert = stream_convert
+        self.limiter = limiter
+        self.transport = transport
+        self.collect_stats = collect_stats
+
+        # reserve disk space before queueing each SRA for download
+        self.admission = None
+        if space_headroom is not None:
+            self.admission = SpaceAdmission(
+                self.temp_directory,
+                target_directory or filestore.__storage_root_path__,
+                headroom=space_headroom,
+                stream_convert=stream_convert,
+            )
 
         self.sra_d = {}
         self.path_d = {}
@@ -55,6 +90,12 @@ class SRA_Fetcher(object):
         self.sra_errors = {}
         self.url_path_queue = Queue(3)
 
+        # SRA instances whose files have all been downloaded, and SRA instances
+        # that have been processed, each consumed by its own pool of workers;
+        # the queues are bounded so that downloading does not run too far ahead
+        self.process_queue = Queue(process_tasks)
+        self.store_queue = Queue(store_tasks)
+
         # acquire this lock if we need to modify any of the above variables
         # to prevent race condition
         self.lock = Lock()
@@ -65,10 +106,40 @@ class SRA_Fetcher(object):
         self.console = Console()
 
     def fetch(self, ntasks=1, count=-1):
+        """ fetch SRA files with ntasks concurrent downloads, while downloaded files
+            are processed (verified or converted) and stored by separate worker pools
+        """
 
         if count > 0:
             self.sraids = self.sraids[:count]
 
+        workers = self.start_workers()
+        try:
+            self.download(ntasks)
+        finally:
+            self.stop_workers(workers)
+
+    def download(self, ntasks):
+
+        if self.engine == 'multi':
+            # a single event loop drives ntasks concurrent transfers
+            t = self.start_url_fetcher()
+            download_utils.download_multi(
+                iter(self.url_path_queue.get, None),
+                total=self.get_total,
+                max_transfers=ntasks,
+                before_started=self._before_started,
+                after_finished=self._after_finished,
+                console=self.console,
+                resume_of=self.get_resume,
+                after_failed=self._after_failed,
+                limiter=self.limiter,
+                transport=self.transport,
+                with_md5sum=True,
+            )
+            t.join()
+            return
+
         if ntasks > 1:
             t = self.start_url_fetcher()
         else:
@@ -82,10 +153,38 @@ class SRA_Fetcher(object):
             before_started=self._before_started,
             after_finished=self._after_finished,
             console=self.console,
+            segments=self.segments,
+            segment_threshold=self.segment_threshold,
+            size_of=self.get_size,
+            resume_of=self.get_resume,
+            after_failed=self._after_failed,
+            limiter=self.limiter,
+            transport=self.transport,
+            with_md5sum=True,
         )
         if ntasks > 1 and t:
             t.join()
 
+    def start_workers(self):
+
+        workers = (
+            [Thread(target=self.process_worker) for i in range(self.process_tasks)],
+            [Thread(target=self.store_worker) for i in range(self.store_tasks)],
+        )
+        for pool in workers:
+            for t in pool:
+                t.start()
+        return workers
+
+    def stop_workers(self, workers):
+        """ let each stage finish its queue before stopping the next stage """
+
+        for (queue, pool) in zip([self.process_queue, self.store_queue], workers):
+            for t in pool:
+                queue.put(None)
+            for t in pool:
+                t.join()
+
     def start_url_fetcher(self):
 
         t = Thread(target=self.prepare_url)
@@ -94,104 +193,311 @@ class SRA_Fetcher(object):
 
     def prepare_url(self):
 
+        if self.resolver == 'concurrent':
+            self.prepare_url_concurrent()
+            return
+
         _c = self.console.log
 
-        # prepare SRA instances
-        for idx, sra_id in enumerate(self.sraids, 1):
+        try:
+            sraids = self.resume_journaled()
+            indexes = {sra_id: idx for idx, sra_id in enumerate(self.sraids, 1)}
 
-            indicator = f'[{idx}/{len(self.sraids)}]'
-            sra = None
+            # prepare SRA instances in batches, with SRA IDs that can not be resolved
+            # by a helper passed to the next helper
+            for start in range(0, len(sraids), self.batch_size):
 
-            errmsgs = []
-            for helper in self.helpers:
-                try:
-                    _c(f'{indicator} Requesting information from {helper.label} for {sra_id}')
-                    info = helper.get_sra_info(sra_id)
-                    urls, filenames = info.urls, info.files
-
-                    if not any(urls):
-                        raise ValueError(f'SRA {sra_id} does not have any files [{helper.label}]')
-
-                    paths = [self.temp_directory / fn for fn in filenames]
-                    sra = SRA(
-                        acc_id=sra_id,
-                        urls=urls,
-                        paths=paths,
-                        md5sums=info.md5sums,
-                        filesizes=info.sizes,
-                        read_count=info.read_count,
-                        base_count=info.base_count,
-                        info=info,
-                        pending=len(urls),
-                        helper=helper,
-                    )
+                batch = sraids[start:start + self.batch_size]
+
+                pending = batch
+                for helper in self.helpers:
+                    if not pending:
+                        break
+
+                    _c(f'[{start + 1}-{start + len(batch)}/{len(sraids)}] Requesting '
+                       f'information from {helper.label} for {len(pending)} SRA(s)')
+
+                    unresolved = []
+                    for sra_id, info in resolve_infos(helper, pending, _c):
+                        indicator = f'[{indexes[sra_id]}/{len(self.sraids)}]'
+                        try:
+                            if isinstance(info, Exception):
+                                raise info
+                            self.queue_sra(indicator, sra_id, info, helper)
+                            self.sra_errors.pop(sra_id, None)
+
+                        except InsufficientSpace as exc:
+                            # other helpers would need the same space
+                            _c(f'{indicator} Not enough disk space for {sra_id}')
+                            self.sra_errors[sra_id] = (f'ERR: {exc}')
 
-                    with self.lock:
-                        self.sra_d[sra_id] = sra
-                        for path in paths:
-                            self.path_d[path] = sra
+                        except ValueError as exc:
+                            _c(f'{indicator} Error accessing info from {helper.label} for {sra_id}')
+                            self.sra_errors[sra_id] = (f'WARN: {exc}')
+                            unresolved.append(sra_id)
 
-                    _c(f'{indicator} Queueing {sra_id} for download')
-                    for url_path in zip(urls, paths):
-                        self.url_path_queue.put(url_path)
-                        self.total += 1
+                    pending = unresolved
+
+        finally:
+            self.url_path_queue.put(None)
+
+    def prepare_url_concurrent(self):
+
+        _c = self.console.log
 
-                    break
+        try:
+            sraids = self.resume_journaled()
+            indexes = {sra_id: idx for idx, sra_id in enumerate(self.sraids, 1)}
+            resolver = ConcurrentResolver(self.helpers, concurrency=self.lookups, log=_c)
+
+            _c(f'Requesting information for {len(sraids)} SRA(s) with up to '
+               f'{self.lookups} concurrent lookups')
+
+            for sra_id, helper, info in resolver.resolve(sraids):
+                indicator = f'[{indexes[sra_id]}/{len(self.sraids)}]'
+                try:
+                    if isinstance(info, Exception):
+                        raise info
+                    self.queue_sra(indicator, sra_id, info, helper)
+                    self.sra_errors.pop(sra_id, None)
+
+                except InsufficientSpace as exc:
+                    _c(f'{indicator} Not enough disk space for {sra_id}')
+                    self.sra_errors[sra_id] = (f'ERR: {exc}')
 
                 except ValueError as exc:
                     _c(f'{indicator} Error accessing info from {helper.label} for {sra_id}')
                     self.sra_errors[sra_id] = (f'WARN: {exc}')
 
-            else:
+        finally:
+            self.url_path_queue.put(None)
+
+    def resume_journaled(self):
+        """ queue SRA IDs having metadata in their journals without resolving them again,
+            and return the rest of SRA IDs
+        """
+
+        helpers = {helper.label: helper for helper in self.helpers}
+        remaining = []
+
+        for idx, sra_id in enumerate(self.sraids, 1):
+            journal = RunJournal(self.temp_directory, sra_id)
+            if journal.info is None or journal.helper not in helpers:
+                remaining.append(sra_id)
+                continue
+            indicator = f'[{idx}/{len(self.sraids)}]'
+            try:
+                self.queue_sra(indicator, sra_id, SRA_Info(**journal.info),
+                               helpers[journal.helper], journal)
+            except InsufficientSpace as exc:
+                self.console.log(f'{indicator} Not enough disk space for {sra_id}')
+                self.sra_errors[sra_id] = (f'ERR: {exc}')
+            except ValueError as exc:
+                self.console.log(f'{indicator} Error resuming {sra_id} from its journal')
+                self.sra_errors[sra_id] = (f'WARN: {exc}')
+
+        return remaining
 
-                # for-loop is exhausted meaning we don't get SRA urls
-                if errmsgs:
-                    self.errbuf.write('\n'.join(errmsgs))
+    def queue_sra(self, indicator, sra_id, info, helper, journal=None):
 
-        self.url_path_queue.put(None)
-     
-    def _before_started(self, url, localpth):
+        _c = self.console.log
+
+        urls, filenames = info.urls, info.files
+
+        if not any(urls):
+            raise ValueError(f'SRA {sra_id} does not have any files [{helper.label}]')
+
+        if self.admission:
+            self.admission.acquire(info, log=_c)
+
+        if journal is None:
+            journal = RunJournal(self.temp_directory, sra_id)
+            journal.record('info', info=info.as_dict(), helper=helper.label)
+
+        paths = [self.temp_directory / fn for fn in filenames]
+        sra = SRA(
+            acc_id=sra_id,
+            urls=urls,
+            paths=paths,
+            md5sums=info.md5sums,
+            filesizes=info.sizes,
+            read_count=info.read_count,
+            base_count=info.base_count,
+            info=info,
+            pending=len(urls),
+            helper=helper,
+            journal=journal,
+        )
+
+        with self.lock:
+            self.sra_d[sra_id] = sra
+            for path in paths:
+                self.path_d[path] = sra
+
+        if journal.is_processed(self.temp_directory):
+            # the files have been verified or converted, only need to be stored
+            sra.info = SRA_Info(**journal.processed)
+            sra.paths = [self.temp_directory / fn for fn in sra.info.files]
+            sra.md5sums = sra.info.md5sums
+            _c(f'{indicator} Resuming {sra_id} for storing')
+            self.store_queue.put(sra)
+            return
+
+        url_paths = []
+        for (idx, (url, path)) in enumerate(zip(urls, paths)):
+            if journal.is_downloaded(path):
+                if (md5sum := journal.downloaded[path.name][1]):
+                    sra.digests[path] = md5sum
+                continue
+            if self.transport and info.mirrors:
+                # use the fastest endpoint, and let stalled transfers switch to others
+                url = self.transport.register(path, info.mirrors[idx])
+            url_paths.append((url, path))
+        sra.pending = len(url_paths)
+
+        if not url_paths:
+            _c(f'{indicator} Resuming {sra_id} for processing')
+            self.process_queue.put(sra)
+            return
+
+        if len(url_paths) < len(urls):
+            _c(f'{indicator} Resuming {sra_id} with {len(urls) - len(url_paths)} '
+               f'downloaded file(s)')
+
+        _c(f'{indicator} Queueing {sra_id} for download')
+        for url_path in url_paths:
+            self.url_path_queue.put(url_path)
+            self.total += 1
+
+    def _before_started(self, url, localpath):
         if self.showurl:
             self.console.log(f'Start downloading: {url}')
+        sra = self.path_d[localpath]
+        if localpath.name not in sra.journal.started:
+            sra.journal.record('started', filename=localpath.name)
 
-    def _after_finished(self, url, localpath):
+    def _after_finished(self, url, localpath, md5sum=None):
 
-        _c = self.console.log
         sra = self.path_d[localpath]
 
-        sra.helper.process_file(localpath, sra)
+        if md5sum:
+            sra.digests[localpath] = md5sum
+        sra.journal.record('downloaded', filename=localpath.name,
+                           size=localpath.stat().st_size, md5sum=md5sum)
 
         with self.lock:
             sra.pending += -1
-            # _c(f'INFO: sra.pending = {sra.pending} for SRA: {sra.acc_id}')
-            if sra.pending == 0:
-                if sra.error:
-                    # we  found error, just return without storing files
-                    _c(f'ERROR found during post-downloading {sra.acc_id}. Skipping...')
-                    return
+            completed = sra.pending == 0
+
+        # hand over the SRA to the processing stage, which blocks only when
+        # all processing workers are busy and the queue is full
+        if completed:
+            self.process_queue.put(sra)
+
+        self.url_path_queue.task_done()
+
+    def _after_failed(self, url, localpath):
+
+        sra = self.path_d[localpath]
+        sra.error += 1
+
+        # the SRA will not be processed, hence free its reservation for other SRAs
+        if self.admission:
+            self.admission.release(sra.acc_id)
+
+    def process_worker(self):
 
+        _c = self.console.log
+
+        while (sra := self.process_queue.get()) is not None:
+
+            try:
+                # process_file() may replace sra.paths, eg. with converted files
+                for path in list(sra.paths):
+                    sra.helper.process_file(path, sra)
+            except Exception as exc:
+                _c(f'ERROR processing {sra.acc_id}: {exc}')
+                sra.error += 1
+
+            if sra.error:
+                # we  found error, just return without storing files, and let the next
+                # fetch download the files again
+                _c(f'ERROR found during post-downloading {sra.acc_id}. Skipping...')
+                sra.journal.record('failed')
+                if self.admission:
+                    self.admission.release(sra.acc_id)
+                continue
+
+            if self.collect_stats and sra.info.stats is None:
+                # files not decompressed during processing, eg. from EBI/ENA
+                try:
+                    from sra_repo.fastq_stats import stat_files
+                    sra.info.stats = stat_files(sra.paths).as_dict()
+                except (ValueError, OSError) as exc:
+                    _c(f'WARN: failed to collect statistics of {sra.acc_id}: {exc}')
+
+            sra.journal.record('processed', info=sra.info.as_dict())
+            if self.admission:
+                # all files are in the temporary directory, only storage space is needed
+                self.admission.update(sra.acc_id, 0)
+            self.store_queue.put(sra)
+
+    def store_worker(self):
+
+        _c = self.console.log
+
+        while (sra := self.store_queue.get()) is not None:
+
+            try:
                 if self.target_directory is not None:
                     # instead of storing to the fs database, just move to target dir
                     for srapath in sra.paths:
                         shutil.move(srapath, self.target_directory)
+                    strategies = ['move']
                 else:
-                    self.filestore.store(
+                    strategies = self.filestore.store(
                         sra.acc_id,
                         sra.paths,
                         sra.info,
                         use_move=True,
                     )
+            except Exception as exc:
+                _c(f'ERROR storing {sra.acc_id}: {exc}')
+                continue
 
-                self.completed += 1
-                _c(f'({self.completed}/{len(self.sraids)}) '
-                   f'Stored {len(sra.paths)} file(s) for {sra.acc_id}')
+            finally:
+                if self.admission:
+                    self.admission.release(sra.acc_id)
+
+            sra.journal.record('stored')
+            sra.journal.remove()
 
+            with self.lock:
+                self.completed += 1
                 # remove ena from sra_d
                 del self.sra_d[sra.acc_id]
 
-        self.url_path_queue.task_done()
+            _c(f'({self.completed}/{len(self.sraids)}) '
+               f'Stored {len(sra.paths)} file(s) for {sra.acc_id} '
+               f'(via {", ".join(sorted(set(strategies)))})')
 
     def get_total(self):
         return self.total
 
+    def get_resume(self, url, localpath):
+        """ return True if the partial file was downloaded by a previous fetch """
+        with self.lock:
+            sra = self.path_d.get(localpath)
+        return (sra is not None and localpath.name in sra.journal.started
+                and localpath.is_file())
+
+    def get_size(self, url, localpath):
+        """ return the expected size of the file to download, or None if unknown """
+        with self.lock:
+            sra = self.path_d.get(localpath)
+        if sra is None or not sra.filesizes or localpath not in sra.paths:
+            return None
+        size = sra.filesizes[sra.paths.index(localpath)]
+        return size if size and size > 0 else None
+
 # EOF
@@ -1,10 +1,13 @@
 
-from concurrent.futures import ThreadPoolExecutor, wait, as_completed
-import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from collections import deque
 import threading
-import subprocess
 
-from sra_repo.utils import cerr, md5sum_file
+from sra_repo.utils import cerr
+from sra_repo.fastq_verifier import verify_files
+from sra_repo.filestore import file_fingerprint
+from sra_repo.device_scheduler import DeviceScheduler
+from sra_repo.executor import get_executor
 
 """
 Entrez XML attributes
@@ -32,39 +35,101 @@ ENA JSON Filereport
 
 class SRA_Validator(object):
 
-    def __init__(self, sraids, fs, *, validate=False, helpers=[], showcmds=False):
+    def __init__(self, sraids, fs, *, validate=False, deep=False, helpers=[], showcmds=False,
+                 scheduler=None):
         self.sraids = sraids
         self.fs = fs
+        self.scheduler = scheduler or DeviceScheduler()
         self.validate_flag = validate
+        self.deep_flag = deep
         self.showcmds_flag = showcmds
         self.helpers = [class_(self) for class_ in helpers]
         self.err_sraids = []
         self.finished = 0
         self._lock = threading.Lock()
 
+        # number of files skipped because of unchanged fingerprints, and number
+        # of files whose MD5 hashes were computed
+        self.skipped_files = 0
+        self.rehashed_files = 0
+
+        # SRA info from batched ENA queries for SRA IDs needing revalidation
+        self.ena_infos = {}
+
+    def prefetch_ena_infos(self):
+        """ query ENA in batches for SRA IDs without info, so that revalidation does
+            not need to query ENA for each SRA ID
+        """
+
+        from sra_repo.ena_helper import ENA_Helper
+
+        sraids = [sra_id for sra_id in self.sraids
+                  if self.fs.check(sra_id=sra_id, throw_exc=False)
+                  and not self.fs.has_validation_info(sra_id)]
+        if not any(sraids):
+            return
+
+        cerr(f'Requesting information from EBI/ENA for {len(sraids)} SRA(s) without info')
+        try:
+            for sra_id, info in ENA_Helper(None).get_sra_infos(sraids):
+                if not isinstance(info, Exception):
+                    self.ena_infos[sra_id] = info
+        except Exception as err:
+            cerr(f'WARN: batched query to EBI/ENA failed: {err}')
+
     def validate(self, threads=4):
 
+        if self.validate_flag:
+            self.prefetch_ena_infos()
+
         if threads == 1:
             for idx, sra_id in enumerate(self.sraids):
                 self._validate(sra_id, idx)
             return
 
-        with ThreadPoolExecutor(max_workers=threads) as executor:
-            futures = []
-            for idx, sra_id in enumerate(self.sraids, 1):
-                futures.append(
-                    executor.submit(
-                        self._validate,
-                        sra_id,
-                        idx,
-                    )
-                )
-                time.sleep(0.75)
+        if not self.validate_flag:
+            # without validation, no file data is read, hence no device limit
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                futures = [executor.submit(self._validate, sra_id, idx)
+                           for idx, sra_id in enumerate(self.sraids, 1)]
+                for future in as_completed(futures):
+                    future.result()
+            return
 
-            # finished up all futures
-            for future in as_completed(futures):
-                # get the result
-                future.result()
+        # queue SRA IDs per device, and only dispatch an SRA ID when its device has
+        # a free reader slot, so that SRA IDs in a slow device do not occupy all threads
+        pending = {}
+        for idx, sra_id in enumerate(self.sraids, 1):
+            pending.setdefault(self.device_of(sra_id), deque()).append((idx, sra_id))
+
+        active = {dev: 0 for dev in pending}
+        running = {}
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            while pending or running:
+                for dev in list(pending):
+                    limit = self.scheduler.limit_of(dev) if dev is not None else threads
+                    while pending[dev] and len(running) < threads and active[dev] < limit:
+                        idx, sra_id = pending[dev].popleft()
+                        running[executor.submit(self._validate, sra_id, idx)] = dev
+                        active[dev] += 1
+                    if not pending[dev]:
+                        del pending[dev]
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    active[running.pop(future)] -= 1
+                    future.result()
+
+        cerr(self.scheduler.summary())
+
+    def device_of(self, sra_id):
+        """ return the device of the storage directory of the SRA ID, or None if the
+            directory does not exist
+        """
+        try:
+            return self.scheduler.device_of(self.fs.get_dirpath(sra_id))
+        except (OSError, ValueError):
+            return None
 
     def _validate(self, sra_id, idx):
 
@@ -85,8 +150,19 @@ class SRA_Validator(object):
             try:
                 info = self.fs.get_validation_info(sra_id)
                 self.validate_filesize(sra_id, read_files, info)
-                self.validate_md5sum(sra_id, read_files, info)
-                cerr(f'[{idx}/{len(self.sraids)}] - MD5sum matched for {sra_id}')
+
+                # files unchanged since their last verification do not need rehashing
+                verified = ([] if self.deep_flag
+                            else self.fs.get_verified_files(sra_id, read_files, info))
+                with self._lock:
+                    self.skipped_files += len(verified)
+
+                if (changed_files := [p for p in read_files if p not in verified]):
+                    self.validate_md5sum(sra_id, changed_files, info)
+                    cerr(f'[{idx}/{len(self.sraids)}] - MD5sum matched for {sra_id}')
+                else:
+                    cerr(f'[{idx}/{len(self.sraids)}] - files unchanged since last '
+                         f'verification for {sra_id}')
 
             except NotImplementedError:
 
@@ -124,13 +200,29 @@ class SRA_Validator(object):
             cerr(f'[{finished}/{len(self.sraids)}] - finished validating')
 
     def validate_md5sum(self, sra_id, read_files, info):
+        """ verify gzip integrity and MD5 hashes of the read files in a single pass,
+            and return the RunReport from the verifier
+        """
 
-        for read_file in read_files:
-            if md5sum_file(read_file) != info.get_md5(read_file.name):
+        fingerprints = {p: file_fingerprint(p) for p in read_files}
+        report = verify_files(read_files, threads=len(read_files), scheduler=self.scheduler)
+        with self._lock:
+            self.rehashed_files += len(read_files)
+
+        for (read_file, file_report) in zip(read_files, report.files):
+            if not file_report.is_valid:
+                raise ValueError(
+                    f'{sra_id} - validation error, {read_file.name} is not valid: '
+                    f'{file_report.errmsg or "gzip error"}'
+                )
+            if file_report.md5sum != info.get_md5(read_file.name):
                 raise ValueError(
                     f'{sra_id} - validation error, mismatched md5sum for {read_file.name}'
                 )
 
+        self.fs.record_verified_files(sra_id, fingerprints, info)
+        return report
+
     def validate_filesize(self, sra_id, read_files, info):
 
         for read_file in read_files:
@@ -167,7 +259,7 @@ class SRA_Validator(object):
 
         from sra_repo.ena_helper import ENA_Helper
 
-        info = ENA_Helper(None).get_sra_info(sra_id)
+        info = self.ena_infos.pop(sra_id, None) or ENA_Helper(None).get_sra_info(sra_id)
 
         # check with size first
         # cerr('check file size')
@@ -185,34 +277,36 @@ class SRA_Validator(object):
 
         info = Entrez_Helper(None).get_sra_info(sra_id)
 
-        # check for total read and base counts
+        # check for total read and base counts, while also computing MD5 hashes
 
-        retcode = validate_read_base_counts(read_files,
-                                            info.read_count,
-                                            info.base_count,
-                                            prefix_cmd=['srun'])
-
-        if retcode != 0:
-            raise ValueError('read and base counts of {sra_id} do not match')
+        fingerprints = {p: file_fingerprint(p) for p in read_files}
+        report = verify_files(read_files, threads=len(read_files), scheduler=self.scheduler)
+        with self._lock:
+            self.rehashed_files += len(read_files)
+        try:
+            report.check(info.read_count, info.base_count)
+        except ValueError as err:
+            raise ValueError(f'read and base counts of {sra_id} do not match: {err}')
 
         info.files = [p.name for p in read_files]
-        info.md5sums = [md5sum_file(p) for p in read_files]
-        info.sizes = [p.stat().st_size for p in read_files]
+        info.md5sums = report.md5sums
+        info.sizes = report.sizes
+        self.fs.record_verified_files(sra_id, fingerprints, info)
 
         return info
 
 
-def validate_read_base_counts(read_files, read_count, base_count, prefix_cmd=[], showcmds=False):
-    cmds = prefix_cmd + ['sra-validator.py',
-                         '--bases', str(base_count),
-                         '--reads', str(read_count)
-                         ] + read_files
+def validate_read_base_counts(read_files, read_count, base_count, executor=None,
+                              showcmds=False):
+    executor = executor or get_executor()
+    cmds = ['sra-validator.py',
+            '--bases', str(base_count),
+            '--reads', str(read_count)
+            ] + read_files
 
     if showcmds:
-        cerr(f' - will run: {" ".join(cmds)}')
-    return subprocess.call(
-        cmds, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-    )
+        cerr(f' - will run: {executor.describe(cmds)}')
+    return executor.run(cmds)
 
 
 # EOF
@@ -0,0 +1,129 @@
+import json
+import os
+import pathlib
+import threading
+import time
+
+from urllib.parse import urlparse
+
+
+"""
+Transport selection
+
+The same file is usually available from several endpoints, eg. ENA files over both
+FTP and HTTPS, and NCBI files from NCBI and cloud mirrors.  The throughput of each
+(protocol, host) is measured from completed transfers and kept as an exponentially
+weighted moving average, persisted in a JSON file set by SRA_REPO_TRANSPORT_STATS
+environment (defaulting to ~/.cache/sra-repo/transport.json).
+
+Endpoints with too few measurements are probed first, afterward the fastest one is
+used.  A transfer stalling below low_speed_limit bytes/second for low_speed_time
+seconds counts as a zero-throughput measurement, and the transfer is switched to
+the next best endpoint of the file.
+"""
+
+
+def endpoint_of(url: str):
+    parsed = urlparse(url)
+    return f'{parsed.scheme.lower()}://{(parsed.hostname or "").lower()}'
+
+
+class TransportSelector(object):
+
+    # smoothing factor of the moving average, and the number of measurements
+    # before an endpoint is considered known
+    alpha = 0.3
+    min_samples = 2
+
+    # measurements from small transfers are dominated by latency
+    min_bytes = 4 * 1024 * 1024
+
+    # stall detection, passed to LOW_SPEED_LIMIT and LOW_SPEED_TIME of curl
+    low_speed_limit = 10 * 1024
+    low_speed_time = 60
+
+    def __init__(self, stats_path: str | pathlib.Path | None = None):
+        self.stats_path = pathlib.Path(stats_path or os.environ.get(
+            'SRA_REPO_TRANSPORT_STATS',
+            pathlib.Path.home() / '.cache' / 'sra-repo' / 'transport.json'
+        ))
+        self.stats = {}
+        self.alternatives = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.stats_path) as f:
+                self.stats = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.stats = {}
+
+    def save(self):
+        with self._lock:
+            stats = dict(self.stats)
+        self.stats_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.stats_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(stats, f, indent=2)
+        tmp_path.replace(self.stats_path)
+
+    def _score(self, url):
+        """ unknown endpoints are sorted first, so that they get probed """
+        stat = self.stats.get(endpoint_of(url))
+        if stat is None or stat['samples'] < self.min_samples:
+            return (0, 0 if stat is None else stat['samples'])
+        return (1, -stat['rate'])
+
+    def order(self, urls: list[str]):
+        """ return urls sorted from the best endpoint, keeping the original order
+            for endpoints with equal score
+        """
+        with self._lock:
+            return sorted(urls, key=self._score)
+
+    def register(self, dest_path, urls: list[str]):
+        """ register the alternative urls of a file, and return the best url """
+        ordered = self.order(urls)
+        with self._lock:
+            self.alternatives[dest_path] = urls
+        return ordered[0]
+
+    def alternate(self, url: str, dest_path):
+        """ return the best url of the file other than url, or None if the file
+            does not have any other url
+        """
+        with self._lock:
+            urls = self.alternatives.get(dest_path, [])
+        candidates = [u for u in self.order(urls) if u != url]
+        return candidates[0] if candidates else None
+
+    def _update(self, url, rate):
+        key = endpoint_of(url)
+        with self._lock:
+            stat = self.stats.get(key)
+            if stat is None:
+                self.stats[key] = dict(rate=rate, samples=1, updated=time.time())
+                return
+            stat['rate'] = (1 - self.alpha) * stat['rate'] + self.alpha * rate
+            stat['samples'] += 1
+            stat['updated'] = time.time()
+
+    def record(self, url: str, nbytes: float, seconds: float):
+        """ record the throughput of a transfer """
+        if nbytes < self.min_bytes or seconds <= 0:
+            return
+        self._update(url, nbytes / seconds)
+
+    def record_stall(self, url: str):
+        self._update(url, 0.0)
+
+    def summary(self):
+        with self._lock:
+            items = sorted(self.stats.items(), key=lambda item: -item[1]['rate'])
+        return 'Transport throughput: ' + ', '.join(
+            f'{key} {stat["rate"] / 1024 ** 2:.1f} MiB/s ({stat["samples"]})'
+            for (key, stat) in items
+        )
+
+# EOF
@@ -40,4 +40,13 @@ def byte_conversion(size):
     return f'{size/r:6.2f} TB'
 
 
+def parse_size(size_str):
+    """ convert size string such as 500M, 2G or 1024 into number of bytes """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size_str = str(size_str).strip().upper().removesuffix('B')
+    if size_str and size_str[-1] in units:
+        return int(float(size_str[:-1]) * units[size_str[-1]])
+    return int(size_str)
+
+
 # EOF